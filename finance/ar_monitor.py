@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+ARの残差による逐次異常スコア (ChangeFinder 風)
+忘却係数つきの逐次最小二乗 (RLS) で銘柄ごとの AR(p) を更新し続け、
+新しいreturnが来るたびに残差から異常スコアを出す。モデルの当てはめ直しはしない。
+
+全銘柄の状態を (銘柄数, ...) の配列で持ち、新しい点が来た銘柄 (1ティック分) を
+まとめて更新する。1銘柄・1点あたりの計算量は O(p^2)。
+
+2段階 (ChangeFinder と同じ構成):
+    1段目: returns の AR の残差から外れ値スコア
+           (標準化した残差の負の対数尤度 0.5 * log(2π) + 0.5 * e^2 / σ^2)
+    平滑化: 直近 smooth 点の外れ値スコアの平均
+    2段目: 平滑化したスコアの AR の残差から同じスコアを出し、もう一度平滑化したものを
+           変化スコアとする (一時的な外れ値では上がらず、状態が変わると上がる)
+残差の分散 σ^2 も忘却係数で指数平滑する。標準化するのでスコアは銘柄の値動きの大きさによらない。
+RLSの係数が落ち着くまで (各銘柄の最初の warmup 点) は変化スコアを出さない。
+
+状態は銘柄名と各銘柄の最後の日時と一緒に npz で保存でき、次回は追加された行だけ入れればよい。
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class RlsAr:
+    """
+    銘柄ごとの AR(p) (定数項つき) を忘却係数つきRLSで更新する。
+    状態はすべて先頭の次元が銘柄の配列。
+    """
+
+    FIELDS = ["theta", "P", "history", "var", "count"]
+
+    def __init__(self, n_series, lags=5, forgetting=0.99, delta=100.0):
+        k = lags + 1
+
+        self.lags = lags
+        self.forgetting = float(forgetting)
+        self.delta = float(delta)
+
+        self.theta = np.zeros((n_series, k))
+        self.P = np.tile(np.eye(k) * delta, (n_series, 1, 1))
+        self.history = np.zeros((n_series, lags))
+        self.var = np.ones(n_series)
+        self.count = np.zeros(n_series, dtype=np.int64)
+
+    def update(self, x, idx):
+        """
+        idx の銘柄に新しい値 x を入れて状態を更新し、標準化した残差のスコアを返す。
+        残差の分散がまだ出ていない銘柄 (最初の lags + 1 点) は nan。
+        """
+        lam = self.forgetting
+        x = np.asarray(x, dtype=np.float64)
+
+        phi = np.concatenate([np.ones((len(idx), 1)), self.history[idx]], axis=1)
+        theta = self.theta[idx]
+        P = self.P[idx]
+        var = self.var[idx]
+        count = self.count[idx]
+        ready = count >= self.lags
+
+        resid = x - np.einsum("bk,bk->b", theta, phi)
+
+        # 予測に使った分散 (更新前) で標準化した負の対数尤度
+        score = 0.5 * np.log(2 * np.pi) + 0.5 * resid * resid / var
+        score[count <= self.lags] = np.nan
+
+        # RLS: g = P phi / (λ + phi' P phi), θ += g e, P = (P - g (P phi)') / λ
+        P_phi = np.einsum("bkl,bl->bk", P, phi)
+        gain = P_phi / (lam + np.einsum("bk,bk->b", phi, P_phi))[:, None]
+
+        self.theta[idx] = theta + gain * resid[:, None]
+        self.P[idx] = (P - gain[:, :, None] * P_phi[:, None, :]) / lam
+
+        # 残差の分散は直近 lags 点がそろってから更新する。
+        # 最初の 1 / (1 - λ) 点は単純平均にして、初期値に引きずられないようにする
+        rate = np.maximum(1.0 - lam, 1.0 / np.maximum(count - self.lags + 1, 1))
+        new_var = var + rate * (resid * resid - var)
+        self.var[idx] = np.where(ready, np.maximum(new_var, 1e-300), var)
+
+        # 直近 lags 点を1つずらす (先頭が最新)
+        history = self.history[idx]
+        history[:, 1:] = history[:, :-1]
+        history[:, 0] = x
+        self.history[idx] = history
+        self.count[idx] += 1
+
+        return score
+
+
+class Smoother:
+    """銘柄ごとの直近 window 点の平均 (nan は入れない)"""
+
+    FIELDS = ["buffer", "pos", "filled"]
+
+    def __init__(self, n_series, window):
+        self.window = window
+        self.buffer = np.zeros((n_series, window))
+        self.pos = np.zeros(n_series, dtype=np.int64)
+        self.filled = np.zeros(n_series, dtype=np.int64)
+
+    def update(self, values, idx):
+        values = np.asarray(values, dtype=np.float64)
+        out = np.full(len(idx), np.nan)
+
+        ok = np.isfinite(values)
+        idx_ok = idx[ok]
+
+        self.buffer[idx_ok, self.pos[idx_ok]] = values[ok]
+        self.pos[idx_ok] = (self.pos[idx_ok] + 1) % self.window
+        self.filled[idx_ok] = np.minimum(self.filled[idx_ok] + 1, self.window)
+
+        full = ok & (self.filled[idx] == self.window)
+        out[full] = self.buffer[idx[full]].mean(axis=1)
+
+        return out
+
+
+class ArResidualMonitor:
+    """
+    全銘柄の ChangeFinder 風モニター。
+    update(returns, idx) で idx の銘柄に1点ずつ入れ、(外れ値スコア, 変化スコア) を返す。
+    """
+
+    def __init__(self, n_series, lags=5, forgetting=0.99, smooth=5, warmup=100, delta=100.0):
+        self.n_series = n_series
+        self.lags = lags
+        self.forgetting = float(forgetting)
+        self.smooth = smooth
+        self.warmup = warmup
+        self.delta = float(delta)
+
+        self.stage1 = RlsAr(n_series, lags=lags, forgetting=forgetting, delta=delta)
+        self.smooth1 = Smoother(n_series, smooth)
+        self.stage2 = RlsAr(n_series, lags=lags, forgetting=forgetting, delta=delta)
+        self.smooth2 = Smoother(n_series, smooth)
+
+    def parts(self):
+        return {
+            "stage1": self.stage1,
+            "smooth1": self.smooth1,
+            "stage2": self.stage2,
+            "smooth2": self.smooth2,
+        }
+
+    def update(self, returns, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+
+        outlier = self.stage1.update(returns, idx)
+        smoothed = self.smooth1.update(outlier, idx)
+
+        # 2段目は平滑化したスコアが出ている銘柄だけ進める
+        change = np.full(len(idx), np.nan)
+        ok = np.isfinite(smoothed)
+
+        if ok.any():
+            score2 = self.stage2.update(smoothed[ok], idx[ok])
+            change[ok] = self.smooth2.update(score2, idx[ok])
+
+        change[self.stage1.count[idx] <= self.warmup] = np.nan
+
+        return outlier, change
+
+    def reindex(self, rows):
+        """
+        rows[i] 番目の銘柄の状態を i 番目に置いた新しいモニターを返す。
+        rows[i] が -1 の銘柄は初期状態 (新しく増えた銘柄)。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        known = rows >= 0
+        new = ArResidualMonitor(
+            len(rows),
+            lags=self.lags,
+            forgetting=self.forgetting,
+            smooth=self.smooth,
+            warmup=self.warmup,
+            delta=self.delta,
+        )
+
+        for name, part in self.parts().items():
+            new_part = new.parts()[name]
+            for field in part.FIELDS:
+                getattr(new_part, field)[known] = getattr(part, field)[rows[known]]
+
+        return new
+
+    # -----------------------------------------------------
+    # 保存 / 復元
+    # -----------------------------------------------------
+
+    def to_arrays(self):
+        arrays = {
+            "lags": np.array(self.lags),
+            "forgetting": np.array(self.forgetting),
+            "smooth": np.array(self.smooth),
+            "warmup": np.array(self.warmup),
+            "delta": np.array(self.delta),
+        }
+
+        for name, part in self.parts().items():
+            for field in part.FIELDS:
+                arrays[f"{name}_{field}"] = getattr(part, field)
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, z):
+        monitor = cls(
+            len(z["stage1_count"]),
+            lags=int(z["lags"]),
+            forgetting=float(z["forgetting"]),
+            smooth=int(z["smooth"]),
+            warmup=int(z["warmup"]),
+            delta=float(z["delta"]),
+        )
+
+        for name, part in monitor.parts().items():
+            for field in part.FIELDS:
+                setattr(part, field, np.array(z[f"{name}_{field}"]))
+
+        return monitor
+
+
+def replay(monitor, returns_list):
+    """
+    i 番目の銘柄に returns_list[i] を順に入れ、銘柄ごとの (外れ値スコア, 変化スコア) の配列を返す。
+    銘柄どうしは独立なので、時刻ではなく「各銘柄の k 番目の点」ごとにまとめて更新する
+    (Pythonのループは最長の銘柄の長さだけ)。
+    """
+    lengths = np.array([len(r) for r in returns_list], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    values = np.concatenate([np.asarray(r, dtype=np.float64) for r in returns_list] + [np.empty(0)])
+
+    outlier = np.full(len(values), np.nan)
+    change = np.full(len(values), np.nan)
+
+    # 長い銘柄から並べておくと、k 番目の点がある銘柄は常に先頭の m 銘柄になる
+    order = np.argsort(-lengths, kind="stable")
+    active = np.searchsorted(-lengths[order], -np.arange(lengths.max(initial=0)), side="left")
+
+    for k, m in enumerate(active):
+        idx = order[:m]
+        flat = offsets[idx] + k
+        outlier[flat], change[flat] = monitor.update(values[flat], idx)
+
+    return (
+        [outlier[a:b] for a, b in zip(offsets[:-1], offsets[1:])],
+        [change[a:b] for a, b in zip(offsets[:-1], offsets[1:])],
+    )
+
+
+def save_state(path, monitor, symbols, last_datetimes):
+    """
+    モニターの状態を、銘柄名と各銘柄の最後に入れたreturnの日時と一緒に保存する
+    (一時ファイル経由で置き換え)。
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            symbols=np.asarray(symbols, dtype=str),
+            last_datetimes=np.asarray(last_datetimes, dtype="datetime64[ns]"),
+            **monitor.to_arrays(),
+        )
+
+    os.replace(tmp_path, path)
+
+
+def load_state(path):
+    """(monitor, symbols, last_datetimes) を返す。状態がなければ (None, None, None)"""
+    path = Path(path)
+
+    if not path.exists():
+        return None, None, None
+
+    with np.load(path, allow_pickle=False) as z:
+        return (
+            ArResidualMonitor.from_arrays(z),
+            [str(s) for s in z["symbols"]],
+            z["last_datetimes"],
+        )
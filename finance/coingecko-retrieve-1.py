@@ -1,13 +1,27 @@
 import argparse
+import asyncio
+import json
+import os
 import random
 import re
+import threading
 import time
 from datetime import datetime, timedelta
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import requests
 
+import http_cache
+import price_store
+
+# --concurrency で使う (直列取得だけなら不要)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 
 # ------------------------
 # デフォルト設定
@@ -24,8 +38,43 @@ DEFAULT_RANDOM_SEED = 42
 
 DEFAULT_OUTPUT_DIR = Path("./coingecko_by_coin")
 
-COINS_LIST_URL = "https://api.coingecko.com/api/v3/coins/list"
-MARKET_CHART_URL = "https://api.coingecko.com/api/v3/coins/{id}/market_chart"
+# 非同期取得 (--concurrency N)
+# N 本のリクエストを同時に出し、全体の速さは共有のトークンバケットで抑える
+# (毎秒 rate_per_min / 60 個のトークンがたまり、最大 burst 個まで貯められる)。
+# 429 が返ったら全タスクを Retry-After の間止めて速さを半分にし、
+# 成功が続くと少しずつ元の速さに戻す (下限は元の速さの 1 / RATE_MIN_DIVISOR)。
+DEFAULT_CONCURRENCY = 0
+DEFAULT_RATE_PER_MIN = 30.0
+DEFAULT_BURST = 5
+RATE_MIN_DIVISOR = 16
+RATE_RECOVER_STEP = 0.05
+
+DEFAULT_BASE_URL = "https://api.coingecko.com/api/v3"
+
+COINS_LIST_PATH = "/coins/list"
+MARKET_CHART_PATH = "/coins/{id}/market_chart"
+MARKET_CHART_RANGE_PATH = "/coins/{id}/market_chart/range"
+
+# 差分取得 (--incremental)
+# 既存CSVの最後の timestamp より後だけを market_chart/range で取得して追記する。
+# range は期間が1日未満だと5分足になるので、既存CSVの間隔 (中央値) に合わせて間引く。
+# CSVがない銘柄や、最後の timestamp が --days より古い銘柄は従来どおり --days 分を取得し、
+# 既存の行と timestamp で重複を除いてから書き直す。
+TAIL_READ_BYTES = 4096
+
+# HTTPキャッシュ (http_cache.py)
+# 200 のレスポンスを gzip で保存し、エンドポイントごとの TTL (coins/list は1日、
+# market_chart は1時間) の間は通信しない。TTL を過ぎたら ETag / Last-Modified で再検証する。
+# market_chart/range (to が毎回変わる) は保存しない。
+# --offline では通信せずキャッシュだけで実行する (前回の実行の再現用)。
+DEFAULT_CACHE_DIR = Path("./coingecko_http_cache")
+
+# 列指向ストア (--store DIR, price_store.py)
+# 銘柄ごとのCSVの代わりに timestamp (int64 エポックミリ秒) と price (float64) を
+# 列ごとの .npy で保存し、coin_id / symbol / name は coins.csv (メタデータの表) にまとめる。
+# 従来のCSVが必要なら python price_store.py --store DIR --export-csv OUT で書き出せる。
+
+RETRY_STATUSES = {500, 502, 503, 504}
 
 
 # ------------------------
@@ -44,6 +93,33 @@ def parse_args():
     parser.add_argument("--timeout-sec", type=int, default=DEFAULT_TIMEOUT_SEC, help="HTTPタイムアウト秒数")
     parser.add_argument("--random-seed", type=int, default=DEFAULT_RANDOM_SEED, help="乱数シード")
     parser.add_argument("--output-dir", type=str, default=str(DEFAULT_OUTPUT_DIR), help="出力先ディレクトリ")
+    parser.add_argument(
+        "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+        help="同時リクエスト数 (0なら従来どおり1件ずつ待機しながら取得。要 aiohttp)"
+    )
+    parser.add_argument(
+        "--rate-per-min", type=float, default=DEFAULT_RATE_PER_MIN,
+        help="非同期取得のリクエスト数の上限 (1分あたり、全タスク共有)"
+    )
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST, help="非同期取得で連続して出せるリクエスト数")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="既存CSVの最後の時刻より後だけを market_chart/range で取得して追記する"
+    )
+    parser.add_argument(
+        "--store", type=str, default=None,
+        help="銘柄ごとのCSVの代わりに列指向ストア (price_store.py) のこのディレクトリに保存する"
+    )
+    parser.add_argument("--cache-dir", type=str, default=str(DEFAULT_CACHE_DIR), help="HTTPキャッシュの保存先")
+    parser.add_argument("--no-cache", action="store_true", help="HTTPキャッシュを使わない")
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="通信せず、HTTPキャッシュに保存したレスポンスだけで実行する (実行の再現用)"
+    )
+    parser.add_argument(
+        "--base-url", type=str, default=DEFAULT_BASE_URL,
+        help="APIのベースURL (有料プランのURLや、テスト用のローカルサーバーを指定する)"
+    )
     parser.add_argument("--yes", action="store_true", help="確認なしで実行する")
     return parser.parse_args()
 
@@ -87,11 +163,10 @@ def format_file_size(num_bytes: int) -> str:
     return f"{num_bytes} B"
 
 
-def calc_days(df: pd.DataFrame) -> float:
-    if df.empty or "timestamp" not in df.columns:
+def span_days(first_ts, last_ts) -> float:
+    if first_ts is None or last_ts is None or pd.isna(first_ts) or pd.isna(last_ts):
         return 0.0
-    delta = df["timestamp"].max() - df["timestamp"].min()
-    return round(delta.total_seconds() / 86400, 2)
+    return round((last_ts - first_ts).total_seconds() / 86400, 2)
 
 
 def controlled_sleep(min_sleep_sec: float, jitter_sec: float):
@@ -111,7 +186,15 @@ def confirm_execution(args, output_dir: Path):
     print(f"最大リトライ回数  : {args.max_retries}")
     print(f"タイムアウト      : {args.timeout_sec} 秒")
     print(f"乱数シード        : {args.random_seed}")
+    print(f"差分取得          : {'あり' if args.incremental else 'なし'}")
+    print(f"HTTPキャッシュ    : {'なし' if args.no_cache else args.cache_dir}{' (オフライン)' if args.offline else ''}")
+    if args.concurrency > 0:
+        print(f"同時リクエスト数  : {args.concurrency}")
+        print(f"リクエスト上限    : {args.rate_per_min} 回/分 (burst {args.burst})")
+    print(f"APIベースURL      : {args.base_url}")
     print(f"保存先            : {output_dir.resolve()}")
+    if args.store:
+        print(f"価格ストア        : {Path(args.store).resolve()}")
     print("=========================\n")
 
     ans = input("実行しますか？ (y/N): ").strip().lower()
@@ -126,45 +209,81 @@ def confirm_execution(args, output_dir: Path):
 # ------------------------
 # リトライ付きリクエスト
 # ------------------------
-def request_with_retry(url, params, timeout_sec, max_retries, min_sleep_sec):
-    wait = min_sleep_sec
+class RetryPolicy:
+    """
+    リクエストの種類 (coins/list, market_chart など) ごとのリトライ方針。
+    待機は wait_sec * 2 から始めて毎回倍にする。429 で Retry-After があればそれ以上待つ。
+    retry_statuses と通信エラーもリトライし、それ以外のエラーはすぐ失敗にする。
+    """
+
+    def __init__(self, name, max_retries, timeout_sec, wait_sec, retry_statuses=RETRY_STATUSES):
+        self.name = name
+        self.max_retries = max_retries
+        self.timeout_sec = timeout_sec
+        self.wait_sec = wait_sec
+        self.retry_statuses = set(retry_statuses)
+
+    def sleep_sec(self, wait, retry_after=None):
+        if retry_after is not None:
+            try:
+                return max(float(retry_after), wait * 2)
+            except ValueError:
+                pass
+
+        return wait * 2
+
+
+def make_policies(args):
+    """リクエストの種類ごとの方針 (coins/list は1回だけで大きいので長めに待つ)"""
+    return {
+        "coins_list": RetryPolicy(
+            "coins_list",
+            max_retries=args.max_retries + 2,
+            timeout_sec=args.timeout_sec * 2,
+            wait_sec=args.min_sleep_sec,
+        ),
+        "market_chart": RetryPolicy(
+            "market_chart",
+            max_retries=args.max_retries,
+            timeout_sec=args.timeout_sec,
+            wait_sec=args.min_sleep_sec,
+        ),
+    }
+
+
+def request_with_retry(url, params, policy):
+    wait = policy.wait_sec
+    max_retries = policy.max_retries
 
     for attempt in range(1, max_retries + 1):
         try:
-            r = session.get(url, params=params, timeout=timeout_sec)
+            r = session.get(url, params=params, timeout=policy.timeout_sec)
 
             if r.status_code == 200:
                 return r
 
             if r.status_code == 429:
-                retry_after = r.headers.get("Retry-After")
-                if retry_after is not None:
-                    try:
-                        sleep_sec = max(float(retry_after), wait * 2)
-                    except ValueError:
-                        sleep_sec = wait * 2
-                else:
-                    sleep_sec = wait * 2
-
+                sleep_sec = policy.sleep_sec(wait, r.headers.get("Retry-After"))
                 log(f"429 Too Many Requests → {sleep_sec:.1f}s待機 ({attempt}/{max_retries})")
                 time.sleep(sleep_sec)
                 wait *= 2
                 continue
 
-            if r.status_code in {500, 502, 503, 504}:
-                sleep_sec = wait * 2
+            if r.status_code in policy.retry_statuses:
+                sleep_sec = policy.sleep_sec(wait)
                 log(f"{r.status_code} サーバーエラー → {sleep_sec:.1f}s待機 ({attempt}/{max_retries})")
                 time.sleep(sleep_sec)
                 wait *= 2
                 continue
 
-            r.raise_for_status()
+            # 404 などはリトライしても変わらないのですぐ失敗にする
+            raise RuntimeError(f"HTTP {r.status_code}: {r.url}")
 
         except requests.RequestException as e:
             if attempt == max_retries:
                 raise RuntimeError(f"request失敗: {e}") from e
 
-            sleep_sec = wait * 2
+            sleep_sec = policy.sleep_sec(wait)
             log(f"通信エラー → {sleep_sec:.1f}s待機 ({attempt}/{max_retries}) : {e}")
             time.sleep(sleep_sec)
             wait *= 2
@@ -175,16 +294,14 @@ def request_with_retry(url, params, timeout_sec, max_retries, min_sleep_sec):
 # ------------------------
 # データ取得
 # ------------------------
-def fetch_coins_list(timeout_sec, max_retries, min_sleep_sec):
+def fetch_coins_list(policy, base_url=DEFAULT_BASE_URL):
     log("coins/list 取得中...")
-    r = request_with_retry(
-        COINS_LIST_URL,
-        params=None,
-        timeout_sec=timeout_sec,
-        max_retries=max_retries,
-        min_sleep_sec=min_sleep_sec,
-    )
-    df = pd.DataFrame(r.json())
+    r = request_with_retry(base_url + COINS_LIST_PATH, params=None, policy=policy)
+    return coins_list_to_df(r.json())
+
+
+def coins_list_to_df(data):
+    df = pd.DataFrame(data)
 
     required_cols = ["id", "symbol", "name"]
     for col in required_cols:
@@ -198,22 +315,46 @@ def fetch_coins_list(timeout_sec, max_retries, min_sleep_sec):
     return df
 
 
-def fetch_market_chart(coin_id, vs_currency, days, timeout_sec, max_retries, min_sleep_sec):
-    url = MARKET_CHART_URL.format(id=coin_id)
-    params = {"vs_currency": vs_currency, "days": days}
+def plan_market_chart(row, args, output_dir: Path, store=None):
+    """
+    1銘柄の market_chart のリクエストを決める。戻り値は (url, params, last_ts)。
+    --incremental で既存CSV (store があればストア) の最後の timestamp が --days 以内なら、
+    その後だけを range で取る。
+    last_ts は既存の最後の timestamp (データがない / 差分取得でなければ None)。
+    """
+    coin_id = row["id"]
+    last_ts = None
+
+    if args.incremental and store is not None:
+        last_ts = store.last_timestamp(coin_id)
+    elif args.incremental:
+        last_ts = read_last_timestamp(coin_csv_path(coin_id, row["symbol"], output_dir))
+
+    now_sec = int(time.time())
+
+    if last_ts is not None and now_sec - last_ts.timestamp() < args.days * 86400:
+        url = args.base_url + MARKET_CHART_RANGE_PATH.format(id=coin_id)
+        params = {
+            "vs_currency": args.vs_currency,
+            "from": int(last_ts.timestamp()) + 1,
+            "to": now_sec,
+        }
+    else:
+        url = args.base_url + MARKET_CHART_PATH.format(id=coin_id)
+        params = {"vs_currency": args.vs_currency, "days": args.days}
+
+    return url, params, last_ts
 
-    r = request_with_retry(
-        url,
-        params=params,
-        timeout_sec=timeout_sec,
-        max_retries=max_retries,
-        min_sleep_sec=min_sleep_sec,
-    )
-    data = r.json()
 
+def fetch_market_chart(url, params, policy):
+    r = request_with_retry(url, params=params, policy=policy)
+    return market_chart_to_df(r.json())
+
+
+def market_chart_to_df(data):
     prices = data.get("prices", [])
     if not prices:
-        return pd.DataFrame()
+        return pd.DataFrame(columns=["timestamp", "price"])
 
     df = pd.DataFrame(prices, columns=["timestamp", "price"])
     df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms", errors="coerce")
@@ -223,22 +364,497 @@ def fetch_market_chart(coin_id, vs_currency, days, timeout_sec, max_retries, min
     return df
 
 
+# ------------------------
+# 非同期取得
+# ------------------------
+class TokenBucket:
+    """
+    全タスクで共有するトークンバケット。acquire() で1個取るまで待つ。
+    penalize() で全タスクを一定時間止めて速さを半分にし、
+    success() ごとに元の速さの RATE_RECOVER_STEP 倍ずつ戻す。
+    """
+
+    def __init__(self, rate_per_sec, burst, clock=time.monotonic):
+        self.max_rate = float(rate_per_sec)
+        self.min_rate = self.max_rate / RATE_MIN_DIVISOR
+        self.rate = self.max_rate
+        self.burst = max(1, int(burst))
+        self.clock = clock
+
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = self.clock()
+
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.refill(now)
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self, sleep_sec):
+        now = self.clock()
+        self.refill(now)
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, now + sleep_sec)
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def success(self):
+        self.refill(self.clock())
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVER_STEP)
+
+
+async def request_with_retry_async(http, bucket, url, params, policy, cache=None):
+    """
+    request_with_retry と同じ方針で、トークンバケットを通して1件取得し JSON を返す。
+    429 のときはこのタスクだけでなくバケット全体を止める。
+    cache があれば requests 側の CachingAdapter と同じ規則でキャッシュを使う
+    (TTL 内ならトークンも使わずに返す)。
+    """
+    wait = policy.wait_sec
+    max_retries = policy.max_retries
+    timeout = aiohttp.ClientTimeout(total=policy.timeout_sec)
+
+    url = http_cache.request_url(url, params)
+    meta, body, headers = None, None, {}
+
+    if cache is not None:
+        meta, body = cache.lookup(url)
+        if body is not None:
+            return json.loads(body)
+        headers = cache.conditional_headers(meta)
+
+    for attempt in range(1, max_retries + 1):
+        await bucket.acquire()
+
+        try:
+            async with http.get(url, headers=headers, timeout=timeout) as r:
+                if r.status == 200:
+                    body = await r.read()
+                    bucket.success()
+                    if cache is not None:
+                        cache.store(url, 200, r.headers, body)
+                    return json.loads(body)
+
+                if r.status == 304 and meta is not None:
+                    bucket.success()
+                    cache.touch(url, meta, r.headers)
+                    return json.loads(cache.load(url)[1])
+
+                if r.status == 429:
+                    sleep_sec = policy.sleep_sec(wait, r.headers.get("Retry-After"))
+                    bucket.penalize(sleep_sec)
+                    log(
+                        f"429 Too Many Requests → 全体で{sleep_sec:.1f}s待機, "
+                        f"{bucket.rate * 60:.1f}回/分に減速 ({attempt}/{max_retries})"
+                    )
+                    wait *= 2
+                    continue
+
+                if r.status in policy.retry_statuses:
+                    sleep_sec = policy.sleep_sec(wait)
+                    log(f"{r.status} サーバーエラー → {sleep_sec:.1f}s待機 ({attempt}/{max_retries})")
+                    await asyncio.sleep(sleep_sec)
+                    wait *= 2
+                    continue
+
+                raise RuntimeError(f"HTTP {r.status}: {r.url}")
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == max_retries:
+                raise RuntimeError(f"request失敗: {e}") from e
+
+            sleep_sec = policy.sleep_sec(wait)
+            log(f"通信エラー → {sleep_sec:.1f}s待機 ({attempt}/{max_retries}) : {e}")
+            await asyncio.sleep(sleep_sec)
+            wait *= 2
+
+    raise RuntimeError("retry失敗")
+
+
+async def fetch_all_async(args, policies, recorder, cache=None):
+    """
+    coins/list を取得して args.n_select 件を選び、args.concurrency 本のタスクで market_chart を取得する。
+    1件終わるごとに recorder.record を呼ぶ (CSV保存はイベントループを止めないようスレッドで行う)。
+    """
+    bucket = TokenBucket(args.rate_per_min / 60.0, args.burst)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    headers = dict(session.headers)
+
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as http:
+        log("coins/list 取得中...")
+        data = await request_with_retry_async(
+            http, bucket, args.base_url + COINS_LIST_PATH, None, policies["coins_list"], cache
+        )
+        sampled = select_coins(coins_list_to_df(data), args.n_select, args.random_seed)
+        recorder.total = len(sampled)
+
+        queue = asyncio.Queue()
+        for _, row in sampled.iterrows():
+            queue.put_nowait(row)
+
+        async def worker():
+            while True:
+                try:
+                    row = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+                url, params, last_ts = plan_market_chart(row, args, recorder.output_dir, recorder.store)
+
+                try:
+                    data = await request_with_retry_async(
+                        http, bucket, url, params, policies["market_chart"], cache
+                    )
+                    df = market_chart_to_df(data)
+                    error = None
+                except Exception as e:
+                    df, error = None, e
+
+                await asyncio.to_thread(recorder.record, row, df, error, last_ts=last_ts)
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+
+def select_coins(coins, n_select, random_seed):
+    actual_n = min(n_select, len(coins))
+    if actual_n < n_select:
+        log(f"指定件数 {n_select} は多すぎるため、{actual_n} 件に調整します")
+
+    return coins.sample(n=actual_n, random_state=random_seed).reset_index(drop=True)
+
+
 # ------------------------
 # 保存
 # ------------------------
-def save_coin_csv(df, coin_id, symbol, name, output_dir: Path):
-    file_name = f"{safe_name(coin_id)}_{safe_name(symbol)}.csv"
-    out_path = output_dir / file_name
+def coin_csv_path(coin_id, symbol, output_dir: Path) -> Path:
+    return output_dir / f"{safe_name(coin_id)}_{safe_name(symbol)}.csv"
+
+
+def read_tail_timestamps(path: Path) -> pd.Series:
+    """
+    CSVの末尾 TAIL_READ_BYTES だけを読み、そこに含まれる行の timestamp を返す。
+    ヘッダーと、途中から読んだときの先頭の欠けた行は除く。ファイルがない・読めなければ空。
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, 2)
+            size = f.tell()
+            start = max(0, size - TAIL_READ_BYTES)
+            f.seek(start)
+            lines = f.read().decode("utf-8-sig", errors="ignore").splitlines()
+    except OSError:
+        return pd.Series([], dtype="datetime64[ns]")
+
+    # 先頭から読んだときはヘッダー、途中から読んだときは欠けた行
+    lines = lines[1:]
+
+    ts = pd.to_datetime(
+        pd.Series([line.split(",")[0] for line in lines if line.strip()], dtype=object),
+        errors="coerce",
+    )
+    return ts.dropna().reset_index(drop=True)
+
+
+def read_last_timestamp(path: Path):
+    """CSVの最後の行の timestamp を返す (末尾だけ読む)。ファイルがない・読めなければ None"""
+    if not path.exists():
+        return None
+
+    ts = read_tail_timestamps(path)
+    return ts.iloc[-1] if len(ts) else None
 
+
+def read_first_timestamp(path: Path):
+    """CSVの最初のデータ行の timestamp を返す (先頭の2行だけ読む)。読めなければ None"""
+    try:
+        with open(path, encoding="utf-8-sig") as f:
+            next(f)
+            first_line = next(f)
+    except (OSError, StopIteration):
+        return None
+
+    ts = pd.to_datetime(first_line.split(",")[0], errors="coerce")
+    return None if pd.isna(ts) else ts
+
+
+def count_csv_rows(path: Path) -> int:
+    """ヘッダーを除いた行数 (パースせずに行を数えるだけ)"""
+    with open(path, encoding="utf-8-sig") as f:
+        return sum(1 for _ in f) - 1
+
+
+def thin_to_spacing(df, last_ts, spacing):
+    """
+    last_ts より後の行を、last_ts + k * spacing (k = 1, 2, ...) に最も近い時刻ごとに1行へ間引く。
+    range が細かい足を返したときに、既存CSVの間隔にそろえるため。
+    """
+    offset = (df["timestamp"] - last_ts) / spacing
+    slot = offset.round()
+    in_slot = slot >= 1
+
+    # 各スロットで予定時刻とのずれが最小の行 (同じなら早い方)
+    closest = (offset - slot).abs()[in_slot].groupby(slot[in_slot]).idxmin()
+    return df[df.index.isin(closest.to_numpy())]
+
+
+def coin_frame(df, coin_id, symbol, name):
     save_df = df.copy()
     save_df["coin_id"] = coin_id
     save_df["symbol"] = symbol
     save_df["name"] = name
+    return save_df
+
+
+def save_coin_csv(df, coin_id, symbol, name, output_dir: Path):
+    out_path = coin_csv_path(coin_id, symbol, output_dir)
+
+    save_df = coin_frame(df, coin_id, symbol, name)
 
     save_df.to_csv(out_path, index=False, encoding="utf-8-sig")
     return out_path, len(save_df)
 
 
+def merge_coin_csv(df, coin_id, symbol, name, output_dir: Path, last_ts):
+    """
+    既存CSVに新しい行を足す。戻り値は (out_path, 全体の行数, 追加した行数)。
+    last_ts がある (range で差分を取った) ときは last_ts より後の行だけを末尾に追記する。
+    それ以外は既存の行と合わせて timestamp で重複を除き (新しい値を優先)、書き直す。
+    """
+    out_path = coin_csv_path(coin_id, symbol, output_dir)
+
+    if not out_path.exists():
+        out_path, n_rows = save_coin_csv(df, coin_id, symbol, name, output_dir)
+        return out_path, n_rows, n_rows
+
+    if last_ts is not None:
+        # 既存の間隔は末尾の数十行から求める (CSV全体は読まない)
+        spacing = read_tail_timestamps(out_path).diff().median()
+        n_old = count_csv_rows(out_path)
+        new = df[df["timestamp"] > last_ts]
+
+        if pd.notna(spacing) and spacing > pd.Timedelta(0):
+            new = thin_to_spacing(new, last_ts, spacing)
+
+        with open(out_path, "a", encoding="utf-8", newline="") as f:
+            coin_frame(new, coin_id, symbol, name).to_csv(f, index=False, header=False)
+
+        return out_path, n_old + len(new), len(new)
+
+    old = pd.read_csv(out_path, encoding="utf-8-sig", parse_dates=["timestamp"])
+    merged = pd.concat([old, coin_frame(df, coin_id, symbol, name)], ignore_index=True)
+    merged = (
+        merged.drop_duplicates(subset=["timestamp"], keep="last")
+        .sort_values("timestamp")
+        .reset_index(drop=True)
+    )
+
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    merged.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    os.replace(tmp_path, out_path)
+
+    return out_path, len(merged), len(merged) - len(old)
+
+
+def save_coin_store(df, coin_id, symbol, name, store, last_ts, incremental):
+    """
+    列指向ストアに保存する。戻り値は (銘柄のディレクトリ, 全体の行数, 追加した行数)。
+    merge_coin_csv と同じく、last_ts があれば既存の間隔に間引いてから足す。
+    差分取得でなければ (save_coin_csv と同じく) 置き換える。
+    """
+    if last_ts is not None:
+        old_ts = store.read(coin_id)["timestamp_ms"]
+        spacing = pd.Timedelta(milliseconds=float(np.median(np.diff(old_ts)))) if len(old_ts) > 1 else pd.NaT
+        df = df[df["timestamp"] > last_ts]
+
+        if pd.notna(spacing) and spacing > pd.Timedelta(0):
+            df = thin_to_spacing(df, last_ts, spacing)
+
+    n_rows, n_new = store.write_frame(df, coin_id, symbol=symbol, name=name, merge=incremental)
+    return store.coin_dir(coin_id), n_rows, n_new
+
+
+# ------------------------
+# 結果の記録
+# ------------------------
+class FetchRecorder:
+    """
+    1銘柄の取得結果を保存して成功 / 空 / 失敗を数え、進捗を出す。
+    非同期取得ではワーカースレッドから呼ばれるのでロックで守る。
+    """
+
+    def __init__(self, output_dir: Path, start_time: float, incremental=False, store=None):
+        self.output_dir = output_dir
+        self.start_time = start_time
+        self.incremental = incremental
+        self.store = store
+        self.total = 0
+        self.done = 0
+        self.lock = threading.Lock()
+
+        self.saved_records = []
+        self.failed_records = []
+        self.empty_records = []
+
+    def record(self, row, df, error, step_time=None, last_ts=None):
+        coin_id = row["id"]
+        symbol = str(row["symbol"])
+        name = str(row["name"])
+
+        with self.lock:
+            if error is not None:
+                self.failed_records.append({
+                    "coin_id": coin_id,
+                    "symbol": symbol,
+                    "name": name,
+                    "error": str(error),
+                })
+                log(f"{symbol} ({coin_id}) 失敗: {error}")
+
+            elif df.empty and last_ts is None:
+                self.empty_records.append({
+                    "coin_id": coin_id,
+                    "symbol": symbol,
+                    "name": name,
+                })
+                log(f"{symbol} ({coin_id}) は価格データなし")
+
+            else:
+                try:
+                    self.save(df, coin_id, symbol, name, last_ts)
+                except Exception as e:
+                    self.failed_records.append({
+                        "coin_id": coin_id,
+                        "symbol": symbol,
+                        "name": name,
+                        "error": str(e),
+                    })
+                    log(f"{symbol} ({coin_id}) 失敗: {e}")
+
+            self.done += 1
+            self.log_progress(symbol, step_time)
+
+    def save(self, df, coin_id, symbol, name, last_ts=None):
+        if df.empty and last_ts is not None:
+            # 差分取得で新しい行がない (すでに最新)。書き込まず、既存の行数だけ記録する
+            out_path, n_rows, file_size_bytes = self.existing_output(coin_id, symbol)
+            n_new = 0
+        elif self.store is not None:
+            out_path, n_rows, n_new = save_coin_store(
+                df, coin_id, symbol, name, self.store, last_ts, self.incremental
+            )
+            file_size_bytes = self.store.nbytes(coin_id)
+        elif self.incremental:
+            out_path, n_rows, n_new = merge_coin_csv(
+                df, coin_id, symbol, name, self.output_dir, last_ts
+            )
+            file_size_bytes = out_path.stat().st_size
+        else:
+            out_path, n_rows = save_coin_csv(df, coin_id, symbol, name, self.output_dir)
+            n_new = n_rows
+            file_size_bytes = out_path.stat().st_size
+
+        file_size_text = format_file_size(file_size_bytes)
+        # 差分取得では取得した差分ではなく、保存済みの全体の期間を記録する
+        actual_days = self.saved_days(coin_id, symbol, out_path)
+
+        self.saved_records.append({
+            "coin_id": coin_id,
+            "symbol": symbol,
+            "name": name,
+            "rows": n_rows,
+            "new_rows": n_new,
+            "days": actual_days,
+            "file_size_bytes": file_size_bytes,
+            "file_size_human": file_size_text,
+            "file_path": str(out_path.resolve()),
+        })
+
+        log(
+            f"{symbol} {'新しい行なし' if df.empty else '保存完了'}: {out_path.name}\n"
+            f"    行数: {n_rows} (追加 {n_new}) / 保存日数: {actual_days}日 / サイズ: {file_size_text}"
+        )
+
+    def existing_output(self, coin_id, symbol):
+        """既存の保存先の (パス, 行数, サイズ)"""
+        if self.store is not None:
+            meta = self.store.meta(coin_id)
+            return self.store.coin_dir(coin_id), meta["rows"], self.store.nbytes(coin_id)
+
+        path = coin_csv_path(coin_id, symbol, self.output_dir)
+        return path, count_csv_rows(path), path.stat().st_size
+
+    def saved_days(self, coin_id, symbol, out_path):
+        """保存先の最初と最後の timestamp から求めた日数 (ストアはメタデータ、CSVは先頭と末尾だけ読む)"""
+        if self.store is not None:
+            meta = self.store.meta(coin_id)
+            first_ms, last_ms = meta["first_timestamp_ms"], meta["last_timestamp_ms"]
+            if first_ms is None or last_ms is None:
+                return 0.0
+            return span_days(pd.Timestamp(first_ms, unit="ms"), pd.Timestamp(last_ms, unit="ms"))
+
+        return span_days(read_first_timestamp(out_path), read_last_timestamp(out_path))
+
+    def log_progress(self, symbol, step_time=None):
+        elapsed = time.time() - self.start_time
+        done = self.done
+        total = max(self.total, done)
+        avg_time = elapsed / done
+        remain = avg_time * (total - done)
+        step_text = f"今回: {step_time:.2f}s / " if step_time is not None else ""
+
+        log(
+            f"[{done}/{total} | {done / total * 100:.1f}%] {symbol} 完了\n"
+            f"    {step_text}経過: {fmt_time(elapsed)} / "
+            f"残り目安: {fmt_time(remain)} / 平均: {avg_time:.2f}s/件\n"
+            f"    成功: {len(self.saved_records)} / 空: {len(self.empty_records)} / "
+            f"失敗: {len(self.failed_records)}"
+        )
+
+
+def run_serial(args, recorder, policies):
+    """従来どおり1件ずつ取得し、毎回 min_sleep_sec + jitter 待つ"""
+    coins = fetch_coins_list(policies["coins_list"], base_url=args.base_url)
+    sampled = select_coins(coins, args.n_select, args.random_seed)
+    recorder.total = len(sampled)
+
+    for i, row in sampled.iterrows():
+        loop_start = time.time()
+
+        url, params, last_ts = plan_market_chart(row, args, recorder.output_dir, recorder.store)
+
+        try:
+            df = fetch_market_chart(url, params, policies["market_chart"])
+            error = None
+        except Exception as e:
+            df, error = None, e
+
+        recorder.record(row, df, error, step_time=time.time() - loop_start, last_ts=last_ts)
+
+        if i + 1 < len(sampled) and not args.offline:
+            controlled_sleep(args.min_sleep_sec, args.jitter_sec)
+
+
+def run_concurrent(args, recorder, policies, cache=None):
+    """args.concurrency 本の同時リクエストで取得する (待機はトークンバケットに任せる)"""
+    asyncio.run(fetch_all_async(args, policies, recorder, cache))
+
+
 # ------------------------
 # メイン
 # ------------------------
@@ -257,7 +873,18 @@ def main():
         raise ValueError("--max-retries は 1 以上にしてください")
     if args.timeout_sec <= 0:
         raise ValueError("--timeout-sec は 1 以上にしてください")
-
+    if args.concurrency < 0:
+        raise ValueError("--concurrency は 0 以上にしてください")
+    if args.concurrency > 0 and aiohttp is None:
+        raise ImportError("--concurrency には aiohttp が必要です (pip install aiohttp)")
+    if args.rate_per_min <= 0:
+        raise ValueError("--rate-per-min は 0 より大きくしてください")
+    if args.burst <= 0:
+        raise ValueError("--burst は 1 以上にしてください")
+    if args.offline and args.no_cache:
+        raise ValueError("--offline と --no-cache は同時に指定できません")
+
+    args.base_url = args.base_url.rstrip("/")
     output_dir = Path(args.output_dir)
 
     if not args.yes:
@@ -275,117 +902,47 @@ def main():
     empty_csv = output_dir / f"empty_{args.n_select}_{ts}.csv"
 
     log("処理開始")
-    coins = fetch_coins_list(
-        timeout_sec=args.timeout_sec,
-        max_retries=args.max_retries,
-        min_sleep_sec=args.min_sleep_sec,
-    )
-
-    actual_n = min(args.n_select, len(coins))
-    if actual_n < args.n_select:
-        log(f"指定件数 {args.n_select} は多すぎるため、{actual_n} 件に調整します")
-
-    sampled = coins.sample(n=actual_n, random_state=args.random_seed).reset_index(drop=True)
-
-    success_count = 0
-    fail_count = 0
-    empty_count = 0
 
-    saved_records = []
-    failed_records = []
-    empty_records = []
+    policies = make_policies(args)
+    store = price_store.PriceStore(args.store) if args.store else None
+    recorder = FetchRecorder(output_dir, start_time, incremental=args.incremental, store=store)
 
-    for i, row in sampled.iterrows():
-        loop_start = time.time()
-
-        coin_id = row["id"]
-        symbol = str(row["symbol"])
-        name = str(row["name"])
+    cache = None
+    if not args.no_cache:
+        cache = http_cache.ResponseCache(args.cache_dir, offline=args.offline)
+        http_cache.install(session, cache)
+        log(f"HTTPキャッシュ: {Path(args.cache_dir).resolve()}{' (オフライン)' if args.offline else ''}")
 
-        try:
-            df = fetch_market_chart(
-                coin_id=coin_id,
-                vs_currency=args.vs_currency,
-                days=args.days,
-                timeout_sec=args.timeout_sec,
-                max_retries=args.max_retries,
-                min_sleep_sec=args.min_sleep_sec,
-            )
-
-            if df.empty:
-                empty_count += 1
-                empty_records.append({
-                    "coin_id": coin_id,
-                    "symbol": symbol,
-                    "name": name,
-                })
-                log(f"{symbol} ({coin_id}) は価格データなし")
-
-            else:
-                out_path, n_rows = save_coin_csv(df, coin_id, symbol, name, output_dir)
-                success_count += 1
-
-                file_size_bytes = out_path.stat().st_size
-                file_size_text = format_file_size(file_size_bytes)
-                actual_days = calc_days(df)
-
-                saved_records.append({
-                    "coin_id": coin_id,
-                    "symbol": symbol,
-                    "name": name,
-                    "rows": n_rows,
-                    "days": actual_days,
-                    "file_size_bytes": file_size_bytes,
-                    "file_size_human": file_size_text,
-                    "file_path": str(out_path.resolve()),
-                })
-
-                log(
-                    f"{symbol} 保存完了: {out_path.name}\n"
-                    f"    行数: {n_rows} / 取得日数: {actual_days}日 / サイズ: {file_size_text}"
-                )
-
-        except Exception as e:
-            fail_count += 1
-            failed_records.append({
-                "coin_id": coin_id,
-                "symbol": symbol,
-                "name": name,
-                "error": str(e),
-            })
-            log(f"{symbol} ({coin_id}) 失敗: {e}")
-
-        elapsed = time.time() - start_time
-        done = i + 1
-        rate = done / actual_n
-        avg_time = elapsed / done
-        remain = avg_time * (actual_n - done)
-        step_time = time.time() - loop_start
+    if args.concurrency > 0:
+        log(f"非同期取得: 同時{args.concurrency}件, 上限 {args.rate_per_min} 回/分 (burst {args.burst})")
+        run_concurrent(args, recorder, policies, cache)
+    else:
+        run_serial(args, recorder, policies)
 
+    if cache is not None:
         log(
-            f"[{done}/{actual_n} | {rate * 100:.1f}%] {symbol} 完了\n"
-            f"    今回: {step_time:.2f}s / 経過: {fmt_time(elapsed)} / "
-            f"残り目安: {fmt_time(remain)} / 平均: {avg_time:.2f}s/件\n"
-            f"    成功: {success_count} / 空: {empty_count} / 失敗: {fail_count}"
+            f"HTTPキャッシュ: 通信なし={cache.stats['fresh']}, 304={cache.stats['revalidated']}, "
+            f"保存={cache.stats['stored']}, オフラインでなし={cache.stats['miss']}"
         )
 
-        if done < actual_n:
-            controlled_sleep(args.min_sleep_sec, args.jitter_sec)
+    if store is not None:
+        metadata_path, n_coins = store.save_metadata()
+        log(f"価格ストアのメタデータ保存完了: {metadata_path.resolve()} ({n_coins} 銘柄)")
 
-    if saved_records:
-        summary_df = pd.DataFrame(saved_records)
+    if recorder.saved_records:
+        summary_df = pd.DataFrame(recorder.saved_records)
         summary_df.to_csv(summary_csv, index=False, encoding="utf-8-sig")
         log(f"一覧CSV保存完了: {summary_csv.resolve()}")
     else:
         log("保存できた銘柄はありませんでした")
 
-    if empty_records:
-        empty_df = pd.DataFrame(empty_records)
+    if recorder.empty_records:
+        empty_df = pd.DataFrame(recorder.empty_records)
         empty_df.to_csv(empty_csv, index=False, encoding="utf-8-sig")
         log(f"空データ一覧CSV保存完了: {empty_csv.resolve()}")
 
-    if failed_records:
-        failed_df = pd.DataFrame(failed_records)
+    if recorder.failed_records:
+        failed_df = pd.DataFrame(recorder.failed_records)
         failed_df.to_csv(failed_csv, index=False, encoding="utf-8-sig")
         log(f"失敗一覧CSV保存完了: {failed_csv.resolve()}")
 
@@ -395,4 +952,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
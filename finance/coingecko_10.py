@@ -1,3 +1,4 @@
+import math
 import random
 import time
 from datetime import datetime, timedelta
@@ -6,6 +7,9 @@ from pathlib import Path
 import requests
 import pandas as pd
 
+import http_cache
+import price_store
+
 
 # ------------------------
 # 設定
@@ -25,6 +29,26 @@ OUTPUT_DIR = Path(r"D:\musashino-university\finance\coingecko_by_coin")
 
 COINS_LIST_URL = "https://api.coingecko.com/api/v3/coins/list"
 MARKET_CHART_URL = "https://api.coingecko.com/api/v3/coins/{id}/market_chart"
+MARKETS_URL = "https://api.coingecko.com/api/v3/coins/markets"
+MARKETS_COLUMNS = ["id", "symbol", "name", "current_price", "market_cap", "total_volume", "last_updated"]
+
+# ★ スナップショットモード (全銘柄の現在値)
+# 銘柄ごとの market_chart の代わりに /coins/markets を1ページ250銘柄ずつ取り、
+# 1回分 (時価総額の上位 N_SELECT 銘柄の断面) を列指向ストア (price_store.py) に追記する。
+# N_SELECT = 1000 なら1回4リクエスト。これを SNAPSHOT_INTERVAL_SEC ごとに繰り返す
+# (間に合わなかった回は飛ばす)。読むときは price_store.PriceStore(STORE_DIR).snapshot_panel()
+SNAPSHOT_MODE = False
+SNAPSHOT_PER_PAGE = 250
+SNAPSHOT_INTERVAL_SEC = 60
+SNAPSHOT_COUNT = 0  # 0 なら止めるまで続ける
+STORE_DIR = OUTPUT_DIR.parent / "coingecko_store"
+
+# ★ HTTPキャッシュ (http_cache.py)
+# coins/list は1日、market_chart は1時間そのまま使い、過ぎたら ETag / Last-Modified で再検証する
+USE_HTTP_CACHE = True
+HTTP_CACHE_DIR = OUTPUT_DIR.parent / "coingecko_http_cache"
+# True にすると通信せずキャッシュだけで実行する (前回の実行の再現用)
+OFFLINE = False
 
 
 # ------------------------
@@ -120,6 +144,118 @@ def fetch_market_chart(coin_id):
     return df
 
 
+def fetch_markets_page(page):
+    params = {
+        "vs_currency": VS_CURRENCY,
+        "order": "market_cap_desc",
+        "per_page": SNAPSHOT_PER_PAGE,
+        "page": page,
+        "sparkline": "false",
+    }
+
+    r = request_with_retry(MARKETS_URL, params=params)
+    return pd.DataFrame(r.json())
+
+
+# ------------------------
+# スナップショット
+# ------------------------
+def take_snapshot(store):
+    """/coins/markets を N_SELECT 銘柄分ページ送りで取り、1回分としてストアに追記する"""
+    fetched_at_ms = int(time.time() * 1000)
+    n_pages = math.ceil(N_SELECT / SNAPSHOT_PER_PAGE)
+    pages = []
+
+    for page in range(1, n_pages + 1):
+        df = fetch_markets_page(page)
+        pages.append(df)
+
+        # 最後のページ (銘柄が足りない) ならそこで終わり
+        if len(df) < SNAPSHOT_PER_PAGE:
+            break
+
+        if page < n_pages and not OFFLINE:
+            controlled_sleep()
+
+    df = pd.concat(pages, ignore_index=True)
+
+    # 欠けている列 (キャッシュの古いレスポンス・一部だけのレスポンスなど) は NaN / NaT にする
+    df = df.reindex(columns=MARKETS_COLUMNS)
+    df = df.dropna(subset=["id"]).drop_duplicates(subset=["id"]).head(N_SELECT)
+
+    if df.empty:
+        return None, 0, len(pages)
+
+    last_updated = pd.to_datetime(df["last_updated"], utc=True, errors="coerce")
+
+    data = {
+        "coin_id": df["id"].astype(str).to_numpy(),
+        "last_updated_ms": price_store.to_epoch_ms(last_updated.dt.tz_localize(None).to_numpy()),
+        "price": pd.to_numeric(df["current_price"], errors="coerce").to_numpy(dtype=float),
+        "market_cap": pd.to_numeric(df["market_cap"], errors="coerce").to_numpy(dtype=float),
+        "total_volume": pd.to_numeric(df["total_volume"], errors="coerce").to_numpy(dtype=float),
+    }
+    out_dir = store.write_snapshot(fetched_at_ms, data)
+
+    names = df[["id", "symbol", "name"]].fillna("")
+    n_new = sum(
+        store.register(row.id, row.symbol, row.name)
+        for row in names.itertuples(index=False)
+    )
+    if n_new:
+        store.save_metadata()
+
+    return out_dir, len(df), len(pages)
+
+
+def collect_snapshots():
+    store = price_store.PriceStore(STORE_DIR)
+    n_pages = math.ceil(N_SELECT / SNAPSHOT_PER_PAGE)
+
+    log(
+        f"スナップショット開始: {N_SELECT} 銘柄 ({n_pages} ページ) を {SNAPSHOT_INTERVAL_SEC}s ごと, "
+        f"保存先: {STORE_DIR}"
+    )
+
+    if (n_pages - 1) * (MIN_SLEEP_SEC + JITTER_SEC) > SNAPSHOT_INTERVAL_SEC:
+        log("1回分のページ取得が SNAPSHOT_INTERVAL_SEC に収まらない可能性があります")
+
+    next_time = time.time()
+    done = 0
+
+    while SNAPSHOT_COUNT == 0 or done < SNAPSHOT_COUNT:
+        loop_start = time.time()
+
+        try:
+            out_dir, n_rows, n_requests = take_snapshot(store)
+            if out_dir is None:
+                log("スナップショット: 銘柄がありませんでした")
+            else:
+                log(
+                    f"スナップショット保存: {out_dir.name} ({n_rows} 銘柄, "
+                    f"{n_requests} リクエスト, {time.time() - loop_start:.1f}s)"
+                )
+        except Exception as e:
+            log(f"スナップショット失敗: {e}")
+
+        done += 1
+        if SNAPSHOT_COUNT and done >= SNAPSHOT_COUNT:
+            break
+
+        # 次の予定時刻まで待つ。過ぎてしまった回は飛ばす
+        next_time += SNAPSHOT_INTERVAL_SEC
+        now = time.time()
+
+        if next_time < now:
+            skipped = math.ceil((now - next_time) / SNAPSHOT_INTERVAL_SEC)
+            next_time += skipped * SNAPSHOT_INTERVAL_SEC
+            log(f"取得が間隔より長かったので {skipped} 回飛ばします")
+
+        time.sleep(max(0.0, next_time - time.time()))
+
+    log(f"スナップショット終了: {done} 回")
+
+
 # ------------------------
 # メイン
 # ------------------------
@@ -130,6 +266,15 @@ def main():
     # ディレクトリ作成
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+    if USE_HTTP_CACHE:
+        cache = http_cache.ResponseCache(HTTP_CACHE_DIR, offline=OFFLINE)
+        http_cache.install(session, cache)
+        log(f"HTTPキャッシュ: {HTTP_CACHE_DIR}{' (オフライン)' if OFFLINE else ''}")
+
+    if SNAPSHOT_MODE:
+        collect_snapshots()
+        return
+
     coins = fetch_coins_list()
 
     actual_n = min(N_SELECT, len(coins))
@@ -183,7 +328,8 @@ def main():
             f"    経過: {fmt_time(elapsed)} / 残り: {fmt_time(remain)}"
         )
 
-        controlled_sleep()
+        if not OFFLINE:
+            controlled_sleep()
 
     # ------------------------
     # 失敗一覧
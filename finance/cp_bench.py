@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+"""
+変化点検知のベンチマーク
+method × model × バックエンド (ruptures / numpy) の各セルについて
+- 処理時間 (全系列を1回処理する時間の、repeat 回の中央値と最小値)
+- メモリのピーク (tracemalloc。時間とは別に1回だけ測る)
+- 変化点の F1 (±margin 点以内なら一致)
+を測り、結果をCSVに追記する。実行ごとに bench_id・gitのコミット・ライブラリの版を付け、
+同じ条件の前回の実行より遅くなった / F1 が下がったセルを表示する。
+
+データ:
+    synthetic: 区分定常な収益率 (区間ごとに平均と分散を変える) を seed から生成する。
+               F1 は生成に使った真の変化点に対して求める
+    real     : coingecko_by_coin から凍結したサンプル (npz)。--freeze でCSVから1回だけ作り、
+               以後は同じ npz を使う (CSVが更新されても結果を比べられる)。
+               真の変化点はないので、F1 は同じ (method, model) の ruptures の結果に対して求める
+               (numpy バックエンドのみ)
+
+    python cp_bench.py --freeze --data-dir D:\\musashino-university\\finance\\coingecko_by_coin
+    python cp_bench.py --dataset synthetic --n 1000 --n-bkps 5 --series 5
+    python cp_bench.py --dataset real --backends ruptures numpy
+"""
+
+import os
+import csv
+import sys
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import cp_engine
+from henkaten import load_price_series, make_log_returns, make_signal, downsample_signal
+from henkaten.detect import METHODS, detect_change_points, ruptures
+
+
+MODELS = ["l1", "l2", "rbf", "normal", "linear"]
+BACKENDS = ["ruptures", "numpy"]
+
+DEFAULT_DATA_DIR = Path("./coingecko_by_coin")
+DEFAULT_OUTPUT_DIR = Path("./change_point_bench")
+
+SAMPLE_NAME = "cp_bench_sample.npz"
+RESULTS_NAME = "cp_bench_results.csv"
+
+# 前回より latency_median が REGRESSION_RATIO 倍を超えたら / F1 が F1_DROP 以上下がったら表示する
+REGRESSION_RATIO = 1.5
+F1_DROP = 0.05
+
+# 同じ条件の実行どうしを比べるための列
+CONDITION_COLUMNS = [
+    "dataset", "series", "n", "n_bkps_true", "max_points", "method", "model", "backend",
+]
+
+
+def log(msg):
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {msg}", flush=True)
+
+
+# =========================================================
+# 1. データ
+# =========================================================
+
+def make_synthetic(n, n_bkps, seed, mean_shift=0.5, vol_ratio=2.0, base_vol=0.01):
+    """
+    区分定常な収益率を作る。戻り値は (returns, 真の変化点)。
+    各区間の平均は ±mean_shift * base_vol、標準偏差は base_vol * vol_ratio^U(-1, 1)。
+    変化点どうしは n / (4 * (n_bkps + 1)) 点以上離す。
+    """
+    rng = np.random.default_rng(seed)
+    min_gap = max(n // (4 * (n_bkps + 1)), 2)
+
+    # 区間長 = min_gap + (残りを Dirichlet で分けたもの) で、間隔の下限を守る
+    free = n - min_gap * (n_bkps + 1)
+    lengths = min_gap + np.floor(rng.dirichlet(np.ones(n_bkps + 1)) * free).astype(int)
+    lengths[-1] += n - lengths.sum()
+    bkps = np.cumsum(lengths)[:-1]
+
+    returns = np.empty(n)
+    start = 0
+
+    for end in list(bkps) + [n]:
+        mean = rng.choice([-1.0, 1.0]) * mean_shift * base_vol
+        vol = base_vol * vol_ratio ** rng.uniform(-1.0, 1.0)
+        returns[start:end] = rng.normal(mean, vol, end - start)
+        start = end
+
+    return returns, [int(b) for b in bkps]
+
+
+def synthetic_dataset(n, n_bkps, series, seed):
+    """[(name, returns, 真の変化点)] のリスト"""
+    return [
+        (f"synthetic_{i}", *make_synthetic(n, n_bkps, seed + i))
+        for i in range(series)
+    ]
+
+
+def freeze_sample(data_dir, pattern, max_files, path, min_returns=10):
+    """coingecko_by_coin の先頭 max_files 個の returns を1つの npz に凍結する"""
+    names = []
+    chunks = []
+
+    for file_path in sorted(Path(data_dir).glob(pattern)):
+        if len(names) >= max_files:
+            break
+
+        try:
+            ret_df = make_log_returns(load_price_series(file_path))
+        except Exception as e:
+            log(f"[{file_path.stem}] スキップ: {e}")
+            continue
+
+        returns = ret_df["return"].to_numpy(dtype=np.float64)
+
+        if len(returns) < min_returns or np.std(returns) <= 0:
+            continue
+
+        names.append(file_path.stem)
+        chunks.append(returns)
+
+    if not names:
+        raise FileNotFoundError(f"凍結できるCSVがありません: {Path(data_dir) / pattern}")
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            names=np.array(names),
+            returns=np.concatenate(chunks),
+            offsets=np.cumsum([0] + [len(c) for c in chunks]),
+        )
+
+    os.replace(tmp_path, path)
+
+    return len(names)
+
+
+def real_dataset(path):
+    """凍結したサンプルを [(name, returns, None)] のリストで返す"""
+    with np.load(path, allow_pickle=False) as z:
+        names = z["names"]
+        returns = z["returns"]
+        offsets = z["offsets"]
+
+    return [
+        (str(name), returns[offsets[i]:offsets[i + 1]], None)
+        for i, name in enumerate(names)
+    ]
+
+
+def make_signals(dataset, max_points):
+    """
+    [(name, signal, 真の変化点)] にする。
+    max_points を超える系列は traversal-henkaten-12 と同じく等間隔に間引き、
+    真の変化点も間引いた後のインデックスに直す。
+    """
+    signals = []
+
+    for name, returns, truth in dataset:
+        signal, _, idx = downsample_signal(make_signal(returns), None, max_points)
+
+        if truth is not None:
+            truth = sorted(set(int(np.searchsorted(idx, b)) for b in truth))
+
+        signals.append((name, signal, truth))
+
+    return signals
+
+
+# =========================================================
+# 2. 計測
+# =========================================================
+
+def run_cell(signals, method, model, backend, opts):
+    """全系列で1回ずつ検知し、系列ごとの変化点のリストを返す"""
+    return [
+        detect_change_points(
+            signal,
+            method,
+            model,
+            pen_base=opts.pen_base,
+            n_bkps=opts.n_bkps if opts.dataset == "synthetic" else opts.real_n_bkps,
+            min_size=opts.min_size,
+            jump=opts.jump,
+            width=opts.width,
+            backend=backend,
+            dynp_max_points=opts.dynp_max_points,
+        )
+        for _, signal, _ in signals
+    ]
+
+
+def peak_memory_mb(func):
+    """func() の実行中に確保されたメモリのピーク (MB)"""
+    tracemalloc.start()
+
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1024 / 1024
+
+
+def mean_f1(expected_list, got_list, n_list, margin):
+    scores = [
+        cp_engine.breakpoint_f1(list(expected) + [n], list(got) + [n], margin=margin)
+        for expected, got, n in zip(expected_list, got_list, n_list)
+        if expected is not None
+    ]
+
+    return float(np.mean(scores)) if scores else np.nan
+
+
+def bench_cell(signals, method, model, backend, opts, reference=None):
+    """
+    1セルを計測して結果の行を返す。
+    reference は F1 の基準 (系列ごとの変化点のリスト)。None なら真の変化点を使う。
+    """
+    row = {"method": method, "model": model, "backend": backend}
+
+    times = []
+
+    try:
+        for _ in range(opts.repeat):
+            t0 = time.perf_counter()
+            cps_list = run_cell(signals, method, model, backend, opts)
+            times.append(time.perf_counter() - t0)
+
+        peak = np.nan
+        if not opts.no_memory:
+            peak = peak_memory_mb(lambda: run_cell(signals, method, model, backend, opts))
+
+    except Exception as e:
+        status = "skipped" if "dynpスキップ" in str(e) else "error"
+        row.update(status=status, error=str(e))
+        return row, None
+
+    n_list = [len(signal) for _, signal, _ in signals]
+    points = sum(n_list)
+
+    if reference is None:
+        expected_list = [truth for _, _, truth in signals]
+        f1_reference = "truth" if signals[0][2] is not None else ""
+    else:
+        expected_list = reference
+        f1_reference = "ruptures"
+
+    row.update(
+        status="ok",
+        error="",
+        latency_median_sec=float(np.median(times)),
+        latency_min_sec=float(np.min(times)),
+        points_per_sec=points / max(float(np.median(times)), 1e-12),
+        peak_mem_mb=peak,
+        n_found_mean=float(np.mean([len(c) for c in cps_list])),
+        f1=mean_f1(expected_list, cps_list, n_list, opts.margin),
+        f1_reference=f1_reference,
+    )
+
+    return row, cps_list
+
+
+def run_benchmark(signals, opts):
+    rows = []
+
+    for method in opts.methods:
+        for model in opts.models:
+            reference = None
+
+            for backend in opts.backends:
+                # numpy バックエンドで cp_engine 非対応の組み合わせは ruptures と同じなので測らない
+                if backend == "numpy" and not cp_engine.supports(method, model):
+                    continue
+
+                row, cps_list = bench_cell(
+                    signals,
+                    method,
+                    model,
+                    backend,
+                    opts,
+                    reference=reference if opts.dataset == "real" else None,
+                )
+                rows.append(row)
+
+                if backend == "ruptures":
+                    reference = cps_list
+
+                log(
+                    f"[{method}/{model}/{backend}] {row['status']} "
+                    + (
+                        f"median={row['latency_median_sec']:.3f}s "
+                        f"peak={row['peak_mem_mb']:.1f}MB f1={row['f1']:.3f}"
+                        if row["status"] == "ok" else row["error"]
+                    )
+                )
+
+    return rows
+
+
+# =========================================================
+# 3. 保存・前回との比較
+# =========================================================
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            timeout=10,
+        )
+        return out.stdout.strip()
+    except Exception:
+        return ""
+
+
+def package_version(name):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return ""
+
+
+def append_results(df, path):
+    """
+    結果のCSVに追記する (初回だけ列名を書く)。
+    既存の列名に合わせて並べ替えてから追記し、既存にない列があるときは
+    全体を列を足した形で書き直す (列の位置がずれた行を作らない)。
+    """
+    if not path.exists():
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+        return
+
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        columns = next(csv.reader(f), [])
+
+    new_columns = [c for c in df.columns if c not in columns]
+
+    if not new_columns:
+        with open(path, "a", encoding="utf-8-sig", newline="") as f:
+            df.reindex(columns=columns).to_csv(f, index=False, header=False)
+        return
+
+    log(f"結果のCSVに列を追加して書き直します: {new_columns}")
+
+    old = pd.read_csv(path, encoding="utf-8-sig", dtype=str, keep_default_na=False)
+    merged = pd.concat([old, df.astype(object)], ignore_index=True).reindex(columns=columns + new_columns)
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    merged.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    os.replace(tmp_path, path)
+
+
+def find_regressions(df, path):
+    """同じ条件の前回の実行と比べ、遅くなった / F1 が下がったセルの行を返す"""
+    if not path.exists():
+        return []
+
+    old = pd.read_csv(path, encoding="utf-8-sig", dtype={"bench_id": str, "commit": str})
+    old = old[(old["status"] == "ok") & (old["bench_id"] != df["bench_id"].iloc[0])]
+
+    if old.empty:
+        return []
+
+    # 条件ごとに最後の実行だけ残す
+    old = old.sort_values("bench_id").groupby(CONDITION_COLUMNS, dropna=False).tail(1)
+
+    merged = df[df["status"] == "ok"].merge(
+        old, on=CONDITION_COLUMNS, suffixes=("", "_prev")
+    )
+
+    messages = []
+
+    for _, r in merged.iterrows():
+        ratio = r["latency_median_sec"] / max(r["latency_median_sec_prev"], 1e-12)
+        f1_drop = r["f1_prev"] - r["f1"]
+        cell = f"[{r['method']}/{r['model']}/{r['backend']}]"
+
+        if ratio > REGRESSION_RATIO:
+            messages.append(
+                f"{cell} 遅くなった: {r['latency_median_sec_prev']:.3f}s → "
+                f"{r['latency_median_sec']:.3f}s (x{ratio:.2f}, 前回 {r['bench_id_prev']})"
+            )
+
+        if f1_drop > F1_DROP:
+            messages.append(
+                f"{cell} F1が下がった: {r['f1_prev']:.3f} → {r['f1']:.3f} "
+                f"(前回 {r['bench_id_prev']})"
+            )
+
+    return messages
+
+
+# =========================================================
+# 4. メイン
+# =========================================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="変化点検知のベンチマーク")
+    parser.add_argument("--dataset", choices=["synthetic", "real"], default="synthetic")
+    parser.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR)
+
+    parser.add_argument("--n", type=int, default=1000, help="合成データの系列長")
+    parser.add_argument("--n-bkps", type=int, default=5, help="合成データの変化点数")
+    parser.add_argument("--series", type=int, default=5, help="合成データの系列数")
+    parser.add_argument("--seed", type=int, default=42)
+
+    parser.add_argument(
+        "--freeze", action="store_true",
+        help="--data-dir のCSVから実データのサンプルを作り直す"
+    )
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_DIR)
+    parser.add_argument("--pattern", default="*.csv")
+    parser.add_argument("--max-files", type=int, default=20, help="凍結する銘柄数")
+    parser.add_argument(
+        "--real-n-bkps", type=int, default=30,
+        help="実データでの pelt 以外の変化点数 (traversal-henkaten-12 と同じ)"
+    )
+
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+
+    parser.add_argument("--max-points", type=int, default=2000)
+    parser.add_argument("--dynp-max-points", type=int, default=500)
+    parser.add_argument("--pen-base", type=float, default=0.2)
+    parser.add_argument("--min-size", type=int, default=2)
+    parser.add_argument("--jump", type=int, default=1)
+    parser.add_argument("--width", type=int, default=10)
+    parser.add_argument("--margin", type=int, default=5, help="F1 で一致とみなす距離")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="メモリのピークを測らない")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    warnings.filterwarnings("ignore")
+    opts = parse_args(argv)
+
+    opts.output_dir.mkdir(parents=True, exist_ok=True)
+    sample_path = opts.output_dir / SAMPLE_NAME
+    results_path = opts.output_dir / RESULTS_NAME
+
+    if opts.freeze:
+        count = freeze_sample(opts.data_dir, opts.pattern, opts.max_files, sample_path)
+        log(f"実データのサンプルを凍結: {sample_path} ({count}銘柄)")
+
+    if opts.dataset == "synthetic":
+        dataset = synthetic_dataset(opts.n, opts.n_bkps, opts.series, opts.seed)
+        n, n_bkps_true = opts.n, opts.n_bkps
+    else:
+        if not sample_path.exists():
+            raise FileNotFoundError(f"サンプルがありません (--freeze で作成): {sample_path}")
+        dataset = real_dataset(sample_path)
+        n, n_bkps_true = int(sum(len(r) for _, r, _ in dataset)), np.nan
+
+    signals = make_signals(dataset, opts.max_points)
+
+    # ruptures の import を最初のセルの時間に入れない
+    if "ruptures" in opts.backends:
+        ruptures()
+
+    bench_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    log(
+        f"bench_id={bench_id}, dataset={opts.dataset}, 系列数={len(signals)}, "
+        f"点数={sum(len(s) for _, s, _ in signals)}, repeat={opts.repeat}"
+    )
+
+    rows = run_benchmark(signals, opts)
+
+    df = pd.DataFrame(rows)
+    meta = {
+        "bench_id": bench_id,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "ruptures": package_version("ruptures"),
+        "dataset": opts.dataset,
+        "series": len(signals),
+        "n": n,
+        "n_bkps_true": n_bkps_true,
+        "max_points": opts.max_points,
+        "repeat": opts.repeat,
+    }
+
+    for i, (key, value) in enumerate(meta.items()):
+        df.insert(i, key, value)
+
+    regressions = find_regressions(df, results_path)
+    append_results(df, results_path)
+
+    log(f"結果を追記: {results_path} ({len(df)}行)")
+
+    for msg in regressions:
+        log(f"[REGRESSION] {msg}")
+
+    if not regressions:
+        log("前回からの悪化なし")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+過去の実行をまたいだ日別変化点数の集計
+出力フォルダにたまった change_point_pairs_*.csv を全部読み、
+(run_id, 日付, method, model, symbol) ごとの変化点数を1つの表にまとめ、
+実行ごとの日別変化点数を1枚に重ねたプロットを作る。
+
+- CSVは全部を pandas に読み込まず、必要な列だけをチャンクで読む
+  (pyarrow があればストリーミングのCSVリーダー、なければ pandas の chunksize)
+- method / model / symbol / 日付は辞書型 (カテゴリ) の列のまま groupby し、
+  チャンクごとの部分集計を最後に足し合わせる
+- 日付は cp_datetime の先頭10文字 (YYYY-MM-DD) をそのまま使う (日時の解析はしない)
+- 同じ実行 (ファイル名末尾の YYYYMMDD_HHMMSS) に統合ファイル (ALL_METHODS_ALL_MODELS) と
+  組み合わせ別ファイルがあるときは統合ファイルだけ読む (二重に数えない)
+- traversal-henkaten-10 / 11 の古い出力 (run_id 列がなく、日時の列が datetime) も読める
+
+    python cp_daily_history.py --output-dir D:\\musashino-university\\finance\\change_point_output
+    python cp_daily_history.py --max-runs 10 --methods pelt binseg
+"""
+
+import os
+import re
+import time
+import argparse
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.compute as pa_compute
+except ImportError:
+    pa = None
+
+
+DEFAULT_OUTPUT_DIR = Path(r"D:\musashino-university\finance\change_point_output")
+
+PAIRS_PATTERN = "change_point_pairs_*.csv"
+OUTPUT_PREFIX = "change_point_daily_history"
+
+# 統合ファイルの名前に入る文字列 (あれば同じ実行の組み合わせ別ファイルは読まない)
+ALL_FILE_MARK = "_ALL_METHODS_ALL_MODELS_"
+
+RUN_ID_PATTERN = re.compile(r"(\d{8}_\d{6})\.csv$")
+
+# 1チャンクの大きさ (pyarrow はバイト数、pandas は行数)
+CHUNK_BYTES = 64 << 20
+CHUNK_ROWS = 500_000
+
+KEY_COLUMNS = ["method", "model", "symbol"]
+
+# 日時の列名 (新しい出力 → 古い出力の順に探す)
+DATETIME_COLUMNS = ["cp_datetime", "datetime"]
+
+
+def log(msg):
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {msg}", flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="過去の change_point_pairs_*.csv をまとめて日別変化点数を集計・プロットする"
+    )
+    parser.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--pattern", default=PAIRS_PATTERN)
+    parser.add_argument(
+        "--max-runs", type=int, default=0,
+        help="プロットに重ねる実行の数 (新しい順。0なら全部)"
+    )
+    parser.add_argument("--methods", nargs="+", default=None, help="集計する method (省略時は全部)")
+    parser.add_argument("--models", nargs="+", default=None, help="集計する model (省略時は全部)")
+    return parser.parse_args(argv)
+
+
+# =========================================================
+# 1. 対象ファイル
+# =========================================================
+
+def file_run_id(path):
+    m = RUN_ID_PATTERN.search(path.name)
+    return m.group(1) if m else path.stem
+
+
+def select_pair_files(paths):
+    """
+    実行ごとに読むファイルを選ぶ。統合ファイルがある実行はそれだけを読む。
+    戻り値は [(run_id, path)] (run_id の古い順)。
+    """
+    by_run = {}
+
+    for path in paths:
+        by_run.setdefault(file_run_id(path), []).append(path)
+
+    selected = []
+
+    for run_id in sorted(by_run):
+        run_paths = sorted(by_run[run_id])
+        all_paths = [p for p in run_paths if ALL_FILE_MARK in p.name]
+        selected.extend((run_id, p) for p in (all_paths or run_paths))
+
+    return selected
+
+
+def read_header(path):
+    with open(path, encoding="utf-8-sig") as f:
+        return [c.strip().strip('"') for c in f.readline().rstrip("\r\n").split(",")]
+
+
+# =========================================================
+# 2. チャンク読込
+# =========================================================
+
+def iter_chunks_pyarrow(path, columns, datetime_col):
+    """
+    pyarrow のストリーミングリーダーで読み、日時は先頭10文字にしてから
+    key の列と一緒に辞書型にする。チャンクごとにカテゴリ列の DataFrame を返す。
+    """
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=CHUNK_BYTES),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=columns,
+            column_types={c: pa.string() for c in columns},
+            strings_can_be_null=True,
+        ),
+    )
+
+    for batch in reader:
+        data = {
+            c: batch.column(c).dictionary_encode()
+            for c in columns if c != datetime_col
+        }
+        dates = pa_compute.utf8_slice_codeunits(batch.column(datetime_col), 0, 10)
+        data["date"] = dates.dictionary_encode()
+
+        yield pa.table(data).to_pandas()
+
+
+def iter_chunks_pandas(path, columns, datetime_col):
+    for chunk in pd.read_csv(
+        path,
+        usecols=columns,
+        dtype={c: "category" for c in columns if c != datetime_col} | {datetime_col: str},
+        encoding="utf-8-sig",
+        chunksize=CHUNK_ROWS,
+    ):
+        chunk["date"] = chunk.pop(datetime_col).str[:10].astype("category")
+        yield chunk
+
+
+def count_file(path, run_id, methods=None, models=None):
+    """
+    1ファイルの (run_id, date, method, model, symbol) ごとの変化点数を返す。
+    run_id 列があればその値、なければファイル名の実行IDを使う。
+    """
+    header = read_header(path)
+    datetime_col = next((c for c in DATETIME_COLUMNS if c in header), None)
+
+    if datetime_col is None or not all(c in header for c in KEY_COLUMNS):
+        raise ValueError(f"必要な列がありません: {header}")
+
+    columns = KEY_COLUMNS + [datetime_col] + (["run_id"] if "run_id" in header else [])
+    iter_chunks = iter_chunks_pyarrow if pa is not None else iter_chunks_pandas
+    group_cols = ["run_id", "date"] + KEY_COLUMNS
+
+    parts = []
+
+    for chunk in iter_chunks(path, columns, datetime_col):
+        if "run_id" not in chunk:
+            chunk["run_id"] = pd.Categorical([run_id] * len(chunk))
+
+        # 日時が空の行 (変化点の日時が取れなかった行) は数えない
+        mask = chunk["date"].notna().to_numpy()
+
+        if methods:
+            mask = mask & chunk["method"].isin(methods).to_numpy()
+        if models:
+            mask = mask & chunk["model"].isin(models).to_numpy()
+
+        counts = chunk[mask].groupby(group_cols, observed=True).size()
+        parts.append(counts.rename("change_point_count").reset_index())
+
+    return parts
+
+
+def aggregate_history(selected, methods=None, models=None):
+    """
+    選んだファイルを順に読み、部分集計を足し合わせた長い表を返す。
+    列は run_id, date, method, model, symbol, change_point_count。
+    """
+    parts = []
+    start = time.perf_counter()
+
+    for file_i, (run_id, path) in enumerate(selected, start=1):
+        try:
+            parts.extend(count_file(path, run_id, methods=methods, models=models))
+        except Exception as e:
+            log(f"[{file_i}/{len(selected)}] {path.name}: 読込失敗: {e}")
+            continue
+
+        if file_i % 20 == 0 or file_i == len(selected):
+            log(
+                f"{file_i}/{len(selected)} ファイル集計完了, "
+                f"{file_i / max(time.perf_counter() - start, 1e-9):.1f} files/s"
+            )
+
+    group_cols = ["run_id", "date"] + KEY_COLUMNS
+
+    if not parts:
+        return pd.DataFrame(columns=group_cols + ["change_point_count"])
+
+    # チャンクごとにカテゴリの中身が違い、連結すると文字列の列に戻るので、カテゴリにし直してから足す
+    history = pd.concat(parts, ignore_index=True)
+    history[group_cols] = history[group_cols].astype("category")
+
+    return (
+        history.groupby(group_cols, observed=True)["change_point_count"].sum()
+        .reset_index()
+        .sort_values(group_cols, ignore_index=True)
+    )
+
+
+# =========================================================
+# 3. 保存・プロット
+# =========================================================
+
+def save_csv_safe(df, path):
+    tmp_path = path.with_name(path.name + ".tmp")
+    df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    os.replace(tmp_path, path)
+
+
+def daily_by_run(history, by=()):
+    """(date × run_id) の変化点数の表 (by を指定するとその列ごとに分ける)"""
+    cols = list(by) + ["date", "run_id"]
+    table = history.groupby(cols, observed=True)["change_point_count"].sum().reset_index()
+    table["date"] = pd.to_datetime(table["date"].astype(str), errors="coerce")
+    return table.dropna(subset=["date"])
+
+
+def plot_runs(ax, table, runs, title):
+    for run_id in runs:
+        run = table[table["run_id"] == run_id].sort_values("date")
+        if not run.empty:
+            ax.plot(run["date"], run["change_point_count"], marker=".", label=str(run_id))
+
+    ax.set_title(title)
+    ax.set_ylabel("change point count")
+
+
+def plot_history(history, runs, out_png):
+    """全 method の合計と、method ごとの日別変化点数を実行ごとの線で重ねる"""
+    if history.empty:
+        return False
+
+    methods = sorted(history["method"].astype(str).unique())
+    total = daily_by_run(history)
+    per_method = daily_by_run(history, by=["method"])
+
+    fig, axes = plt.subplots(
+        len(methods) + 1, 1, figsize=(12, 3 * (len(methods) + 1)), sharex=True, squeeze=False
+    )
+    axes = axes[:, 0]
+
+    plot_runs(axes[0], total, runs, "Daily Change Points - ALL METHODS / ALL MODELS")
+
+    for ax, method in zip(axes[1:], methods):
+        plot_runs(ax, per_method[per_method["method"] == method], runs, f"method = {method}")
+
+    axes[0].legend(title="run_id", fontsize=8, ncol=max(1, min(len(runs), 4)))
+    axes[-1].set_xlabel("date")
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    fig.savefig(out_png, dpi=150)
+    plt.close(fig)
+
+    return True
+
+
+def main(argv=None):
+    warnings.filterwarnings("ignore")
+    opts = parse_args(argv)
+
+    paths = sorted(p for p in opts.output_dir.glob(opts.pattern) if p.is_file())
+
+    if not paths:
+        raise FileNotFoundError(f"対象ファイルが見つかりません: {opts.output_dir / opts.pattern}")
+
+    selected = select_pair_files(paths)
+    log(
+        f"対象ファイル数: {len(selected)} / {len(paths)} "
+        f"(実行数: {len({run_id for run_id, _ in selected})}), "
+        f"読込: {'pyarrow' if pa is not None else 'pandas'}"
+    )
+
+    history = aggregate_history(selected, methods=opts.methods, models=opts.models)
+
+    history_path = opts.output_dir / f"{OUTPUT_PREFIX}.csv"
+    save_csv_safe(history, history_path)
+    log(f"日別変化点数 (実行 × 日付 × method × model × symbol) 保存: {history_path.name}")
+
+    runs = sorted(history["run_id"].astype(str).unique())
+    if opts.max_runs > 0:
+        runs = runs[-opts.max_runs:]
+
+    runs_table = daily_by_run(history)
+    runs_wide = (
+        runs_table.pivot(index="date", columns="run_id", values="change_point_count")
+        .reindex(columns=runs)
+        .fillna(0)
+        .astype(np.int64)
+        .reset_index()
+    )
+    runs_path = opts.output_dir / f"{OUTPUT_PREFIX}_runs.csv"
+    save_csv_safe(runs_wide, runs_path)
+    log(f"日別変化点数 (日付 × 実行) 保存: {runs_path.name}")
+
+    plot_dir = opts.output_dir / "daily_change_point_plots"
+    plot_dir.mkdir(parents=True, exist_ok=True)
+    png_path = plot_dir / f"{OUTPUT_PREFIX}_runs.png"
+
+    if plot_history(history, runs, png_path):
+        log(f"実行別の日別変化点数プロット保存: {png_path.name}")
+    else:
+        log("変化点がないのでプロットは作成されませんでした")
+
+    log(f"行数: {len(history)}, 変化点数: {int(history['change_point_count'].sum())}")
+
+
+if __name__ == "__main__":
+    main()
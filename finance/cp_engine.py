@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+変化点検知エンジン (NumPy版) の互換モジュール
+本体は henkaten/engine.py に移した。traversal-henkaten-12 / cp_stream / cp_bench などの
+import cp_engine はそのまま使える (中身は henkaten.engine と同じオブジェクト)。
+
+単体で実行すると coingecko_by_coin のCSVで ruptures と結果・速度を比較する:
+    python cp_engine.py --data-dir D:\\musashino-university\\finance\\coingecko_by_coin
+"""
+
+from henkaten.engine import *  # noqa: F401,F403
+from henkaten.engine import _feasible_last_bkps, _nearest_admissible  # noqa: F401
+from henkaten.engine import main
+
+
+if __name__ == "__main__":
+    main()
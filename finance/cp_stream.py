@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+逐次 (インクリメンタル) 変化点検知
+PELT の状態 (累積和・最適コスト・直前の変化点・枝刈り後の候補集合) を
+銘柄ごとに npz で保存し、次回は追加された行だけを処理する。
+
+確定した変化点:
+PELTの枝刈りで残った候補 (と、これから候補に入る直近 min_size 点) の
+どれから最適分割をたどっても必ず通る変化点は、今後データが増えても変わらない。
+これを「確定」とみなし、まだ出力していないものだけを返す。
+
+信号のスケール (returnsの標準偏差) とペナルティは初回に決めて固定する。
+変化点の計算は cp_engine の PELT と同じ (l1 / l2 / normal)。
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+import cp_engine
+
+
+class OnlinePelt:
+    def __init__(self, model, pen, scale, min_size=2):
+        self.model = model
+        self.pen = float(pen)
+        self.scale = float(scale)
+
+        self.cost = cp_engine.PrefixSumCost(model, np.zeros((0, 1)))
+        self.min_size = max(min_size, self.cost.min_size)
+
+        self.total = np.zeros(1)
+        self.last = np.zeros(1, dtype=np.int64)
+        self.admissible = np.empty(0, dtype=np.int64)
+
+        # 出力済みの確定変化点のうち最大のもの (0 = まだなし)
+        self.emitted_upto = 0
+
+    @property
+    def n_samples(self):
+        return self.cost.n_samples
+
+    def update(self, returns):
+        """
+        新しいreturnsを追加し、新たに確定した変化点 (インデックス) を返す。
+        インデックスは状態を作ったときの最初のreturnを0とする。
+        """
+        x = np.asarray(returns, dtype=np.float64).reshape(-1, 1) / self.scale
+
+        if len(x) == 0:
+            return []
+
+        n_old = self.n_samples
+        self.cost.append(x)
+        n_new = self.n_samples
+
+        self.total = np.concatenate([self.total, np.full(n_new - n_old, np.inf)])
+        self.last = np.concatenate([self.last, np.zeros(n_new - n_old, dtype=np.int64)])
+
+        for bkp in range(max(n_old + 1, self.min_size), n_new + 1):
+            self.admissible = cp_engine.pelt_step(
+                self.cost,
+                self.total,
+                self.last,
+                self.admissible,
+                bkp,
+                self.pen,
+                self.min_size,
+                1
+            )
+
+        confirmed = self.confirmed_change_points()
+        new_cps = [cp for cp in confirmed if cp > self.emitted_upto]
+
+        if new_cps:
+            self.emitted_upto = new_cps[-1]
+
+        return new_cps
+
+    def future_candidates(self):
+        """今後の最適分割で最後の変化点になり得る点"""
+        n = self.n_samples
+        recent = np.arange(max(0, n - self.min_size + 1), n + 1)
+        cands = np.union1d(self.admissible, recent)
+        return cands[np.isfinite(self.total[cands])]
+
+    def confirmed_change_points(self):
+        common = None
+
+        for t in self.future_candidates():
+            chain = set(cp_engine.backtrack(self.last, int(t))) - {int(t)}
+            common = chain if common is None else common & chain
+
+            if not common:
+                return []
+
+        return sorted(common) if common else []
+
+    def strength(self, cp, window=5):
+        """変化点前後 window 点の平均の差 (estimate_strength と同じ定義)"""
+        n = self.n_samples
+        left = max(0, cp - window)
+        right = min(n, cp + window)
+
+        if cp <= left or right <= cp:
+            return np.nan
+
+        s1 = self.cost.s1[:, 0]
+        left_mean = (s1[cp] - s1[left]) / (cp - left)
+        right_mean = (s1[right] - s1[cp]) / (right - cp)
+
+        return abs(float(right_mean - left_mean))
+
+    # -----------------------------------------------------
+    # 保存 / 復元
+    # -----------------------------------------------------
+
+    def to_arrays(self):
+        return {
+            "model": np.array(self.model),
+            "pen": np.array(self.pen),
+            "scale": np.array(self.scale),
+            "min_size": np.array(self.min_size),
+            "s1": self.cost.s1,
+            "s2": self.cost.s2,
+            "total": self.total,
+            "last": self.last,
+            "admissible": self.admissible,
+            "emitted_upto": np.array(self.emitted_upto),
+        }
+
+    @classmethod
+    def from_arrays(cls, z):
+        det = cls(
+            str(z["model"]),
+            pen=float(z["pen"]),
+            scale=float(z["scale"]),
+            min_size=int(z["min_size"]),
+        )
+        det.cost = cp_engine.PrefixSumCost.from_prefix(det.model, z["s1"], z["s2"])
+        det.total = np.array(z["total"], dtype=np.float64)
+        det.last = np.array(z["last"], dtype=np.int64)
+        det.admissible = np.array(z["admissible"], dtype=np.int64)
+        det.emitted_upto = int(z["emitted_upto"])
+        return det
+
+
+def save_state(path, detector, datetimes):
+    """
+    検知器の状態と、各returnの日時を保存する (一時ファイル経由で置き換え)。
+    datetimes[i] は i 番目のreturnの日時。
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+
+    with open(tmp_path, "wb") as f:
+        np.savez(f, datetimes=np.asarray(datetimes), **detector.to_arrays())
+
+    os.replace(tmp_path, path)
+
+
+def load_state(path):
+    """(detector, datetimes) を返す。状態がなければ (None, None)"""
+    path = Path(path)
+
+    if not path.exists():
+        return None, None
+
+    with np.load(path, allow_pickle=False) as z:
+        return OnlinePelt.from_arrays(z), z["datetimes"]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+変化点検知の共通ライブラリ
+traversal-henkaten-2 〜 12 がそれぞれ持っていた処理を1つにまとめたもの。
+
+    engine   : 累積和による変化点検知エンジン (l1/l2/normal × pelt/binseg/bottomup/dynp)
+    io       : CSV読込 (load_price_series / load_coin_csv)
+    returns  : 対数収益率とAR (make_log_returns / apply_ar_returns_in_sample /
+               fit_ar_rmse_batch)
+    detect   : 信号の作成・間引き・変化点検知・間引き・強度
+               (make_signal / downsample_signal / detect_change_points /
+                detect_change_points_multiscale /
+                filter_change_points_by_distance / change_point_strength(s))
+    cli      : method / model / ペナルティ のグリッドで全銘柄を処理するCLI
+
+設定はモジュール定数ではなく引数で渡す (既定値は traversal-henkaten-12 と同じ)。
+ruptures は使うときに初めて import する (numpyバックエンドだけなら読み込まない)。
+
+CLI:
+    python -m henkaten --data-dir D:\\musashino-university\\finance\\coingecko_by_coin \\
+        --methods pelt binseg --models l2 normal --pen-bases 0.1 0.2 0.5
+"""
+
+from .io import load_price_series, load_coin_csv, read_csv_auto
+from .returns import (
+    make_log_returns,
+    apply_ar_returns_in_sample,
+    fit_ar_rmse,
+    fit_ar_rmse_batch,
+)
+from .detect import (
+    make_signal,
+    downsample_signal,
+    detect_change_points,
+    detect_change_points_multiscale,
+    filter_change_points_by_distance,
+    change_point_strength,
+    change_point_strengths,
+)
+
+__all__ = [
+    "load_price_series",
+    "load_coin_csv",
+    "read_csv_auto",
+    "make_log_returns",
+    "apply_ar_returns_in_sample",
+    "fit_ar_rmse",
+    "fit_ar_rmse_batch",
+    "make_signal",
+    "downsample_signal",
+    "detect_change_points",
+    "detect_change_points_multiscale",
+    "filter_change_points_by_distance",
+    "change_point_strength",
+    "change_point_strengths",
+]
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from henkaten.cli import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+method / model / ペナルティ (pen_base) / 変化点数 (n_bkps) のグリッドで
+全銘柄の変化点検知を行うCLI。
+
+1ファイルごとに 読込 → 対数収益率 → AR → 信号作成 → 間引き を1回だけ行い、
+そのファイルでグリッドの全セルを実行する。
+--workers N のときはファイル単位でプロセス並列にし、
+設定はワーカー起動時に1回だけ渡す (import もワーカーごとに1回)。
+
+pelt は --pen-bases の各値、それ以外の method は --n-bkps の各値でセルを作る。
+--multiscale のときは間引かず、粗い信号で検知してから元の解像度で位置を見直す。
+
+    python -m henkaten --data-dir coingecko_by_coin --methods pelt binseg \\
+        --models l2 normal --pen-bases 0.1 0.2 0.5 --n-bkps 10 30 --workers 4
+"""
+
+import os
+import time
+import argparse
+import warnings
+from pathlib import Path
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .io import load_price_series
+from .returns import make_log_returns, fit_ar_rmse
+from .detect import (
+    METHODS,
+    make_signal,
+    downsample_signal,
+    detect_change_points,
+    detect_change_points_multiscale,
+    filter_change_points_by_distance,
+    change_point_strengths,
+)
+
+
+DEFAULT_DATA_DIR = Path(r"D:\musashino-university\finance\coingecko_by_coin")
+DEFAULT_OUTPUT_DIR = Path(r"D:\musashino-university\finance\change_point_output")
+
+MODELS = ["l1", "l2", "rbf", "normal", "linear"]
+
+OUTPUT_PREFIX = "change_point_grid"
+
+# ワーカープロセス側の設定 (init_worker で1回だけ受け取る)
+_OPTS = None
+
+
+def log(msg):
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {msg}", flush=True)
+
+
+def parse_scale(value):
+    if value in ("std", "zscore"):
+        return value
+
+    return float(value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="method / model / ペナルティのグリッドで全銘柄の変化点検知を行う"
+    )
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_DIR)
+    parser.add_argument("--pattern", default="*.csv")
+    parser.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--max-files", type=int, default=0, help="0なら全ファイル")
+
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument(
+        "--pen-bases", nargs="+", type=float, default=[0.2],
+        help="pelt のペナルティ (pen_base * log(n))"
+    )
+    parser.add_argument(
+        "--no-pen-log", action="store_true",
+        help="pelt のペナルティに log(n) を掛けない (traversal-henkaten-9 〜 11 と同じ)"
+    )
+    parser.add_argument(
+        "--n-bkps", nargs="+", type=int, default=[30],
+        help="pelt 以外の変化点数"
+    )
+
+    parser.add_argument("--min-size", type=int, default=2)
+    parser.add_argument("--jump", type=int, default=1)
+    parser.add_argument("--width", type=int, default=10, help="window の幅")
+    parser.add_argument("--min-returns", type=int, default=10)
+    parser.add_argument("--max-points", type=int, default=2000)
+    parser.add_argument("--dynp-max-points", type=int, default=500)
+    parser.add_argument(
+        "--multiscale", action="store_true",
+        help="--max-points を超える系列を間引かず、ブロック平均で検知して元の解像度で見直す"
+    )
+    parser.add_argument(
+        "--min-distance", type=int, default=0,
+        help="検知後に近すぎる変化点を間引く最小距離 (0なら間引かない)"
+    )
+    parser.add_argument(
+        "--scale", type=parse_scale, default="std",
+        help='信号のスケール: "std" / "zscore" / 倍率 (例: 100)'
+    )
+    parser.add_argument("--ar-lags", type=int, default=5)
+    parser.add_argument("--backend", choices=["ruptures", "numpy"], default="ruptures")
+    parser.add_argument("--workers", type=int, default=1)
+
+    return parser.parse_args(argv)
+
+
+def grid_cells(opts):
+    """(method, model, pen_base, n_bkps) のリスト"""
+    cells = []
+
+    for method in opts.methods:
+        for model in opts.models:
+            if method == "pelt":
+                cells.extend((method, model, pen, np.nan) for pen in opts.pen_bases)
+            else:
+                cells.extend((method, model, np.nan, k) for k in opts.n_bkps)
+
+    return cells
+
+
+def process_file(file_path, opts):
+    """
+    1ファイルでグリッドの全セルを実行し、(summary_rows, pairs_df) を返す。
+    pairs は変化点ごとの dict ではなく、セルごとに列の配列で作って最後に連結する。
+    """
+    symbol = file_path.stem
+    summary_rows = []
+    pair_frames = []
+
+    base = {"symbol": symbol, "file_name": file_path.name}
+
+    try:
+        ret_df = make_log_returns(load_price_series(file_path))
+        returns = ret_df["return"].to_numpy(dtype=np.float64)
+        rmse = fit_ar_rmse(returns, lags=opts.ar_lags)
+
+        signal = make_signal(returns, scale=opts.scale)
+
+        if opts.multiscale:
+            ds_datetimes, ds_idx = ret_df["datetime"], np.arange(len(signal))
+        else:
+            signal, ds_datetimes, ds_idx = downsample_signal(
+                signal, ret_df["datetime"], opts.max_points
+            )
+    except Exception as e:
+        for method, model, pen_base, n_bkps in grid_cells(opts):
+            summary_rows.append(dict(
+                base, method=method, model=model, pen_base=pen_base, n_bkps=n_bkps,
+                returns=np.nan, rmse=np.nan, change_point_count=0, cp_datetimes="",
+                cp_seconds=np.nan, status="error", error=str(e), note="",
+            ))
+        return summary_rows, pd.DataFrame()
+
+    base.update(returns=len(returns), rmse=rmse)
+
+    for method, model, pen_base, n_bkps in grid_cells(opts):
+        cell = dict(base, method=method, model=model, pen_base=pen_base, n_bkps=n_bkps)
+        t0 = time.perf_counter()
+
+        if opts.multiscale:
+            detect = partial(detect_change_points_multiscale, max_points=opts.max_points)
+        else:
+            detect = detect_change_points
+
+        try:
+            cps = detect(
+                signal,
+                method,
+                model,
+                pen_base=pen_base if method == "pelt" else 0.0,
+                pen_log_n=not opts.no_pen_log,
+                n_bkps=n_bkps if method != "pelt" else 1,
+                min_size=opts.min_size,
+                jump=opts.jump,
+                width=opts.width,
+                backend=opts.backend,
+                dynp_max_points=opts.dynp_max_points,
+                min_returns=opts.min_returns,
+            )
+            status, error, note = "ok", "", ""
+        except Exception as e:
+            # dynp のサイズ超過は失敗ではなく省略 (traversal と同じく変化点なしで note に残す)
+            cps = []
+            if "dynpスキップ" in str(e):
+                status, error, note = "skipped", "", str(e)
+            else:
+                status, error, note = "error", str(e), ""
+
+        if opts.min_distance > 0:
+            cps = filter_change_points_by_distance(cps, opts.min_distance)
+
+        cps = np.asarray(cps, dtype=np.int64)
+        cp_datetimes = ds_datetimes.iloc[cps]
+
+        summary_rows.append(dict(
+            cell,
+            change_point_count=len(cps),
+            cp_datetimes=" | ".join(str(x) for x in cp_datetimes),
+            cp_seconds=time.perf_counter() - t0,
+            status=status,
+            error=error,
+            note=note,
+        ))
+
+        pair_frames.append(pd.DataFrame(dict(
+            cell,
+            cp_index_downsampled=cps,
+            cp_index_original=np.asarray(ds_idx)[cps],
+            cp_datetime=cp_datetimes.to_numpy(),
+            cp_strength=change_point_strengths(signal, cps),
+        )))
+
+    return summary_rows, pd.concat(pair_frames, ignore_index=True)
+
+
+def init_worker(opts):
+    global _OPTS
+    _OPTS = opts
+    warnings.filterwarnings("ignore")
+
+
+def process_file_in_worker(file_path):
+    return process_file(file_path, _OPTS)
+
+
+def iter_file_results(files, opts):
+    if opts.workers <= 1:
+        for file_path in files:
+            yield process_file(file_path, opts)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=opts.workers,
+        initializer=init_worker,
+        initargs=(opts,),
+    ) as executor:
+        yield from executor.map(process_file_in_worker, files)
+
+
+def save_csv_safe(df, path):
+    tmp_path = path.with_name(path.name + ".tmp")
+    df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    warnings.filterwarnings("ignore")
+    opts = parse_args(argv)
+
+    if opts.workers <= 0:
+        raise ValueError("--workers は 1 以上にしてください")
+
+    files = sorted(opts.data_dir.glob(opts.pattern))
+
+    if opts.max_files > 0:
+        files = files[:opts.max_files]
+
+    if not files:
+        raise FileNotFoundError(f"対象ファイルが見つかりません: {opts.data_dir / opts.pattern}")
+
+    opts.output_dir.mkdir(parents=True, exist_ok=True)
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    log(f"対象ファイル数: {len(files)}, セル数: {len(grid_cells(opts))}, workers={opts.workers}")
+
+    all_summary_rows = []
+    all_pair_frames = []
+    pair_count = 0
+    start = time.perf_counter()
+
+    for file_i, (summary_rows, pairs_df) in enumerate(iter_file_results(files, opts), start=1):
+        all_summary_rows.extend(summary_rows)
+        all_pair_frames.append(pairs_df)
+        pair_count += len(pairs_df)
+
+        if file_i % 50 == 0 or file_i == len(files):
+            elapsed = time.perf_counter() - start
+            log(
+                f"{file_i}/{len(files)} ファイル完了: 変化点={pair_count}, "
+                f"{file_i / max(elapsed, 1e-9):.1f} files/s"
+            )
+
+    summary_df = pd.DataFrame(all_summary_rows)
+    summary_df.insert(0, "run_id", run_id)
+    pairs_df = pd.concat(all_pair_frames, ignore_index=True)
+    pairs_df.insert(0, "run_id", run_id)
+
+    summary_path = opts.output_dir / f"{OUTPUT_PREFIX}_summary_{run_id}.csv"
+    pairs_path = opts.output_dir / f"{OUTPUT_PREFIX}_pairs_{run_id}.csv"
+
+    save_csv_safe(summary_df, summary_path)
+    save_csv_safe(pairs_df, pairs_path)
+
+    log(f"summary保存: {summary_path}")
+    log(f"pairs保存: {pairs_path}")
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+変化点検知
+pelt / binseg / bottomup / window / dynp × ruptures のコスト。
+backend="numpy" のとき、engine (累積和エンジン) が対応する組み合わせ (l1/l2/normal × pelt/binseg/bottomup/dynp)
+は累積和エンジンで解き、それ以外は ruptures を使う。
+
+多重解像度 (detect_change_points_multiscale):
+長い系列を間引く代わりに、block 点ずつまとめた粗い信号で変化点を探し、
+各候補の前後 (±block + refine_radius 点) だけを元の解像度で見直して位置を決める。
+粗い信号は block ごとの平均 × sqrt(block) (normal は block ごとの二乗平均平方根)。
+"""
+
+import numpy as np
+
+from . import engine
+
+
+METHODS = ["pelt", "binseg", "bottomup", "window", "dynp"]
+
+_RPT = None
+
+
+def ruptures():
+    """ruptures は重いので、最初に使うときだけ import する"""
+    global _RPT
+
+    if _RPT is None:
+        import ruptures as rpt
+        _RPT = rpt
+
+    return _RPT
+
+
+def make_signal(returns, scale="std"):
+    """
+    returns を (n, 1) の信号にする。
+    scale:
+        "std"    : 標準偏差で割る (traversal-henkaten-12)
+        "zscore" : 平均を引いて標準偏差で割る (traversal-henkaten-2 〜 4)
+        数値     : その倍率を掛ける (traversal-henkaten-9 〜 11 の RETURN_SCALE)
+    """
+    signal = np.asarray(returns, dtype=float).reshape(-1, 1)
+
+    if not isinstance(scale, str):
+        return signal * float(scale)
+
+    std = float(np.std(signal))
+
+    if std <= 0 or np.isnan(std):
+        raise ValueError("returnsの標準偏差が0です")
+
+    if scale == "std":
+        return signal / std
+
+    if scale == "zscore":
+        return (signal - signal.mean()) / std
+
+    raise ValueError(f"未知のscaleです: {scale}")
+
+
+def downsample_signal(signal, datetimes, max_points):
+    """
+    max_points 点まで等間隔に間引く。
+    戻り値は (signal, datetimes, 元のインデックス)。datetimes は None でもよい。
+    """
+    n = len(signal)
+
+    if n <= max_points:
+        return signal, datetimes, np.arange(n)
+
+    idx = np.linspace(0, n - 1, max_points).astype(int)
+    idx = np.unique(idx)
+
+    if datetimes is not None:
+        datetimes = datetimes.iloc[idx].reset_index(drop=True)
+
+    return signal[idx], datetimes, idx
+
+
+def default_n_bkps(n, n_bkps, min_size):
+    """系列が短いときは n_bkps を区間数の上限まで下げる"""
+    return min(n_bkps, max(1, n // max(min_size, 2) - 1))
+
+
+def detect_change_points(
+    signal,
+    method,
+    model,
+    pen_base=0.2,
+    pen_log_n=True,
+    n_bkps=30,
+    min_size=2,
+    jump=1,
+    width=10,
+    backend="ruptures",
+    dynp_max_points=None,
+    min_returns=10,
+    stats=None,
+):
+    """
+    変化点のインデックス (0 < cp < n、末尾の n は含まない) を返す。
+
+    pelt のペナルティは pen_base * log(n) (pen_log_n=False なら pen_base そのまま)、
+    それ以外は n_bkps 個 (短い系列では default_n_bkps で減らす)。
+    ruptures の dynp で n > dynp_max_points のときは RuntimeError("dynpスキップ ...")。
+    stats (dict) には numpy バックエンドの dynp の枝刈り統計が入る。
+    """
+    n = len(signal)
+
+    if n < min_returns:
+        return []
+
+    pen = pen_base * np.log(max(n, 2)) if pen_log_n else pen_base
+    n_bkps = default_n_bkps(n, n_bkps, min_size)
+
+    if backend == "numpy" and engine.supports(method, model):
+        cps = engine.detect(
+            method,
+            model,
+            signal,
+            pen=pen,
+            n_bkps=n_bkps,
+            min_size=min_size,
+            jump=jump,
+            stats=stats
+        )
+
+        return [int(cp) for cp in cps if int(cp) < n]
+
+    if method == "dynp" and dynp_max_points is not None and n > dynp_max_points:
+        raise RuntimeError(
+            f"dynpスキップ: len={n} > DYN_MAX_POINTS_FOR_CP={dynp_max_points}"
+        )
+
+    rpt = ruptures()
+
+    if method == "pelt":
+        algo = rpt.Pelt(model=model, min_size=min_size, jump=jump).fit(signal)
+        cps = algo.predict(pen=pen)
+
+    elif method == "binseg":
+        algo = rpt.Binseg(model=model, min_size=min_size, jump=jump).fit(signal)
+        cps = algo.predict(n_bkps=n_bkps)
+
+    elif method == "bottomup":
+        algo = rpt.BottomUp(model=model, min_size=min_size, jump=jump).fit(signal)
+        cps = algo.predict(n_bkps=n_bkps)
+
+    elif method == "window":
+        width = min(width, max(2, n // 2))
+        algo = rpt.Window(width=width, model=model, min_size=min_size, jump=jump).fit(signal)
+        cps = algo.predict(n_bkps=n_bkps)
+
+    elif method == "dynp":
+        algo = rpt.Dynp(model=model, min_size=min_size, jump=jump).fit(signal)
+        cps = algo.predict(n_bkps=n_bkps)
+
+    else:
+        raise ValueError(f"未知のmethodです: {method}")
+
+    # rupturesは最後にnを返すので除外
+    return [int(cp) for cp in cps if int(cp) < n]
+
+
+# =========================================================
+# 多重解像度 (粗い信号で検知 → 元の解像度で位置を見直す)
+# =========================================================
+
+def block_aggregate(signal, block, model):
+    """
+    block 点ごとにまとめた (ceil(n / block), 1) の粗い信号を作る。
+    最後の端数の block はその点数で平均する。
+    平均は sqrt(block) 倍して、ノイズの大きさを元の信号とそろえる。
+    normal (分散の変化) では block ごとの二乗平均平方根を使う。
+    """
+    x = np.asarray(signal, dtype=float)[:, 0]
+    n = len(x)
+    m_full = n // block
+
+    values = x * x if model == "normal" else x
+
+    head = values[:m_full * block].reshape(m_full, block).mean(axis=1)
+
+    if n > m_full * block:
+        head = np.append(head, values[m_full * block:].mean())
+
+    if model == "normal":
+        coarse = np.sqrt(head)
+    else:
+        coarse = head * np.sqrt(block)
+
+    return coarse.reshape(-1, 1)
+
+
+def segment_cost_function(signal, model):
+    """
+    区間コスト error(start, end)。start / end は配列でもよい。
+    engine の対応モデルは累積和、それ以外は ruptures のコストを1つずつ呼ぶ。
+    """
+    if model in engine.SUPPORTED_MODELS:
+        return engine.PrefixSumCost(model, signal).error
+
+    cost = ruptures().costs.cost_factory(model=model).fit(signal)
+
+    def error(start, end):
+        return np.array([cost.error(int(s), int(e)) for s, e in zip(start, end)])
+
+    return error
+
+
+def refine_change_points(signal, model, coarse_cps, radius, min_size=2):
+    """
+    各候補 c の前後 radius 点の中で、区間を2つに分けたときのコストが最小になる位置に動かす。
+    区間は 前の変化点 〜 次の候補。
+    累積和で解けないモデル (rbf など) は全体のグラム行列を作らないよう、
+    c の前後 3 * radius 点に切り出した区間で比べる。
+    """
+    n = len(signal)
+    min_size = max(min_size, 2)
+    prefix_model = model in engine.SUPPORTED_MODELS
+
+    if prefix_model:
+        error = segment_cost_function(signal, model)
+
+    refined = []
+    bounds = list(coarse_cps) + [n]
+
+    for i, c in enumerate(coarse_cps):
+        seg_start = refined[-1] if refined else 0
+        seg_end = bounds[i + 1]
+
+        if not prefix_model:
+            seg_start = max(seg_start, c - 3 * radius)
+            seg_end = min(seg_end, c + 3 * radius)
+
+        lo = max(seg_start + min_size, c - radius)
+        hi = min(seg_end - min_size, c + radius)
+
+        if hi < lo:
+            continue
+
+        if prefix_model:
+            offset, seg_error = 0, error
+        else:
+            offset = seg_start
+            seg_error = segment_cost_function(signal[seg_start:seg_end], model)
+
+        cand = np.arange(lo, hi + 1) - offset
+        starts = np.full(len(cand), seg_start - offset)
+        ends = np.full(len(cand), seg_end - offset)
+
+        total = seg_error(starts, cand) + seg_error(cand, ends)
+
+        refined.append(int(cand[int(np.nanargmin(total))]) + offset)
+
+    return refined
+
+
+def detect_change_points_multiscale(
+    signal,
+    method,
+    model,
+    max_points=2000,
+    refine_radius=None,
+    **kwargs,
+):
+    """
+    n > max_points なら block = ceil(n / max_points) 点ずつまとめた信号で
+    detect_change_points を実行し、候補を元の解像度で見直す。
+    n <= max_points ならそのまま detect_change_points と同じ。
+    戻り値は元の信号でのインデックス。refine_radius の既定値は block。
+    kwargs は detect_change_points にそのまま渡す。
+    """
+    n = len(signal)
+
+    if n <= max_points:
+        return detect_change_points(signal, method, model, **kwargs)
+
+    block = int(np.ceil(n / max_points))
+    coarse = block_aggregate(signal, block, model)
+
+    coarse_cps = detect_change_points(coarse, method, model, **kwargs)
+    coarse_cps = [cp * block for cp in coarse_cps if 0 < cp * block < n]
+
+    radius = block if refine_radius is None else refine_radius
+
+    refined = refine_change_points(
+        signal,
+        model,
+        coarse_cps,
+        radius=radius,
+        min_size=kwargs.get("min_size", 2)
+    )
+
+    return sorted(set(refined))
+
+
+def filter_change_points_by_distance(bkps, min_distance):
+    """前に残した変化点から min_distance 未満の変化点を落とす"""
+    filtered = []
+
+    for b in sorted(bkps):
+        if not filtered or b - filtered[-1] >= min_distance:
+            filtered.append(b)
+
+    return filtered
+
+
+def change_point_strengths(signal, cps, window=5):
+    """
+    全変化点の 前後 window 点の平均の差の絶対値 (change_point_strength の一括版)。
+    信号の累積和から各窓の平均をまとめて求める。窓が取れない変化点は NaN。
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    cps = np.asarray(cps, dtype=np.int64)
+    n = len(signal)
+
+    csum = np.concatenate([[0.0], np.cumsum(signal)])
+
+    left = np.maximum(cps - window, 0)
+    right = np.minimum(cps + window, n)
+    valid = (left < cps) & (cps < right)
+
+    c, left, right = cps[valid], left[valid], right[valid]
+    left_mean = (csum[c] - csum[left]) / (c - left)
+    right_mean = (csum[right] - csum[c]) / (right - c)
+
+    strengths = np.full(len(cps), np.nan)
+    strengths[valid] = np.abs(right_mean - left_mean)
+
+    return strengths
+
+
+def change_point_strength(signal, cp, window=5):
+    """変化点前後 window 点の平均の差の絶対値"""
+    return float(change_point_strengths(signal, [cp], window)[0])
@@ -0,0 +1,825 @@
+# -*- coding: utf-8 -*-
+"""
+変化点検知エンジン (NumPy版)
+l1 / l2 / normal コスト × pelt / binseg / bottomup
+
+rupturesはセグメントのコストを error(start, end) の1回呼び出しごとに
+Pythonオブジェクト経由で計算するため、長い系列では遅い。
+ここでは x, x^2 の累積和を最初に1回だけ作り、
+任意区間のコストを O(1) (候補点についてはベクトル化) で求める。
+
+探索の手順・候補点・停止条件・同点時の選び方は ruptures 1.1.x と同じにしてある。
+l2 / normal は ruptures と同じコスト、l1 は近似コスト
+(正規分布を仮定した平均絶対偏差 sqrt(2/pi) * std * 区間長) を使う。
+
+dynp は ruptures の再帰 (lru_cache) ではなく、区間数ごとの最適分割を
+表で持つ動的計画法で解く。不等式による枝刈り (SNIP) を入れ、
+コスト表は終点方向にブロック分割してメモリ量を抑える。
+
+単体で実行すると coingecko_by_coin のCSVで ruptures と結果・速度を比較する
+(finance/cp_engine.py がこのモジュールを再エクスポートしている):
+    python cp_engine.py --data-dir D:\\musashino-university\\finance\\coingecko_by_coin
+"""
+
+import argparse
+import heapq
+from collections import deque
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+
+SUPPORTED_MODELS = ["l1", "l2", "normal"]
+SUPPORTED_METHODS = ["pelt", "binseg", "bottomup", "dynp"]
+
+# ruptures CostNormal(add_small_diag=True) と同じ値
+NORMAL_SMALL_DIAG = 1e-6
+
+L1_GAUSS_FACTOR = np.sqrt(2.0 / np.pi)
+
+# dynpのコスト表は (候補点 × 終点ブロック) 単位で作る。
+# ブロックが小さいほど枝刈りがこまめに効く。バイト数はメモリの上限。
+DYNP_BLOCK = 64
+DYNP_MAX_TABLE_BYTES = 64 * 1024 * 1024
+
+
+# =========================================================
+# 1. コスト (累積和)
+# =========================================================
+
+class PrefixSumCost:
+    """
+    累積和による区間コスト。
+    error(start, end) は start / end に整数でも配列でも渡せる。
+    """
+
+    def __init__(self, model, signal):
+        if model not in SUPPORTED_MODELS:
+            raise ValueError(f"未対応のmodelです: {model}")
+
+        x = np.asarray(signal, dtype=np.float64)
+
+        if x.ndim == 1:
+            x = x.reshape(-1, 1)
+
+        if model == "normal" and x.shape[1] != 1:
+            raise ValueError("normalは1次元の信号のみ対応しています")
+
+        self.model = model
+        self.n_samples = x.shape[0]
+        # ruptures の CostL2 / CostL1 / CostNormal と同じ最小区間長
+        self.min_size = 1 if model == "l2" else 2
+
+        zeros = np.zeros((1, x.shape[1]))
+        self.s1 = np.vstack([zeros, np.cumsum(x, axis=0)])
+        self.s2 = np.vstack([zeros, np.cumsum(x * x, axis=0)])
+
+    @classmethod
+    def from_prefix(cls, model, s1, s2):
+        """保存しておいた累積和から復元する (逐次検知用)"""
+        cost = cls(model, np.zeros((0, s1.shape[1])))
+        cost.s1 = np.asarray(s1, dtype=np.float64)
+        cost.s2 = np.asarray(s2, dtype=np.float64)
+        cost.n_samples = cost.s1.shape[0] - 1
+        return cost
+
+    def append(self, x_new):
+        """末尾にデータを追加し、累積和を伸ばす"""
+        x_new = np.asarray(x_new, dtype=np.float64)
+
+        if x_new.ndim == 1:
+            x_new = x_new.reshape(-1, 1)
+
+        self.s1 = np.vstack([self.s1, self.s1[-1] + np.cumsum(x_new, axis=0)])
+        self.s2 = np.vstack([self.s2, self.s2[-1] + np.cumsum(x_new * x_new, axis=0)])
+        self.n_samples = self.s1.shape[0] - 1
+
+    def _sq_dev(self, start, end):
+        """区間内の平均からの二乗偏差の和 (次元ごと)"""
+        start = np.asarray(start)
+        end = np.asarray(end)
+        length = (end - start)[..., None]
+
+        s1 = self.s1[end] - self.s1[start]
+        s2 = self.s2[end] - self.s2[start]
+
+        sq = s2 - s1 * s1 / length
+        return np.maximum(sq, 0.0), length
+
+    def error(self, start, end):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self._error(start, end)
+
+    def error_by_dim(self, start, end):
+        """l2 コストを次元ごとに返す (形は start / end の形 + (次元数,))"""
+        if self.model != "l2":
+            raise ValueError("次元ごとのコストは l2 のみ対応しています")
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self._sq_dev(start, end)[0]
+
+    def _error(self, start, end):
+        sq, length = self._sq_dev(start, end)
+
+        if self.model == "l2":
+            out = sq.sum(axis=-1)
+
+        elif self.model == "l1":
+            out = (L1_GAUSS_FACTOR * np.sqrt(sq * length)).sum(axis=-1)
+
+        else:
+            var = sq[..., 0] / length[..., 0]
+            out = np.log(var + NORMAL_SMALL_DIAG) * length[..., 0]
+
+        if np.ndim(out) == 0:
+            return float(out)
+        return out
+
+
+# =========================================================
+# 2. 共通
+# =========================================================
+
+def sanity_check(n_samples, n_bkps, jump, min_size):
+    """ruptures.utils.sanity_check と同じ判定"""
+    n_adm_bkps = n_samples // jump
+
+    if n_bkps > n_adm_bkps:
+        return False
+    if n_bkps * int(np.ceil(min_size / jump)) * jump + min_size > n_samples:
+        return False
+    return True
+
+
+def check_params(cost, n_bkps, jump, min_size):
+    if not sanity_check(cost.n_samples, n_bkps, jump, min_size):
+        raise ValueError(
+            f"分割できないパラメータです: n={cost.n_samples}, n_bkps={n_bkps}, "
+            f"jump={jump}, min_size={min_size}"
+        )
+
+
+# =========================================================
+# 3. PELT
+# =========================================================
+
+def pelt(cost, pen, min_size=2, jump=5):
+    """
+    rupturesのPeltと同じ再帰・同じ枝刈り。
+    F[t] = signal[0:t] の最適分割の (コスト + pen) の和。
+    """
+    n = cost.n_samples
+    min_size = max(min_size, cost.min_size)
+    check_params(cost, 0, jump, min_size)
+
+    total = np.full(n + 1, np.inf)
+    total[0] = 0.0
+    last = np.zeros(n + 1, dtype=np.int64)
+
+    ind = [k for k in range(0, n, jump) if k >= min_size]
+    ind.append(n)
+
+    admissible = np.empty(0, dtype=np.int64)
+
+    for bkp in ind:
+        admissible = pelt_step(cost, total, last, admissible, bkp, pen, min_size, jump)
+
+    return backtrack(last, n)
+
+
+def pelt_step(cost, total, last, admissible, bkp, pen, min_size, jump):
+    """
+    PELTの1ステップ。total[bkp], last[bkp] を埋め、枝刈り後の候補を返す。
+    逐次検知 (cp_stream) でも同じ処理を使う。
+    """
+    new_adm_pt = ((bkp - min_size) // jump) * jump
+    admissible = np.append(admissible, new_adm_pt)
+
+    # 分割が存在しない t (total=inf) は候補から外れる
+    admissible = admissible[np.isfinite(total[admissible])]
+
+    values = total[admissible] + (cost.error(admissible, bkp) + pen)
+    best = int(np.argmin(values))
+
+    total[bkp] = values[best]
+    last[bkp] = admissible[best]
+
+    return admissible[values <= total[bkp] + pen]
+
+
+def backtrack(last, end):
+    """last[t] (signal[0:t] の最適分割の最後の変化点) をたどって変化点列を返す"""
+    bkps = []
+    t = end
+    while t > 0:
+        bkps.append(int(t))
+        t = int(last[t])
+
+    return sorted(bkps)
+
+
+def segmentation_cost(cost, bkps):
+    """ペナルティを含まない分割のコスト合計"""
+    ends = np.asarray(bkps, dtype=np.int64)
+    starts = np.concatenate([[0], ends[:-1]])
+    return float(np.sum(cost.error(starts, ends)))
+
+
+def crops(cost, pen_min, pen_max, min_size=2, jump=5, max_runs=500):
+    """
+    CROPS (Changepoints for a Range Of PenaltieS)。
+    [pen_min, pen_max] のすべてのペナルティに対する PELT の最適分割を、
+    必要な点だけ PELT を実行して求める。
+
+    区間 (b0, b1) の両端で変化点数 m0 > m1 + 1 なら、
+    2つの分割のコストが等しくなるペナルティ
+        b = (Q1 - Q0) / (m0 - m1)   (Q はペナルティを含まないコスト)
+    で PELT を実行し、m が m1 と異なれば区間をさらに分ける。
+    累積和のコストは1回作ったものを全ペナルティで使い回す。
+    区間は幅優先で分けるので、max_runs で打ち切っても範囲全体が粗く埋まる。
+
+    戻り値はペナルティ昇順の
+    {"penalty", "n_bkps", "cost", "bkps"} のリスト (bkpsは最後のnを含む)。
+    """
+    if pen_min > pen_max:
+        raise ValueError(f"pen_min > pen_max です: {pen_min} > {pen_max}")
+
+    results = {}
+
+    def run(pen):
+        bkps = pelt(cost, pen=pen, min_size=min_size, jump=jump)
+        results[pen] = {
+            "penalty": float(pen),
+            "n_bkps": len(bkps) - 1,
+            "cost": segmentation_cost(cost, bkps),
+            "bkps": bkps,
+        }
+        return results[pen]
+
+    run(pen_min)
+    if pen_max != pen_min:
+        run(pen_max)
+
+    queue = deque([(pen_min, pen_max)])
+
+    while queue and len(results) < max_runs:
+        b0, b1 = queue.popleft()
+        r0 = results[b0]
+        r1 = results[b1]
+
+        if r0["n_bkps"] <= r1["n_bkps"] + 1:
+            continue
+
+        b_int = (r1["cost"] - r0["cost"]) / (r0["n_bkps"] - r1["n_bkps"])
+
+        # 丸め誤差で区間の外に出たら打ち切る
+        if not (b0 < b_int < b1) or b_int in results:
+            continue
+
+        r_int = run(b_int)
+
+        if r_int["n_bkps"] != r1["n_bkps"]:
+            queue.append((b0, b_int))
+            queue.append((b_int, b1))
+
+    return [results[pen] for pen in sorted(results)]
+
+
+# =========================================================
+# 4. Binary Segmentation
+# =========================================================
+
+def binseg(cost, n_bkps, min_size=2, jump=5):
+    """rupturesのBinseg(n_bkps指定)と同じ手順"""
+    n = cost.n_samples
+    min_size = max(min_size, cost.min_size)
+    check_params(cost, n_bkps, jump, min_size)
+
+    cache = {}
+
+    def single_bkp(start, end):
+        key = (start, end)
+        if key in cache:
+            return cache[key]
+
+        segment_cost = cost.error(start, end)
+
+        if np.isinf(segment_cost) and segment_cost < 0:
+            cache[key] = (None, 0)
+            return cache[key]
+
+        cands = np.arange(start, end, jump)
+        cands = cands[(cands - start >= min_size) & (end - cands >= min_size)]
+
+        if len(cands) == 0:
+            cache[key] = (None, 0)
+            return cache[key]
+
+        gains = segment_cost - cost.error(start, cands) - cost.error(cands, end)
+
+        # max((gain, bkp)) と同じく、同じgainなら後ろのbkpを選ぶ
+        best_gain = gains.max()
+        best = np.flatnonzero(gains == best_gain)[-1]
+
+        cache[key] = (int(cands[best]), float(best_gain))
+        return cache[key]
+
+    bkps = [n]
+
+    while True:
+        starts = [0] + bkps[:-1]
+        new_bkps = [single_bkp(s, e) for s, e in zip(starts, bkps)]
+        bkp, gain = max(new_bkps, key=lambda x: x[1])
+
+        if bkp is None:
+            break
+
+        if len(bkps) - 1 >= n_bkps:
+            break
+
+        bkps.append(bkp)
+        bkps.sort()
+
+    return bkps
+
+
+# =========================================================
+# 5. Bottom-up
+# =========================================================
+
+def _nearest_admissible(start, end, min_size, jump):
+    """[start, end) の中央に最も近い、jumpの倍数の分割点 (なければNone)"""
+    lo = -(-(start + min_size) // jump) * jump
+    hi = ((end - min_size) // jump) * jump
+
+    if lo > hi:
+        return None
+
+    mid = (start + end) * 0.5
+    k = int(np.floor(mid / jump)) * jump
+
+    best = None
+    for c in (k, k + jump):
+        c = min(max(c, lo), hi)
+        if best is None or abs(c - mid) < abs(best - mid):
+            best = c
+
+    return best
+
+
+def bottomup(cost, n_bkps, min_size=2, jump=5):
+    """rupturesのBottomUp(n_bkps指定)と同じ手順"""
+    n = cost.n_samples
+    min_size = max(min_size, cost.min_size)
+    check_params(cost, n_bkps, jump, min_size)
+
+    # 細かい区間に分ける (一番長い区間から中央付近で分割)
+    partition = [(-n, (0, n))]
+
+    while True:
+        _, (start, end) = partition[0]
+        bkp = _nearest_admissible(start, end, min_size, jump)
+
+        if bkp is None:
+            break
+
+        heapq.heappop(partition)
+        heapq.heappush(partition, (-bkp + start, (start, bkp)))
+        heapq.heappush(partition, (-end + bkp, (bkp, end)))
+
+    leaves = sorted(seg for _, seg in partition)
+
+    starts = np.array([s for s, _ in leaves])
+    ends = np.array([e for _, e in leaves])
+    leaf_vals = cost.error(starts, ends)
+
+    val = {seg: float(v) for seg, v in zip(leaves, np.atleast_1d(leaf_vals))}
+
+    def merge(left, right):
+        seg = (left[0], right[1])
+        if seg not in val:
+            val[seg] = cost.error(seg[0], seg[1])
+
+        v = val[seg]
+        if np.isinf(v) and v < 0:
+            gain = 0
+        else:
+            gain = v - (val[left] + val[right])
+
+        # Bnodeは開始位置で比較されるので、同じgainなら開始位置の小さい方
+        return (gain, seg[0], seg, left, right)
+
+    merged = [merge(left, right) for left, right in zip(leaves[:-1], leaves[1:])]
+    heapq.heapify(merged)
+
+    keys = [s for s, _ in leaves]
+    removed = set()
+
+    while len(leaves) > n_bkps + 1:
+        try:
+            _, _, seg, left, right = heapq.heappop(merged)
+            while left in removed or right in removed:
+                _, _, seg, left, right = heapq.heappop(merged)
+        except IndexError:
+            break
+
+        idx = int(np.searchsorted(keys, left[0]))
+        leaves[idx] = seg
+        keys[idx] = seg[0]
+        del leaves[idx + 1]
+        del keys[idx + 1]
+
+        removed.add(left)
+        removed.add(right)
+
+        if idx > 0:
+            heapq.heappush(merged, merge(leaves[idx - 1], seg))
+        if idx < len(leaves) - 1:
+            heapq.heappush(merged, merge(seg, leaves[idx + 1]))
+
+    return [e for _, e in leaves]
+
+
+# =========================================================
+# 6. Dynp (最適分割・枝刈りつき)
+# =========================================================
+
+def _feasible_last_bkps(n, n_left_bkps, min_size, jump):
+    """
+    左側に n_left_bkps 個の変化点を置ける最後の変化点 s の候補 (ruptures Dynp と同じ条件)
+    """
+    s = np.arange(0, n + 1, jump)
+    ok = (s // jump >= n_left_bkps)
+    ok &= n_left_bkps * int(np.ceil(min_size / jump)) * jump + min_size <= s
+    return s[ok]
+
+
+def dynp(cost, n_bkps, min_size=2, jump=5, max_table_bytes=DYNP_MAX_TABLE_BYTES, stats=None):
+    """
+    n_bkps 個の変化点で総コスト最小の分割 (rupturesのDynpと同じ解・同じ同点処理)。
+
+    F[k][t] = signal[0:t] を k+1 区間に分けたときの最小コスト
+            = min_s F[k-1][s] + cost(s, t)
+
+    枝刈り:
+    コストは cost(s, u) >= cost(s, t) + cost(t, u) を満たすので、
+    F[k-1][s] + cost(s, t) > F[k-1][t] となった s は、
+    u >= t + min_size の終点では t より必ず悪い。以後の候補から外す。
+
+    stats に dict を渡すと、評価したセル数と全表のセル数を入れて返す。
+    """
+    n = cost.n_samples
+    min_size = max(min_size, cost.min_size)
+    check_params(cost, n_bkps, jump, min_size)
+
+    ends = np.arange(n + 1)
+    block = min(DYNP_BLOCK, int(max_table_bytes // (8 * 4 * (n + 1))))
+    block = max(min_size + 1, block)
+
+    # k = 0 (変化点なし)
+    prev = np.full(n + 1, np.inf)
+    prev[min_size:] = cost.error(0, ends[min_size:])
+
+    argmins = []
+    evaluated = 0
+    full = 0
+    pruned = 0
+
+    for k in range(1, n_bkps + 1):
+        cands_all = _feasible_last_bkps(n, k - 1, min_size, jump)
+        cands_all = cands_all[np.isfinite(prev[cands_all])]
+
+        # k 区間目の終点として意味があるのは、残りの変化点を置ける t まで
+        t_max = n - (n_bkps - k) * min_size
+        cur = np.full(n + 1, np.inf)
+        arg = np.zeros(n + 1, dtype=np.int64)
+
+        # t の候補として使える点 (枝刈りの基準にできる点)
+        is_cand = np.zeros(n + 1, dtype=bool)
+        is_cand[cands_all] = True
+
+        active = np.empty(0, dtype=np.int64)
+        next_new = 0
+
+        t_start = int(cands_all[0]) + min_size if len(cands_all) else n + 1
+
+        # 最後の層は t = n だけ求めればよい
+        if k == n_bkps:
+            t_start = n
+
+        for b0 in range(t_start, t_max + 1, block):
+            b1 = min(b0 + block, t_max + 1)
+            t_block = ends[b0:b1]
+
+            # このブロックで新たに使える s を追加 (s <= t - min_size)
+            stop = np.searchsorted(cands_all, b1 - 1 - min_size, side="right")
+            active = np.concatenate([active, cands_all[next_new:stop]])
+            next_new = stop
+
+            if len(active) == 0:
+                continue
+
+            table = prev[active][:, None] + cost.error(active[:, None], t_block[None, :])
+            table[t_block[None, :] - active[:, None] < min_size] = np.inf
+
+            evaluated += table.size
+            best = np.argmin(table, axis=0)
+            cur[b0:b1] = table[best, np.arange(len(t_block))]
+            arg[b0:b1] = active[best]
+
+            # 枝刈り: 次のブロック (u >= b1) で効くのは t <= b1 - min_size
+            usable = is_cand[b0:b1] & (t_block <= b1 - min_size) & np.isfinite(prev[b0:b1])
+            if usable.any():
+                t_use = t_block[usable]
+                worse = table[:, usable] > prev[t_use][None, :]
+                worse &= t_use[None, :] - active[:, None] >= min_size
+                dominated = worse.any(axis=1)
+                if dominated.any():
+                    pruned += int(dominated.sum())
+                    active = active[~dominated]
+
+        # 全表で評価した場合のセル数 (枝刈りなし)
+        t_all = ends[t_start:t_max + 1]
+        full += int(np.sum(np.searchsorted(cands_all, t_all - min_size, side="right")))
+
+        argmins.append(arg)
+        prev = cur
+
+    # 最終区間
+    if n_bkps == 0:
+        bkps = [n]
+    else:
+        bkps = [n]
+        t = n
+        for arg in reversed(argmins):
+            t = int(arg[t])
+            bkps.append(t)
+        bkps = sorted(bkps)
+
+    if stats is not None:
+        stats["evaluated"] = evaluated
+        stats["full"] = full
+        stats["pruned"] = pruned
+
+    return bkps
+
+
+# =========================================================
+# 7. グループスパース二分割 (パネル)
+# =========================================================
+
+def dim_gains(cost, start, end, cands):
+    """区間 [start, end) を cands で分けたときの次元ごとの l2 コストの減少 (候補 × 次元)"""
+    return (
+        cost.error_by_dim(start, end)[None, :]
+        - cost.error_by_dim(np.full(len(cands), start), cands)
+        - cost.error_by_dim(cands, np.full(len(cands), end))
+    )
+
+
+def sparse_binseg(cost, threshold, n_bkps=None, min_members=1, min_size=2, jump=5):
+    """
+    (T × N) のパネルを全次元で共通の変化点に分ける二分割
+    (sparsified binary segmentation)。
+
+    各区間の各候補点で、次元ごとのコストの減少が threshold を超えた次元だけ
+    (減少 - threshold) を足し合わせ、それが最大の点で分ける。
+    threshold を超えた次元が min_members 未満の候補は使わない。
+    一部の銘柄だけが動いた変化点も、全銘柄の和で薄まらずに拾える。
+
+    n_bkps が None なら分けられる区間がなくなるまで続ける。
+    戻り値は ruptures と同じ形 (最後に n を含む) の bkps と、
+    {bkp: {"gain": 合計, "members": 超えた次元の番号}}。
+    """
+    n = cost.n_samples
+    min_size = max(min_size, cost.min_size)
+    max_bkps = n if n_bkps is None else n_bkps
+
+    cache = {}
+
+    def single_bkp(start, end):
+        key = (start, end)
+        if key in cache:
+            return cache[key]
+
+        cands = np.arange(start, end, jump)
+        cands = cands[(cands - start >= min_size) & (end - cands >= min_size)]
+        cache[key] = (None, 0.0, None)
+
+        if len(cands) == 0:
+            return cache[key]
+
+        excess = dim_gains(cost, start, end, cands) - threshold
+        hits = excess > 0
+
+        total = np.where(hits, excess, 0.0).sum(axis=1)
+        total[hits.sum(axis=1) < min_members] = 0.0
+
+        best = int(np.argmax(total))
+
+        if total[best] > 0:
+            cache[key] = (int(cands[best]), float(total[best]), np.flatnonzero(hits[best]))
+
+        return cache[key]
+
+    bkps = [n]
+    info = {}
+
+    while len(bkps) - 1 < max_bkps:
+        starts = [0] + bkps[:-1]
+        bkp, gain, members = max(
+            (single_bkp(s, e) for s, e in zip(starts, bkps)), key=lambda x: x[1]
+        )
+
+        if bkp is None:
+            break
+
+        bkps.append(bkp)
+        bkps.sort()
+        info[bkp] = {"gain": gain, "members": members}
+
+    return bkps, info
+
+
+# =========================================================
+# 8. 入口
+# =========================================================
+
+def supports(method, model):
+    return method in SUPPORTED_METHODS and model in SUPPORTED_MODELS
+
+
+def detect(method, model, signal, pen=None, n_bkps=None, min_size=2, jump=5, stats=None):
+    """
+    ruptures の fit(signal).predict(...) と同じ形 (最後に n を含む) で返す。
+    pelt は pen、binseg / bottomup / dynp は n_bkps を使う。
+    stats (dict) は dynp のときだけ枝刈りの統計が入る。
+    """
+    cost = PrefixSumCost(model, signal)
+
+    if method == "pelt":
+        return pelt(cost, pen=pen, min_size=min_size, jump=jump)
+
+    if method == "binseg":
+        return binseg(cost, n_bkps=n_bkps, min_size=min_size, jump=jump)
+
+    if method == "bottomup":
+        return bottomup(cost, n_bkps=n_bkps, min_size=min_size, jump=jump)
+
+    if method == "dynp":
+        return dynp(cost, n_bkps=n_bkps, min_size=min_size, jump=jump, stats=stats)
+
+    raise ValueError(f"未対応のmethodです: {method}")
+
+
+# =========================================================
+# 9. rupturesとの比較
+# =========================================================
+
+def load_signal(path, max_points):
+    import pandas as pd
+
+    df = pd.read_csv(path, encoding="utf-8-sig")
+    if "price" not in df.columns:
+        return None
+
+    price = pd.to_numeric(df["price"], errors="coerce")
+    price = price[price > 0].to_numpy(dtype=float)
+
+    returns = np.diff(np.log(price))
+    returns = returns[np.isfinite(returns)]
+
+    if len(returns) < 10 or np.std(returns) <= 0:
+        return None
+
+    signal = (returns / np.std(returns)).reshape(-1, 1)
+
+    if len(signal) > max_points:
+        idx = np.unique(np.linspace(0, len(signal) - 1, max_points).astype(int))
+        signal = signal[idx]
+
+    return signal
+
+
+def breakpoint_f1(expected, got, margin=5):
+    """最後の n を除いた変化点同士の F1 (±margin 以内なら一致)"""
+    expected = list(expected)[:-1]
+    got = list(got)[:-1]
+
+    if not expected and not got:
+        return 1.0
+    if not expected or not got:
+        return 0.0
+
+    used = set()
+    tp = 0
+    for e in expected:
+        for i, g in enumerate(got):
+            if i not in used and abs(g - e) <= margin:
+                used.add(i)
+                tp += 1
+                break
+
+    precision = tp / len(got)
+    recall = tp / len(expected)
+
+    if tp == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+def compare_with_ruptures(files, max_points, dynp_max_points, n_bkps, pen_base, min_size, jump):
+    import ruptures as rpt
+
+    algos = {
+        "pelt": rpt.Pelt,
+        "binseg": rpt.Binseg,
+        "bottomup": rpt.BottomUp,
+        "dynp": rpt.Dynp,
+    }
+
+    print(
+        f"{'method':<9}{'model':<8}{'files':>6}{'same':>6}{'F1':>7}"
+        f"{'rpt[s]':>10}{'np[s]':>10}{'x':>8}"
+    )
+
+    for method in SUPPORTED_METHODS:
+        for model in SUPPORTED_MODELS:
+            same = 0
+            f1_sum = 0.0
+            count = 0
+            t_rpt = 0.0
+            t_np = 0.0
+
+            # ruptures の dynp は長い系列だと終わらないので、比較用に短くする
+            points = dynp_max_points if method == "dynp" else max_points
+
+            for path in files:
+                signal = load_signal(path, points)
+                if signal is None:
+                    continue
+
+                n = len(signal)
+                pen = pen_base * np.log(max(n, 2))
+                k = min(n_bkps, max(1, n // max(min_size, 2) - 1))
+
+                t0 = time.perf_counter()
+                algo = algos[method](model=model, min_size=min_size, jump=jump).fit(signal)
+                if method == "pelt":
+                    expected = algo.predict(pen=pen)
+                else:
+                    expected = algo.predict(n_bkps=k)
+                t1 = time.perf_counter()
+                got = detect(method, model, signal, pen=pen, n_bkps=k,
+                             min_size=min_size, jump=jump)
+                t2 = time.perf_counter()
+
+                t_rpt += t1 - t0
+                t_np += t2 - t1
+                count += 1
+                same += int(list(expected) == list(got))
+                f1_sum += breakpoint_f1(expected, got)
+
+            speedup = t_rpt / t_np if t_np > 0 else np.nan
+            f1 = f1_sum / count if count else np.nan
+            print(
+                f"{method:<9}{model:<8}{count:>6}{same:>6}{f1:>7.3f}"
+                f"{t_rpt:>10.2f}{t_np:>10.2f}{speedup:>8.1f}",
+                flush=True
+            )
+
+
+def main():
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="NumPy変化点エンジンとrupturesの比較")
+    parser.add_argument("--data-dir", type=str, default="./coingecko_by_coin")
+    parser.add_argument("--max-files", type=int, default=50)
+    parser.add_argument("--max-points", type=int, default=2000)
+    parser.add_argument("--dynp-max-points", type=int, default=300)
+    parser.add_argument("--n-bkps", type=int, default=30)
+    parser.add_argument("--pen-base", type=float, default=0.2)
+    parser.add_argument("--min-size", type=int, default=2)
+    parser.add_argument("--jump", type=int, default=1)
+    args = parser.parse_args()
+
+    files = sorted(Path(args.data_dir).glob("*.csv"))[:args.max_files]
+
+    if not files:
+        raise FileNotFoundError(f"CSVが見つかりません: {args.data_dir}")
+
+    compare_with_ruptures(
+        files,
+        max_points=args.max_points,
+        dynp_max_points=args.dynp_max_points,
+        n_bkps=args.n_bkps,
+        pen_base=args.pen_base,
+        min_size=args.min_size,
+        jump=args.jump,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+CSV読込
+列名の候補は各 traversal-henkaten の候補をすべて合わせたもの。
+
+スキーマの推定 (sniff_csv):
+ファイル全体を文字コードごとに読み直す代わりに、先頭 SNIFF_BYTES だけを
+デコードして文字コード・日時列・価格列を決め、ファイルの横に
+<名前>.schema.json として保存する (キーは mtime と size)。
+2回目以降はこのマニフェストを読むだけで、本体は必要な2列だけを
+usecols / dtype 指定 (pyarrow があれば pyarrow エンジン) で読む。
+高速な読み方で失敗したら、従来どおり全列を読んで変換する。
+"""
+
+import io
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# pyarrow の数値の読み方は正確な丸めで、C エンジンとは最下位ビットが違うことがある。
+# 以前の出力とビット単位で合わせたいときは "c" にする。
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+
+ENCODINGS = ["utf-8-sig", "utf-8", "cp932", "shift_jis"]
+
+SNIFF_BYTES = 16 * 1024
+SCHEMA_SUFFIX = ".schema.json"
+USE_SCHEMA_MANIFEST = True
+
+DATETIME_CANDIDATES = [
+    "timestamp",
+    "datetime",
+    "date",
+    "time",
+    "Date",
+    "Datetime",
+    "Timestamp",
+    "Time",
+    "snapped_at",
+]
+
+PRICE_CANDIDATES = [
+    "price",
+    "Price",
+    "close",
+    "Close",
+    "market_price",
+    "Market Price",
+    "current_price",
+    "usd",
+    "value",
+    "Value",
+]
+
+MIN_PRICE_ROWS = 3
+
+
+def read_csv_auto(path):
+    last_error = None
+
+    for enc in ENCODINGS:
+        try:
+            return pd.read_csv(path, encoding=enc)
+        except Exception as e:
+            last_error = e
+
+    raise last_error
+
+
+def detect_datetime_column(df):
+    for c in DATETIME_CANDIDATES:
+        if c in df.columns:
+            return c
+
+    return None
+
+
+def detect_price_column(df):
+    for c in PRICE_CANDIDATES:
+        if c in df.columns:
+            return c
+
+    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+
+    if numeric_cols:
+        return numeric_cols[0]
+
+    return None
+
+
+# =========================================================
+# スキーマの推定とマニフェスト
+# =========================================================
+
+def schema_path(file_path):
+    file_path = Path(file_path)
+    return file_path.with_name(file_path.name + SCHEMA_SUFFIX)
+
+
+def file_key(file_path):
+    st = os.stat(file_path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def decode_head(raw, complete):
+    """
+    先頭バイト列を文字コード候補の順にデコードする。
+    途中で切れている (complete=False) ときは最後の改行までを使う。
+    戻り値は (encoding, text)。どれでもデコードできなければ (None, None)。
+    """
+    if not complete:
+        cut = raw.rfind(b"\n")
+        if cut < 0:
+            return None, None
+        raw = raw[:cut + 1]
+
+    for enc in ENCODINGS:
+        try:
+            return enc, raw.decode(enc)
+        except UnicodeDecodeError:
+            continue
+
+    return None, None
+
+
+def sniff_csv(file_path):
+    """
+    先頭 SNIFF_BYTES から {"encoding", "datetime_col", "price_col"} を推定する。
+    推定できなければ None。
+    """
+    with open(file_path, "rb") as f:
+        raw = f.read(SNIFF_BYTES + 1)
+
+    complete = len(raw) <= SNIFF_BYTES
+    enc, text = decode_head(raw[:SNIFF_BYTES], complete)
+
+    if enc is None:
+        return None
+
+    try:
+        sample = pd.read_csv(io.StringIO(text))
+    except Exception:
+        return None
+
+    if sample.empty:
+        return None
+
+    return {
+        "encoding": enc,
+        "datetime_col": detect_datetime_column(sample),
+        "price_col": detect_price_column(sample),
+    }
+
+
+def load_schema(file_path):
+    """マニフェストがあり、キーが一致すればそれを、なければ推定して保存したものを返す"""
+    path = schema_path(file_path)
+    key = file_key(file_path)
+
+    if USE_SCHEMA_MANIFEST and path.exists():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                schema = json.load(f)
+            if schema.get("key") == key:
+                return schema
+        except Exception:
+            # 壊れたマニフェストは推定し直して上書きする
+            pass
+
+    schema = sniff_csv(file_path)
+
+    if schema is None:
+        return None
+
+    schema["key"] = key
+
+    if USE_SCHEMA_MANIFEST:
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(schema, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            # 書き込めない場所 (読み取り専用など) では保存しない
+            pass
+
+    return schema
+
+
+def read_price_columns(file_path, schema):
+    """
+    マニフェストの文字コード・列名で、日時列と価格列だけを読む。
+    価格列は float64 に固定する (数値でない値があれば例外)。
+    戻り値は (df, datetime_col, price_col)。
+    """
+    dt_col = schema["datetime_col"]
+    price_col = schema["price_col"]
+    usecols = [price_col] if dt_col is None else [dt_col, price_col]
+
+    df = pd.read_csv(
+        file_path,
+        encoding=schema["encoding"],
+        usecols=usecols,
+        dtype={price_col: "float64"},
+        engine=CSV_ENGINE,
+    )
+
+    return df, dt_col, price_col
+
+
+def read_all_columns(file_path):
+    """全列を読んで列を判定する (従来の読み方)"""
+    df = read_csv_auto(file_path)
+
+    if df.empty:
+        raise ValueError("CSVが空です")
+
+    return df, detect_datetime_column(df), detect_price_column(df)
+
+
+# =========================================================
+# 価格系列
+# =========================================================
+
+def load_price_series(file_path):
+    """
+    CSVから {"datetime", "price"} の DataFrame を作る。
+    日時列がなければ行番号を datetime に入れる。
+    日時の重複は最初の行を残し、日時順に並べる。
+    """
+    schema = load_schema(file_path)
+    df = None
+
+    if schema is not None and schema["price_col"] is not None:
+        try:
+            df, dt_col, price_col = read_price_columns(file_path, schema)
+        except Exception:
+            df = None
+
+    if df is None:
+        df, dt_col, price_col = read_all_columns(file_path)
+
+    if df.empty:
+        raise ValueError("CSVが空です")
+
+    if price_col is None:
+        raise ValueError("価格列が見つかりません")
+
+    if dt_col is not None:
+        # 読み方 (エンジン) によって日時の単位が変わらないよう ns にそろえる
+        dt = pd.to_datetime(df[dt_col], errors="coerce").dt.as_unit("ns")
+    else:
+        dt = pd.Series(pd.RangeIndex(len(df)), index=df.index)
+
+    price = pd.to_numeric(df[price_col], errors="coerce")
+
+    out = pd.DataFrame({
+        "datetime": dt,
+        "price": price
+    })
+
+    out = out.dropna(subset=["price"])
+    out = out.replace([np.inf, -np.inf], np.nan).dropna(subset=["price"])
+
+    if dt_col is not None:
+        out = out.dropna(subset=["datetime"])
+        out = out.drop_duplicates(subset=["datetime"])
+        out = out.sort_values("datetime")
+
+    out = out.reset_index(drop=True)
+
+    if len(out) < MIN_PRICE_ROWS:
+        raise ValueError("有効な価格データが少なすぎます")
+
+    return out
+
+
+# traversal-henkaten-2 〜 4 での名前
+load_coin_csv = load_price_series
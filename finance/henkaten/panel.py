@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+銘柄をまたぐ変化点 (パネル)
+銘柄ごとに検知してから日別に数えるのではなく、
+全銘柄の対数収益率を共通の時刻グリッドにそろえた (T × N) 行列を作り、
+1回の探索で市場全体の変化点を求める。
+
+    build_return_panel   : 時刻グリッドにそろえた収益率の表 (T × N) を作る
+    standardize_panel    : 銘柄ごとに標準化し、欠測を 0 (平均) で埋めた行列にする
+    coarsen_panel        : T が大きすぎるときにブロックごとの収益率の和にまとめる
+    detect_panel_change_points : 変化点と、それぞれで動いた銘柄を返す
+
+method:
+    "sparse": グループスパースな二分割 (engine.sparse_binseg)。
+              銘柄ごとのコストの減少が閾値を超えた銘柄だけを足し合わせる
+    "pelt"  : 全銘柄の l2 コストの和で PELT (全銘柄が同じ向きに動く変化点向け)
+閾値は threshold_base * log(T) (標準化した信号で、変化がない銘柄の
+コストの減少の最大値がおよそ 2 * log(T) になるため)。
+"""
+
+import numpy as np
+import pandas as pd
+
+from . import engine
+
+
+PANEL_METHODS = ["sparse", "pelt"]
+
+
+def build_return_panel(series, freq="1h", min_coverage=0.5):
+    """
+    series は {symbol: (datetimes, prices)}。
+    各銘柄の価格を freq のグリッドに切り下げて最後の値を取り、
+    観測のあるグリッド点どうしの対数収益率を後ろの点に置く (観測のない点は NaN)。
+    グリッドの min_coverage 未満しか収益率がない銘柄は除く。
+    戻り値は (T × N) の DataFrame (index はグリッドの時刻)。
+    """
+    columns = {}
+
+    for symbol, (datetimes, prices) in series.items():
+        price = pd.Series(
+            np.asarray(prices, dtype=np.float64),
+            index=pd.DatetimeIndex(datetimes).floor(freq),
+        )
+        price = price[price > 0].groupby(level=0).last()
+
+        if len(price) >= 2:
+            columns[symbol] = np.log(price).diff().iloc[1:]
+
+    if not columns:
+        raise ValueError("パネルにできる銘柄がありません")
+
+    panel = pd.DataFrame(columns).sort_index()
+    coverage = panel.notna().mean(axis=0)
+
+    return panel.loc[:, coverage >= min_coverage]
+
+
+def standardize_panel(panel):
+    """
+    銘柄ごとに平均を引いて標準偏差で割り、欠測は 0 で埋めた (T × N) 行列を返す。
+    標準偏差が 0 の銘柄は除く。戻り値は (X, symbols)。
+    """
+    mean = panel.mean(axis=0)
+    std = panel.std(axis=0, ddof=0)
+    keep = (std > 0).to_numpy()
+
+    X = ((panel - mean) / std).to_numpy(dtype=np.float64)[:, keep]
+    X[np.isnan(X)] = 0.0
+
+    return X, list(panel.columns[keep])
+
+
+def coarsen_panel(X, datetimes, max_points):
+    """
+    T > max_points なら block 点ごとの和 / sqrt(block) にまとめる
+    (収益率の和は粗いグリッドでの収益率。sqrt(block) で割ってノイズの大きさをそろえる)。
+    戻り値は (X, datetimes, block)。datetimes は各ブロックの先頭の時刻。
+    """
+    T = len(X)
+
+    if T <= max_points:
+        return X, datetimes, 1
+
+    block = int(np.ceil(T / max_points))
+    m = int(np.ceil(T / block))
+
+    padded = np.zeros((m * block, X.shape[1]))
+    padded[:T] = X
+    coarse = padded.reshape(m, block, -1).sum(axis=1) / np.sqrt(block)
+
+    return coarse, datetimes[::block], block
+
+
+def detect_panel_change_points(
+    X,
+    method="sparse",
+    pen_base=0.2,
+    threshold_base=2.0,
+    min_members=2,
+    n_bkps=None,
+    min_size=2,
+    jump=1,
+):
+    """
+    (T × N) の行列 X で市場全体の変化点を求める。
+    戻り値は変化点ごとの dict
+    {"cp", "gain", "members" (コストの減少が閾値を超えた列番号), "member_gains"} のリスト。
+    pelt の penalty は pen_base * N * log(T)。
+    """
+    if method not in PANEL_METHODS:
+        raise ValueError(f"未対応のmethodです: {method}")
+
+    T, N = X.shape
+    threshold = threshold_base * np.log(max(T, 2))
+    cost = engine.PrefixSumCost("l2", X)
+
+    if method == "sparse":
+        bkps, _ = engine.sparse_binseg(
+            cost,
+            threshold,
+            n_bkps=n_bkps,
+            min_members=min_members,
+            min_size=min_size,
+            jump=jump,
+        )
+    else:
+        pen = pen_base * N * np.log(max(T, 2))
+        bkps = engine.pelt(cost, pen=pen, min_size=min_size, jump=jump)
+
+    # 前後の変化点で挟んだ区間で、銘柄ごとのコストの減少を求め直す
+    bounds = [0] + list(bkps)
+    results = []
+
+    for start, cp, end in zip(bounds[:-2], bounds[1:-1], bounds[2:]):
+        gains = engine.dim_gains(cost, start, end, np.array([cp]))[0]
+        members = np.flatnonzero(gains > threshold)
+        members = members[np.argsort(-gains[members])]
+
+        results.append({
+            "cp": int(cp),
+            "gain": float(gains.sum()),
+            "members": members,
+            "member_gains": gains[members],
+        })
+
+    return results
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+対数収益率とAR
+ARは statsmodels の AutoReg(trend="c") と同じ最小二乗を NumPy で直接解く
+(in-sample の予測値・RMSE は AutoReg と一致する)。
+statsmodels の import とモデル作成のコストがなく、バージョン差の影響も受けない。
+
+fit_ar_rmse_batch は複数銘柄をまとめて解く。
+長さの近い銘柄を1つのグループにし、グループごとに正規方程式 (X'X) b = X'y を
+一括の solve で解く (1銘柄ずつ lstsq を呼ぶループをなくす)。
+X'X の条件数が AR_BATCH_MAX_COND を超える銘柄 (値が一定の区間が長いなど) は
+正規方程式では精度が落ちるので、1銘柄ずつ lstsq で解き直す。
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+AR_MIN_EXTRA_POINTS = 5
+
+# 一括ARのグループ: 説明変数の配列の上限バイト数と、
+# グループ内の最長 / 最短 の上限 (0で埋める無駄を抑える)
+AR_BATCH_MAX_BYTES = 64 * 1024 * 1024
+AR_BATCH_MAX_PAD = 1.25
+AR_BATCH_MAX_COND = 1e10
+
+
+def make_log_returns(price_df):
+    """
+    price_df に "return" (対数収益率) 列を足し、計算できない行を落とす。
+    価格が0以下の行の次の行も落ちる。
+    """
+    prices = price_df["price"].astype(float)
+
+    prices = prices.replace([np.inf, -np.inf], np.nan)
+    prices = prices.where(prices > 0)
+    log_price = np.log(prices)
+
+    returns = log_price.diff()
+
+    out = price_df.copy()
+    out["return"] = returns
+
+    out = out.replace([np.inf, -np.inf], np.nan)
+    out = out.dropna(subset=["return"])
+    out = out.reset_index(drop=True)
+
+    return out
+
+
+def ar_design(x, lags):
+    """
+    説明変数 [1, x[t-1], ..., x[t-lags]] と目的変数 x[t] (t = lags, ..., n - 1)。
+    ラグ行列は sliding_window_view で作る (コピーは説明変数への代入の1回だけ)。
+    """
+    windows = sliding_window_view(x, lags + 1)
+
+    design = np.empty((len(windows), lags + 1))
+    design[:, 0] = 1.0
+    design[:, 1:] = windows[:, lags - 1::-1]
+
+    return design, windows[:, lags]
+
+
+def can_fit_ar(x, lags, min_extra_points=AR_MIN_EXTRA_POINTS):
+    return len(x) > lags + min_extra_points and bool(np.all(np.isfinite(x)))
+
+
+def apply_ar_returns_in_sample(returns, lags=5, min_extra_points=AR_MIN_EXTRA_POINTS):
+    """
+    AR(lags) (定数項つき) を最小二乗で当てはめ、in-sample の残差と RMSE を返す。
+    残差の長さは len(returns) - lags。
+    データが lags + min_extra_points 以下なら (空配列, nan)。
+    """
+    x = np.asarray(returns, dtype=np.float64)
+    n = len(x)
+
+    if not can_fit_ar(x, lags, min_extra_points):
+        return np.empty(0), np.nan
+
+    design, target = ar_design(x, lags)
+
+    coef, *_ = np.linalg.lstsq(design, target, rcond=None)
+    resid = target - design @ coef
+
+    return resid, float(np.sqrt(np.mean(resid ** 2)))
+
+
+def fit_ar_rmse(returns, lags=5):
+    return apply_ar_returns_in_sample(returns, lags=lags)[1]
+
+
+def ar_batch_groups(lengths, max_bytes=AR_BATCH_MAX_BYTES, max_pad=AR_BATCH_MAX_PAD):
+    """銘柄の番号を長さ順に並べ、一括で解くグループに分ける"""
+    groups = []
+    group = []
+
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if group:
+            # 0で埋めた (銘柄数 × 最長) の returns と重みの2つ分
+            size = (len(group) + 1) * lengths[i] * 8 * 2
+
+            if lengths[i] > lengths[group[0]] * max_pad or size > max_bytes:
+                groups.append(group)
+                group = []
+
+        group.append(i)
+
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+def fit_ar_rmse_batch(returns_list, lags=5, min_extra_points=AR_MIN_EXTRA_POINTS):
+    """
+    複数銘柄の AR(lags) の RMSE をまとめて求める (fit_ar_rmse と同じ値)。
+    戻り値は returns_list と同じ順の配列。当てはめられない銘柄は nan。
+
+    グループごとに returns を (銘柄数 × 最長) に0で埋め、sliding_window_view の
+    (銘柄数 × 窓 × (lags + 1)) のビュー W から、有効な窓だけの W'W と列和を
+    einsum で一度に求める (説明変数の行列は作らない)。
+    W'W には X'X・X'y・y'y がすべて入っているので、正規方程式を一括で解き、
+    残差平方和は y'y - b'X'y で求める。
+    """
+    xs = [np.asarray(x, dtype=np.float64) for x in returns_list]
+    rmse = np.full(len(xs), np.nan)
+
+    valid = [i for i, x in enumerate(xs) if can_fit_ar(x, lags, min_extra_points)]
+
+    for group in ar_batch_groups([len(xs[i]) for i in valid]):
+        members = [valid[g] for g in group]
+        lengths = np.array([len(xs[i]) for i in members])
+        counts = lengths - lags
+
+        padded = np.zeros((len(members), lengths.max()))
+        for b, i in enumerate(members):
+            padded[b, :lengths[b]] = xs[i]
+
+        # windows[b, t] = [x[t], ..., x[t + lags]] (最後の列が目的変数)
+        windows = sliding_window_view(padded, lags + 1, axis=1)
+        weight = (np.arange(windows.shape[1])[None, :] < counts[:, None]).astype(np.float64)
+
+        cross = np.einsum("btk,btl,bt->bkl", windows, windows, weight, optimize=True)
+        sums = np.einsum("btk,bt->bk", windows, weight)
+
+        # 説明変数 [1, x[t], ..., x[t + lags - 1]] の正規方程式
+        gram = np.empty((len(members), lags + 1, lags + 1))
+        gram[:, 0, 0] = counts
+        gram[:, 0, 1:] = sums[:, :lags]
+        gram[:, 1:, 0] = sums[:, :lags]
+        gram[:, 1:, 1:] = cross[:, :lags, :lags]
+
+        rhs = np.concatenate([sums[:, lags:], cross[:, :lags, lags]], axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ok = np.linalg.cond(gram) < AR_BATCH_MAX_COND
+
+        # 条件数の悪い銘柄は単位行列に置き換えて一緒に解き、あとで lstsq で解き直す
+        gram[~ok] = np.eye(lags + 1)
+        coef = np.linalg.solve(gram, rhs[..., None])[..., 0]
+
+        ssr = cross[:, lags, lags] - np.einsum("bk,bk->b", coef, rhs)
+        rmse[members] = np.sqrt(np.maximum(ssr, 0.0) / counts)
+
+        for b in np.flatnonzero(~ok):
+            rmse[members[b]] = fit_ar_rmse(xs[members[b]], lags=lags)
+
+    return rmse
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+HTTPレスポンスのディスクキャッシュ (CoinGecko 取得スクリプト用)
+requests.Session に mount するアダプター (CachingAdapter) と、
+aiohttp など requests 以外からも使えるキャッシュ本体 (ResponseCache) からなる。
+
+- キーは GET の URL (クエリ込み)。200 のレスポンスだけを保存する
+- 保存は1件につき meta (JSON) と本文 (gzip) の2ファイル。一時ファイル経由で置き換える
+- エンドポイントごとの TTL (秒) の間は通信せずに保存した本文を返す
+- TTL を過ぎたら ETag / Last-Modified があれば If-None-Match / If-Modified-Since を付けて
+  問い合わせ、304 なら保存した本文をそのまま返す (本文は転送されない)
+- offline=True のときは一切通信せず、TTL に関係なく保存した本文を返す。
+  保存されていなければ CacheMiss (リトライしても変わらないので requests の例外にはしない)。
+  ある実行で保存した内容で、その実行をそのまま再現するためのモード。
+- TTL が None のエンドポイントは保存しない。market_chart/range は to (現在時刻) が毎回変わり、
+  保存しても再利用・再検証・オフラインでの再現のどれにも使えないため
+
+    session.mount("https://", CachingAdapter(ResponseCache(cache_dir, ttls=DEFAULT_TTLS)))
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+# URLのパスに対する正規表現 → TTL (秒)。上から順に最初に一致したものを使う。
+# None は保存しない (キーが毎回変わるリクエスト)
+DEFAULT_TTLS = [
+    (r"/coins/list$", 24 * 3600),
+    (r"/market_chart/range$", None),
+    (r"/market_chart$", 3600),
+    (r"/coins/markets$", 0),
+]
+DEFAULT_TTL = 0
+
+# レスポンスのヘッダーのうち保存するもの
+KEEP_HEADERS = ["Content-Type", "ETag", "Last-Modified", "Date", "Cache-Control"]
+
+
+class CacheMiss(RuntimeError):
+    """オフラインでキャッシュにないリクエスト"""
+
+
+def request_url(url, params=None):
+    """requests と同じ規則でクエリを付けた URL (キャッシュのキー)"""
+    return requests.Request("GET", url, params=params).prepare().url
+
+
+class ResponseCache:
+    def __init__(self, cache_dir, ttls=None, default_ttl=DEFAULT_TTL, offline=False):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttls = [(re.compile(p), ttl) for p, ttl in (DEFAULT_TTLS if ttls is None else ttls)]
+        self.default_ttl = default_ttl
+        self.offline = offline
+
+        self.stats = {"fresh": 0, "revalidated": 0, "stored": 0, "miss": 0}
+
+    def ttl(self, url):
+        path = requests.utils.urlparse(url).path
+
+        for pattern, ttl in self.ttls:
+            if pattern.search(path):
+                return ttl
+
+        return self.default_ttl
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        sub = self.cache_dir / key[:2]
+        return sub / f"{key}.json", sub / f"{key}.body.gz"
+
+    # -----------------------------------------------------
+    # 読み書き
+    # -----------------------------------------------------
+
+    def load(self, url):
+        """(meta, body) を返す。なければ (None, None)"""
+        meta_path, body_path = self.paths(url)
+
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            with gzip.open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+
+        return meta, body
+
+    def store(self, url, status, headers, body):
+        if self.ttl(url) is None:
+            return
+
+        meta_path, body_path = self.paths(url)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+
+        meta = {
+            "url": url,
+            "status": status,
+            "headers": {k: headers[k] for k in KEEP_HEADERS if k in headers},
+            "stored_at": time.time(),
+        }
+
+        # 本文 → meta の順に置き換える (meta があれば本文は必ずそろっている)
+        tmp_path = body_path.with_name(body_path.name + ".tmp")
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, body_path)
+
+        self.write_meta(meta_path, meta)
+        self.stats["stored"] += 1
+
+    def touch(self, url, meta, headers=None):
+        """304 のとき: 保存時刻を更新し、新しい ETag / Last-Modified があれば差し替える"""
+        meta["stored_at"] = time.time()
+
+        for k in KEEP_HEADERS:
+            if headers is not None and k in headers:
+                meta["headers"][k] = headers[k]
+
+        self.write_meta(self.paths(url)[0], meta)
+        self.stats["revalidated"] += 1
+
+    def write_meta(self, meta_path, meta):
+        tmp_path = meta_path.with_name(meta_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, meta_path)
+
+    # -----------------------------------------------------
+    # 判定
+    # -----------------------------------------------------
+
+    def lookup(self, url):
+        """
+        通信せずに返せるなら (meta, body)、問い合わせが必要なら (meta, None)
+        (meta は条件付きリクエスト用。保存されていなければ None)。
+        オフラインで保存されていなければ CacheMiss。
+        """
+        if self.ttl(url) is None:
+            if self.offline:
+                self.stats["miss"] += 1
+                raise CacheMiss(f"オフライン: キャッシュしないリクエストです: {url}")
+            return None, None
+
+        meta, body = self.load(url)
+
+        if meta is None:
+            if self.offline:
+                self.stats["miss"] += 1
+                raise CacheMiss(f"オフライン: キャッシュにありません: {url}")
+            return None, None
+
+        if self.offline or time.time() - meta["stored_at"] < self.ttl(url):
+            self.stats["fresh"] += 1
+            return meta, body
+
+        return meta, None
+
+    def conditional_headers(self, meta):
+        headers = {}
+
+        if meta is None:
+            return headers
+
+        if "ETag" in meta["headers"]:
+            headers["If-None-Match"] = meta["headers"]["ETag"]
+        if "Last-Modified" in meta["headers"]:
+            headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+
+        return headers
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    ResponseCache を通す requests のアダプター。
+    キャッシュから返したレスポンスには from_cache = True を付ける。
+    """
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        url = request.url
+        meta, body = self.cache.lookup(url)
+
+        if body is not None:
+            return self.cached_response(request, meta, body)
+
+        request.headers.update(self.cache.conditional_headers(meta))
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and meta is not None:
+            self.cache.touch(url, meta, response.headers)
+            _, body = self.cache.load(url)
+            return self.cached_response(request, meta, body)
+
+        if response.status_code == 200:
+            self.cache.store(url, 200, response.headers, response.content)
+
+        response.from_cache = False
+        return response
+
+    def cached_response(self, request, meta, body):
+        response = requests.Response()
+        response.status_code = meta["status"]
+        response.headers = CaseInsensitiveDict(meta["headers"])
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.reason = "OK"
+        response.from_cache = True
+        return response
+
+
+def install(session, cache):
+    """session の http / https に CachingAdapter を付ける"""
+    adapter = CachingAdapter(cache)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return adapter
@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+"""
+銘柄ごとの価格の列指向ストア (CSV を1銘柄1ファイルで持つ代わり)
+coin_id / symbol / name は行ごとに持たず、メタデータの表にまとめる。
+
+    <root>/
+        coins.csv                      メタデータの表 (1銘柄1行、save_metadata で書き直す)
+        series/coin_id=<id>/
+            meta.json                  その銘柄のメタデータ (書き込みの確定点)
+            timestamp_ms.<世代>.npy    int64 (UNIXエポックのミリ秒、昇順・重複なし)
+            price.<世代>.npy           float64
+        snapshots/date=<YYYY-MM-DD>/<エポックミリ秒>/
+            coin_id.npy, last_updated_ms.npy, price.npy, market_cap.npy, total_volume.npy
+                                       /coins/markets の1回分 (全銘柄の断面)。1回ごとに1ディレクトリ
+
+- 列ごとに .npy で持つので np.load(mmap_mode="r") でそのまま読める
+  (read はコピーせずにファイルを写した読み取り専用の NumPy 配列を返す)
+- 書き込みは新しい世代のファイルを作ってから meta.json を置き換え、最後に古い世代を消す。
+  途中で落ちても meta.json が指す世代はそろっている。
+  読込中の古い世代が消せない (Windows で mmap 中など) ときは次の書き込みで消す
+- 同じ timestamp の行は新しい値を優先して1行にする
+- スナップショットは1回分を一時ディレクトリに書いてから名前を変えて追加する。
+  read_snapshots で期間の全行、snapshot_panel で (時刻 × 銘柄) の表にして読む
+- export_csv で coingecko-retrieve-1.py の CSV と同じ形式 (timestamp, price, coin_id, symbol, name) に戻せる
+
+    python price_store.py --store ./coingecko_store --import-csv ./coingecko_by_coin
+    python price_store.py --store ./coingecko_store --export-csv ./coingecko_by_coin_export
+"""
+
+import os
+import re
+import json
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = {
+    "timestamp_ms": np.int64,
+    "price": np.float64,
+}
+
+METADATA_COLUMNS = [
+    "coin_id",
+    "symbol",
+    "name",
+    "rows",
+    "first_timestamp_ms",
+    "last_timestamp_ms",
+    "generation",
+    "updated_at",
+]
+
+METADATA_FILE = "coins.csv"
+SERIES_DIR = "series"
+PARTITION_PREFIX = "coin_id="
+META_FILE = "meta.json"
+
+GENERATION_PATTERN = re.compile(r"^(\w+)\.(\d+)\.npy$")
+
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_COLUMNS = {
+    "coin_id": np.str_,
+    "last_updated_ms": np.int64,
+    "price": np.float64,
+    "market_cap": np.float64,
+    "total_volume": np.float64,
+}
+
+
+def log(msg):
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {msg}", flush=True)
+
+
+def partition_name(coin_id):
+    """coin_id をディレクトリ名に使える形にする (元の coin_id は meta.json に持つ)"""
+    text = re.sub(r'[\\/:*?"<>|\s]', "_", str(coin_id).strip())
+    return PARTITION_PREFIX + (text[:120] or "unknown")
+
+
+def to_epoch_ms(values):
+    """datetime / 数値の配列を int64 のエポックミリ秒にする"""
+    values = np.asarray(values)
+
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[ms]").astype(np.int64)
+
+    return values.astype(np.int64)
+
+
+def sort_unique(timestamp_ms, price):
+    """timestamp の昇順に並べ、同じ timestamp は後ろの値 (新しい値) を残す"""
+    if len(timestamp_ms) == 0:
+        return timestamp_ms, price
+
+    order = np.argsort(timestamp_ms, kind="stable")
+    timestamp_ms = timestamp_ms[order]
+    price = price[order]
+
+    keep = np.append(timestamp_ms[1:] != timestamp_ms[:-1], True)
+    return timestamp_ms[keep], price[keep]
+
+
+def write_npy(path, arr):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, data):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class PriceStore:
+    def __init__(self, root):
+        self.root = Path(root)
+        self.series_dir = self.root / SERIES_DIR
+        self.series_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshot_dir = self.root / SNAPSHOT_DIR
+
+    def coin_dir(self, coin_id):
+        return self.series_dir / partition_name(coin_id)
+
+    def column_path(self, coin_id, column, generation):
+        return self.coin_dir(coin_id) / f"{column}.{generation}.npy"
+
+    # -----------------------------------------------------
+    # メタデータ
+    # -----------------------------------------------------
+
+    def meta(self, coin_id):
+        """銘柄の meta.json の中身。なければ None"""
+        try:
+            with open(self.coin_dir(coin_id) / META_FILE, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def iter_meta(self):
+        for path in sorted(self.series_dir.glob(f"{PARTITION_PREFIX}*/{META_FILE}")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def metadata(self):
+        """全銘柄のメタデータの表 (meta.json から作る)"""
+        return pd.DataFrame(list(self.iter_meta()), columns=METADATA_COLUMNS)
+
+    def coin_ids(self):
+        return [m["coin_id"] for m in self.iter_meta()]
+
+    def save_metadata(self):
+        """メタデータの表を coins.csv に書き出す (一時ファイル経由で置き換え)"""
+        path = self.root / METADATA_FILE
+        tmp_path = path.with_name(path.name + ".tmp")
+
+        table = self.metadata()
+        table.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+        os.replace(tmp_path, path)
+
+        return path, len(table)
+
+    def nbytes(self, coin_id):
+        """今の世代のファイルの合計サイズ"""
+        meta = self.meta(coin_id)
+        if meta is None or meta["rows"] == 0:
+            return 0
+
+        return sum(
+            self.column_path(coin_id, c, meta["generation"]).stat().st_size for c in COLUMNS
+        )
+
+    # -----------------------------------------------------
+    # 読込
+    # -----------------------------------------------------
+
+    def read(self, coin_id, mmap=True):
+        """
+        {"timestamp_ms", "price"} の配列を返す。なければ None。
+        mmap=True ならファイルを写した読み取り専用の配列 (コピーしない)。
+        """
+        meta = self.meta(coin_id)
+        if meta is None:
+            return None
+
+        # 長さ0の配列は mmap できない
+        if meta["rows"] == 0:
+            return {c: np.empty(0, dtype=dtype) for c, dtype in COLUMNS.items()}
+
+        return {
+            c: np.load(
+                self.column_path(coin_id, c, meta["generation"]),
+                mmap_mode="r" if mmap else None,
+                allow_pickle=False,
+            )
+            for c in COLUMNS
+        }
+
+    def last_timestamp(self, coin_id):
+        """最後の行の timestamp (pd.Timestamp)。なければ None"""
+        meta = self.meta(coin_id)
+        if meta is None or meta["rows"] == 0:
+            return None
+
+        return pd.Timestamp(meta["last_timestamp_ms"], unit="ms")
+
+    def read_frame(self, coin_id):
+        """
+        coingecko-retrieve-1.py の CSV と同じ列 (timestamp, price, coin_id, symbol, name) の DataFrame。
+        なければ None。
+        """
+        meta = self.meta(coin_id)
+        data = self.read(coin_id, mmap=False)
+        if data is None:
+            return None
+
+        df = pd.DataFrame({
+            "timestamp": pd.to_datetime(data["timestamp_ms"], unit="ms"),
+            "price": data["price"],
+        })
+        df["coin_id"] = meta["coin_id"]
+        df["symbol"] = meta["symbol"]
+        df["name"] = meta["name"]
+
+        return df
+
+    # -----------------------------------------------------
+    # 書き込み
+    # -----------------------------------------------------
+
+    def write(self, coin_id, timestamp, price, symbol=None, name=None, merge=True):
+        """
+        1銘柄の行を書く。timestamp は datetime かエポックミリ秒の配列。
+        merge=True なら既存の行と合わせ (同じ timestamp は新しい値)、False なら置き換える。
+        symbol / name を省略すると既存のメタデータの値を使う。
+        戻り値は (全体の行数, 増えた行数)。
+        """
+        timestamp_ms = to_epoch_ms(timestamp)
+        price = np.asarray(price, dtype=np.float64)
+
+        if len(timestamp_ms) != len(price):
+            raise ValueError(f"timestamp と price の長さが違います: {len(timestamp_ms)} != {len(price)}")
+
+        old_meta = self.meta(coin_id)
+        old_rows = 0 if old_meta is None else old_meta["rows"]
+
+        # 足す行がなければ書き直さない
+        if merge and old_meta is not None and len(timestamp_ms) == 0:
+            return old_rows, 0
+
+        if merge and old_rows > 0:
+            old = self.read(coin_id, mmap=False)
+            timestamp_ms = np.concatenate([old["timestamp_ms"], timestamp_ms])
+            price = np.concatenate([old["price"], price])
+
+        timestamp_ms, price = sort_unique(timestamp_ms, price)
+
+        generation = 1 if old_meta is None else old_meta["generation"] + 1
+        coin_dir = self.coin_dir(coin_id)
+        coin_dir.mkdir(parents=True, exist_ok=True)
+
+        write_npy(self.column_path(coin_id, "timestamp_ms", generation), timestamp_ms)
+        write_npy(self.column_path(coin_id, "price", generation), price)
+
+        meta = {
+            "coin_id": str(coin_id),
+            "symbol": str(symbol) if symbol is not None else (old_meta or {}).get("symbol", ""),
+            "name": str(name) if name is not None else (old_meta or {}).get("name", ""),
+            "rows": int(len(timestamp_ms)),
+            "first_timestamp_ms": int(timestamp_ms[0]) if len(timestamp_ms) else None,
+            "last_timestamp_ms": int(timestamp_ms[-1]) if len(timestamp_ms) else None,
+            "generation": generation,
+            "updated_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        write_json(coin_dir / META_FILE, meta)
+
+        self.remove_old_generations(coin_id, generation)
+
+        return len(timestamp_ms), len(timestamp_ms) - old_rows
+
+    def write_frame(self, df, coin_id, symbol=None, name=None, merge=True):
+        """timestamp / price 列の DataFrame を書く (market_chart_to_df の戻り値など)"""
+        return self.write(
+            coin_id,
+            df["timestamp"].to_numpy(),
+            df["price"].to_numpy(dtype=np.float64),
+            symbol=symbol,
+            name=name,
+            merge=merge,
+        )
+
+    def register(self, coin_id, symbol, name):
+        """
+        行のない銘柄をメタデータに加える (スナップショットだけの銘柄の symbol / name を持つため)。
+        すでにある銘柄は何もしない。加えたら True
+        """
+        if (self.coin_dir(coin_id) / META_FILE).exists():
+            return False
+
+        self.coin_dir(coin_id).mkdir(parents=True, exist_ok=True)
+        write_json(self.coin_dir(coin_id) / META_FILE, {
+            "coin_id": str(coin_id),
+            "symbol": str(symbol),
+            "name": str(name),
+            "rows": 0,
+            "first_timestamp_ms": None,
+            "last_timestamp_ms": None,
+            "generation": 0,
+            "updated_at": datetime.now().isoformat(timespec="seconds"),
+        })
+
+        return True
+
+    def remove_old_generations(self, coin_id, generation):
+        for path in self.coin_dir(coin_id).glob("*.npy"):
+            m = GENERATION_PATTERN.match(path.name)
+            if m is None or int(m.group(2)) == generation:
+                continue
+
+            try:
+                path.unlink()
+            except OSError:
+                # mmap で開かれている (Windows) など。次の書き込みで消す
+                pass
+
+    # -----------------------------------------------------
+    # スナップショット (全銘柄の断面)
+    # -----------------------------------------------------
+
+    def write_snapshot(self, timestamp, data):
+        """
+        1回分のスナップショットを追加する。timestamp は取得時刻 (datetime かエポックミリ秒)、
+        data は SNAPSHOT_COLUMNS の列の配列の dict。戻り値は書いたディレクトリ。
+        """
+        timestamp_ms = int(to_epoch_ms([timestamp])[0])
+        day = pd.Timestamp(timestamp_ms, unit="ms").strftime("%Y-%m-%d")
+        n = len(data["coin_id"])
+
+        out_dir = self.snapshot_dir / f"date={day}" / str(timestamp_ms)
+        tmp_dir = out_dir.with_name(f".{out_dir.name}.tmp")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        for c, dtype in SNAPSHOT_COLUMNS.items():
+            arr = np.asarray(data[c]).astype(dtype)
+            if len(arr) != n:
+                raise ValueError(f"{c} の長さが違います: {len(arr)} != {n}")
+            write_npy(tmp_dir / f"{c}.npy", arr)
+
+        # 同じ時刻の分があれば置き換える
+        if out_dir.exists():
+            for path in out_dir.glob("*.npy"):
+                path.unlink()
+            out_dir.rmdir()
+
+        os.replace(tmp_dir, out_dir)
+
+        return out_dir
+
+    def snapshot_dirs(self, start=None, end=None):
+        """start <= 取得時刻 < end のスナップショットのディレクトリ (古い順)"""
+        start_ms = None if start is None else pd.Timestamp(start).value // 1_000_000
+        end_ms = None if end is None else pd.Timestamp(end).value // 1_000_000
+
+        dirs = []
+
+        for path in self.snapshot_dir.glob("date=*/*"):
+            if not path.is_dir() or not path.name.isdigit():
+                continue
+
+            timestamp_ms = int(path.name)
+            if start_ms is not None and timestamp_ms < start_ms:
+                continue
+            if end_ms is not None and timestamp_ms >= end_ms:
+                continue
+
+            dirs.append((timestamp_ms, path))
+
+        return sorted(dirs)
+
+    def read_snapshot(self, path, mmap=True):
+        """1回分の列の配列の dict (mmap=True ならコピーしない)"""
+        return {
+            c: np.load(path / f"{c}.npy", mmap_mode="r" if mmap else None, allow_pickle=False)
+            for c in SNAPSHOT_COLUMNS
+        }
+
+    def read_snapshots(self, start=None, end=None):
+        """
+        期間のスナップショットを縦につないだ DataFrame
+        (列は timestamp, coin_id, last_updated, price, market_cap, total_volume)。
+        """
+        parts = []
+
+        for timestamp_ms, path in self.snapshot_dirs(start, end):
+            data = self.read_snapshot(path, mmap=False)
+            data["timestamp_ms"] = np.full(len(data["coin_id"]), timestamp_ms, dtype=np.int64)
+            parts.append(data)
+
+        columns = ["timestamp_ms"] + list(SNAPSHOT_COLUMNS)
+        merged = {
+            c: np.concatenate([p[c] for p in parts]) if parts else np.empty(0, dtype=np.int64)
+            for c in columns
+        }
+
+        df = pd.DataFrame({
+            "timestamp": merged["timestamp_ms"].astype("datetime64[ms]"),
+            "coin_id": merged["coin_id"].astype(str),
+            # last_updated がなかった銘柄は NaT (int64 の最小値) で入っている
+            "last_updated": merged["last_updated_ms"].astype("datetime64[ms]"),
+            "price": merged["price"],
+            "market_cap": merged["market_cap"],
+            "total_volume": merged["total_volume"],
+        })
+
+        return df
+
+    def snapshot_panel(self, column="price", start=None, end=None):
+        """(取得時刻 × 銘柄) の表。その回に含まれない銘柄は NaN"""
+        df = self.read_snapshots(start, end)
+        return df.pivot_table(index="timestamp", columns="coin_id", values=column, aggfunc="last", dropna=False)
+
+    # -----------------------------------------------------
+    # CSV との変換
+    # -----------------------------------------------------
+
+    def export_csv(self, coin_id, path):
+        """1銘柄を utf-8-sig の CSV に書き出す (一時ファイル経由で置き換え)"""
+        df = self.read_frame(coin_id)
+        if df is None:
+            raise KeyError(f"ストアにない銘柄です: {coin_id}")
+
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+        os.replace(tmp_path, path)
+
+        return len(df)
+
+    def import_csv(self, path, merge=True):
+        """coingecko-retrieve-1.py / coingecko_10.py の CSV を1つ取り込む。戻り値は (coin_id, 行数)"""
+        df = pd.read_csv(path, encoding="utf-8-sig", parse_dates=["timestamp"])
+        df = df.dropna(subset=["timestamp", "price"])
+
+        if df.empty:
+            raise ValueError("価格データがありません")
+
+        first = df.iloc[0]
+        coin_id = str(first["coin_id"])
+        n_rows, _ = self.write_frame(
+            df, coin_id, symbol=first.get("symbol"), name=first.get("name"), merge=merge
+        )
+
+        return coin_id, n_rows
+
+
+def csv_file_name(meta):
+    """coingecko-retrieve-1.py の coin_csv_path と同じ形のファイル名"""
+    def safe(text):
+        text = str(text).strip().lower()
+        text = re.sub(r'[\\/:*?"<>|]', "_", text)
+        text = re.sub(r"\s+", "_", text)
+        text = re.sub(r"_+", "_", text)
+        text = text.strip("._")
+        return text[:120] if text else "unknown"
+
+    return f"{safe(meta['coin_id'])}_{safe(meta['symbol'])}.csv"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="列指向の価格ストアと CSV の変換")
+    parser.add_argument("--store", type=Path, required=True, help="ストアのディレクトリ")
+    parser.add_argument("--import-csv", type=Path, default=None, help="このフォルダの *.csv を取り込む")
+    parser.add_argument("--export-csv", type=Path, default=None, help="全銘柄をこのフォルダに CSV で書き出す")
+    parser.add_argument("--pattern", default="*.csv", help="--import-csv で読むファイル")
+    opts = parser.parse_args(argv)
+
+    store = PriceStore(opts.store)
+
+    if opts.import_csv is not None:
+        paths = sorted(
+            p for p in opts.import_csv.glob(opts.pattern)
+            if not p.name.startswith(("summary_", "failed_", "empty_"))
+        )
+        n_ok = 0
+
+        for i, path in enumerate(paths, start=1):
+            try:
+                coin_id, n_rows = store.import_csv(path)
+                n_ok += 1
+            except Exception as e:
+                log(f"[{i}/{len(paths)}] {path.name}: 取込失敗: {e}")
+                continue
+
+            if i % 100 == 0 or i == len(paths):
+                log(f"[{i}/{len(paths)}] 取込: {coin_id} ({n_rows}行)")
+
+        log(f"取込完了: {n_ok} / {len(paths)} ファイル")
+
+    if opts.export_csv is not None:
+        opts.export_csv.mkdir(parents=True, exist_ok=True)
+        # スナップショットだけの銘柄 (行なし) は書き出さない
+        metas = [m for m in store.iter_meta() if m["rows"] > 0]
+
+        for meta in metas:
+            store.export_csv(meta["coin_id"], opts.export_csv / csv_file_name(meta))
+
+        log(f"書き出し完了: {len(metas)} 銘柄 → {opts.export_csv.resolve()}")
+
+    path, n_coins = store.save_metadata()
+    log(f"メタデータ: {path} ({n_coins} 銘柄)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+進捗表示とメトリクス
+ファイルごとの log() 行の代わりに、1行の進捗表示を上書き更新し、
+一定間隔でメトリクスを JSON Lines に追記する。
+
+- ステージ (load / ar / cp など) ごとに 完了数 / 総数、files/s、points/s を数える
+- フェーズ (load / ar / downsample / cp / write) ごとの累計時間を持つ
+  (並列実行ではワーカー側で測った時間の合計)
+- 端末でなければ (リダイレクト時など) 上書きせず、一定間隔で1行ずつ出す
+
+メトリクスの1行の例:
+{"event": "progress", "stage": "cp", "done": 120, "total": 25000,
+ "files_per_sec": 14.2, "points_per_sec": 28000.0, "phase_sec": {"cp": 7.9}, ...}
+"""
+
+import sys
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def format_rate(x):
+    return f"{x:,.1f}" if x < 100 else f"{x:,.0f}"
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    def __init__(
+        self,
+        metrics_path=None,
+        run_id="",
+        echo=print,
+        refresh_sec=0.5,
+        metrics_sec=10.0,
+        plain_sec=30.0,
+        stream=None,
+    ):
+        self.metrics_path = metrics_path
+        self.run_id = run_id
+        self.echo = echo
+        self.refresh_sec = refresh_sec
+        self.metrics_sec = metrics_sec
+        self.plain_sec = plain_sec
+        self.stream = stream or sys.stdout
+        self.is_tty = self.stream.isatty()
+
+        self.start = time.perf_counter()
+        self.phase_sec = {}
+
+        self.metrics_file = None
+        if metrics_path is not None:
+            self.metrics_file = open(metrics_path, "a", encoding="utf-8")
+
+        self.stage = None
+        self.line_len = 0
+        self.last_refresh = 0.0
+        self.last_metrics = time.perf_counter()
+        self.last_plain = time.perf_counter()
+
+    # -----------------------------------------------------
+    # ステージ
+    # -----------------------------------------------------
+
+    def start_stage(self, name, total):
+        if self.stage is not None:
+            self.end_stage()
+
+        self.stage = {
+            "name": name,
+            "total": int(total),
+            "done": 0,
+            "points": 0,
+            "counts": {},
+            "label": "",
+            "start": time.perf_counter(),
+        }
+        self.refresh(force=True)
+
+    def end_stage(self):
+        if self.stage is None:
+            return
+
+        self.refresh(force=True)
+        self.clear_line()
+        self.echo(self.status_text())
+        self.dump_metrics("stage_end")
+        self.stage = None
+
+    def advance(self, n=1, points=0, label=None, **counts):
+        """
+        完了数を n 進める。counts は change_points=3, errors=1 のような累計カウンタ。
+        """
+        st = self.stage
+        st["done"] += n
+        st["points"] += int(points)
+
+        if label is not None:
+            st["label"] = label
+
+        for key, value in counts.items():
+            st["counts"][key] = st["counts"].get(key, 0) + value
+
+        self.refresh()
+
+    def add_phase(self, phase, seconds):
+        self.phase_sec[phase] = self.phase_sec.get(phase, 0.0) + float(seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.perf_counter() - t0)
+
+    # -----------------------------------------------------
+    # 表示
+    # -----------------------------------------------------
+
+    def rates(self):
+        st = self.stage
+        elapsed = max(time.perf_counter() - st["start"], 1e-9)
+        return st["done"] / elapsed, st["points"] / elapsed
+
+    def status_text(self):
+        st = self.stage
+        files_per_sec, points_per_sec = self.rates()
+        pct = st["done"] / st["total"] * 100 if st["total"] else 100.0
+
+        parts = [f"[{st['name']}] {st['done']}/{st['total']} ({pct:.1f}%)"]
+
+        if st["label"]:
+            parts.append(st["label"])
+
+        parts.append(f"{format_rate(files_per_sec)} files/s")
+
+        if st["points"]:
+            parts.append(f"{format_rate(points_per_sec)} points/s")
+
+        for key, value in st["counts"].items():
+            parts.append(f"{key}={value}")
+
+        if 0 < st["done"] < st["total"] and files_per_sec > 0:
+            parts.append(f"ETA {format_eta((st['total'] - st['done']) / files_per_sec)}")
+
+        return " | ".join(parts)
+
+    def refresh(self, force=False):
+        if self.stage is None:
+            return
+
+        now = time.perf_counter()
+
+        if self.is_tty and (force or now - self.last_refresh >= self.refresh_sec):
+            text = self.status_text()
+            pad = max(self.line_len - len(text), 0)
+            self.stream.write("\r" + text + " " * pad)
+            self.stream.flush()
+            self.line_len = len(text)
+            self.last_refresh = now
+
+        if not self.is_tty and now - self.last_plain >= self.plain_sec:
+            self.echo(self.status_text())
+            self.last_plain = now
+
+        if now - self.last_metrics >= self.metrics_sec:
+            self.dump_metrics()
+
+    def clear_line(self):
+        if self.is_tty and self.line_len:
+            self.stream.write("\r" + " " * self.line_len + "\r")
+            self.stream.flush()
+            self.line_len = 0
+
+    def write(self, msg):
+        """進捗行を消してから通常のログを1行出す"""
+        self.clear_line()
+        self.echo(msg)
+        self.refresh(force=True)
+
+    # -----------------------------------------------------
+    # メトリクス
+    # -----------------------------------------------------
+
+    def metrics(self, event="progress"):
+        row = {
+            "event": event,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "run_id": self.run_id,
+            "elapsed_sec": round(time.perf_counter() - self.start, 3),
+            "phase_sec": {k: round(v, 3) for k, v in self.phase_sec.items()},
+        }
+
+        if self.stage is not None:
+            files_per_sec, points_per_sec = self.rates()
+            row.update({
+                "stage": self.stage["name"],
+                "label": self.stage["label"],
+                "done": self.stage["done"],
+                "total": self.stage["total"],
+                "points": self.stage["points"],
+                "files_per_sec": round(files_per_sec, 3),
+                "points_per_sec": round(points_per_sec, 3),
+                **self.stage["counts"],
+            })
+
+        return row
+
+    def dump_metrics(self, event="progress"):
+        self.last_metrics = time.perf_counter()
+
+        if self.metrics_file is None:
+            return
+
+        self.metrics_file.write(json.dumps(self.metrics(event), ensure_ascii=False) + "\n")
+        self.metrics_file.flush()
+
+    def close(self):
+        self.end_stage()
+        self.dump_metrics("end")
+
+        if self.metrics_file is not None:
+            self.metrics_file.close()
+            self.metrics_file = None
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+変化点検知の結果ストア (SQLite)
+(method, model, file) の1単位ごとの summary / pairs 行を1つのDBファイルに追記する。
+
+- 1単位を1トランザクションで書き込むので、途中で落ちても半端な単位は残らない
+  (チェックポイント。WAL なのでプロセスが落ちても書き込み済みの単位は消えない)
+- units テーブルに完了した単位を記録し、同じ run_id で再開するときはそれをスキップする
+- 日別変化点数・組み合わせ別集計は SQL で DB から直接求める
+- 統合CSVは DB から分割して読み出して書く (全行をメモリに持たない)。
+  列の型は SUMMARY_COLUMNS / PAIR_COLUMNS ごとに固定し、チャンクによって 3 / 3.0 のように書式が揺れないようにする
+- 日時は固定書式 (DATETIME_FORMAT) の文字列で保存する
+
+複数の run_id を同じDBに入れられる。
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+SUMMARY_COLUMNS = [
+    "run_id",
+    "method",
+    "model",
+    "symbol",
+    "file_name",
+    "rows",
+    "returns",
+    "start_datetime",
+    "end_datetime",
+    "min_price",
+    "max_price",
+    "last_price",
+    "rmse",
+    "change_point_count",
+    "cp_datetimes",
+    "cp_indices_original",
+    "cp_strengths",
+    "status",
+    "error",
+]
+
+PAIR_COLUMNS = [
+    "run_id",
+    "method",
+    "model",
+    "symbol",
+    "file_name",
+    "cp_index_downsampled",
+    "cp_index_original",
+    "cp_datetime",
+    "cp_strength",
+    "rows",
+    "returns",
+    "rmse",
+]
+
+DATETIME_COLUMNS = ["start_datetime", "end_datetime", "cp_datetime"]
+INTEGER_COLUMNS = ["rows", "returns", "change_point_count", "cp_index_downsampled", "cp_index_original"]
+FLOAT_COLUMNS = ["min_price", "max_price", "last_price", "rmse", "cp_strength"]
+
+# 保存する日時の書式 (タイムゾーンつきは UTC にそろえてから外す)
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+EXPORT_CHUNK_ROWS = 100_000
+
+
+def to_sql_value(v):
+    """numpy / pandas の値を sqlite3 で書ける値にする (NaN は NULL)"""
+    if v is None:
+        return None
+
+    if isinstance(v, (pd.Timestamp, datetime, np.datetime64)):
+        return None if pd.isna(v) else str(pd.Timestamp(v))
+
+    if isinstance(v, (bool, np.bool_)):
+        return int(v)
+
+    if isinstance(v, (int, np.integer)):
+        return int(v)
+
+    if isinstance(v, (float, np.floating)):
+        return None if np.isnan(v) else float(v)
+
+    return v
+
+
+def datetime_values(values):
+    """日時の値の並びを DATETIME_FORMAT の文字列のリストにする (解釈できない値・欠測は NULL)"""
+    dt = pd.to_datetime(pd.Series(list(values), dtype=object), format="ISO8601", errors="coerce", utc=True)
+    text = dt.dt.tz_convert(None).dt.strftime(DATETIME_FORMAT)
+    return [None if pd.isna(x) else x for x in text]
+
+
+def apply_schema(chunk, parse_dates=True):
+    """読み出した DataFrame の列を固定の型にする (整数は欠測ありの Int64)"""
+    for c in chunk.columns:
+        if c in INTEGER_COLUMNS:
+            chunk[c] = pd.to_numeric(chunk[c], errors="coerce").astype("Int64")
+        elif c in FLOAT_COLUMNS:
+            chunk[c] = pd.to_numeric(chunk[c], errors="coerce").astype(np.float64)
+        elif c in DATETIME_COLUMNS and parse_dates:
+            chunk[c] = pd.to_datetime(chunk[c], format="ISO8601", errors="coerce")
+
+    return chunk
+
+
+def column_length(data):
+    """列ごとの配列の dict の行数 (スカラーの列は数えない)"""
+    lengths = [len(v) for v in data.values() if np.ndim(v) > 0]
+    return max(lengths, default=0)
+
+
+def column_values(v, n):
+    """1列分の値を sqlite3 で書ける値のリストにする (スカラーは n 行に広げる)"""
+    if np.ndim(v) == 0:
+        return [to_sql_value(v)] * n
+
+    arr = np.asarray(v)
+
+    if arr.dtype.kind in "iub":
+        return arr.astype(np.int64).tolist()
+
+    if arr.dtype.kind == "f":
+        return [None if x != x else x for x in arr.tolist()]
+
+    if arr.dtype.kind == "M":
+        return [None if pd.isna(x) else str(x) for x in pd.DatetimeIndex(arr)]
+
+    return [to_sql_value(x) for x in arr]
+
+
+class ResultsStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+    def create_tables(self):
+        summary_cols = ", ".join(SUMMARY_COLUMNS)
+        pair_cols = ", ".join(PAIR_COLUMNS)
+
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS summary ({summary_cols})")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS pairs ({pair_cols})")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS units ("
+                "run_id, method, model, file_name, change_points, finished_at, "
+                "PRIMARY KEY (run_id, method, model, file_name))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS summary_run ON summary (run_id, method, model)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS pairs_run ON pairs (run_id, method, model)"
+            )
+
+    def close(self):
+        self.conn.close()
+
+    # -----------------------------------------------------
+    # 書き込み
+    # -----------------------------------------------------
+
+    def write_unit(self, run_id, method, model, file_name, summary_row, pair_columns):
+        """
+        1単位 (method, model, file) の行を書き込み、完了として記録する。
+        pair_columns は pairs の列ごとの配列の dict (スカラーは全行で共通の値)。
+        同じ単位の古い行 (前回途中で落ちた分など) は消してから書く。
+        """
+        key = (run_id, method, model, file_name)
+
+        with self.conn:
+            for table in ["summary", "pairs", "units"]:
+                self.conn.execute(
+                    f"DELETE FROM {table} "
+                    "WHERE run_id = ? AND method = ? AND model = ? AND file_name = ?",
+                    key
+                )
+
+            self.insert_rows("summary", SUMMARY_COLUMNS, [summary_row])
+            self.insert_columns("pairs", PAIR_COLUMNS, pair_columns)
+
+            self.conn.execute(
+                "INSERT INTO units VALUES (?, ?, ?, ?, ?, ?)",
+                key + (column_length(pair_columns), datetime.now().isoformat())
+            )
+
+    def insert_rows(self, table, columns, rows):
+        placeholders = ", ".join("?" for _ in columns)
+
+        self.conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+            (
+                [
+                    datetime_values([row.get(c)])[0] if c in DATETIME_COLUMNS else to_sql_value(row.get(c))
+                    for c in columns
+                ]
+                for row in rows
+            )
+        )
+
+    def insert_columns(self, table, columns, data):
+        """列ごとの配列の dict をまとめて書き込む"""
+        n = column_length(data)
+
+        if n == 0:
+            return
+
+        placeholders = ", ".join("?" for _ in columns)
+
+        values = []
+
+        for c in columns:
+            v = data.get(c)
+            if c in DATETIME_COLUMNS:
+                values.append(datetime_values([v] * n if np.ndim(v) == 0 else v))
+            else:
+                values.append(column_values(v, n))
+
+        self.conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+            zip(*values)
+        )
+
+    # -----------------------------------------------------
+    # 読み出し
+    # -----------------------------------------------------
+
+    def done_units(self, run_id):
+        """完了済みの {(method, model, file_name)}"""
+        cur = self.conn.execute(
+            "SELECT method, model, file_name FROM units WHERE run_id = ?", (run_id,)
+        )
+        return set(cur)
+
+    def count(self, table, run_id):
+        cur = self.conn.execute(f"SELECT COUNT(*) FROM {table} WHERE run_id = ?", (run_id,))
+        return int(cur.fetchone()[0])
+
+    def iter_table(self, table, run_id, chunksize=EXPORT_CHUNK_ROWS, parse_dates=True):
+        """
+        run_id の行を書き込み順に DataFrame の塊で返す。列の型はチャンクによらず同じ。
+        parse_dates=False なら日時は保存した文字列のまま。
+        """
+        columns = SUMMARY_COLUMNS if table == "summary" else PAIR_COLUMNS
+
+        for chunk in pd.read_sql_query(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE run_id = ? ORDER BY rowid",
+            self.conn,
+            params=(run_id,),
+            chunksize=chunksize,
+        ):
+            yield apply_schema(chunk, parse_dates=parse_dates)
+
+    def datetime_width(self, table, column, run_id):
+        """
+        CSVに書く日時の文字数。run_id 全体で秒未満がなければ秒まで (19)、
+        ミリ秒までなら 23、それ以外は 26 (全チャンクで同じ書式にする)。
+        """
+        cur = self.conn.execute(
+            f"""
+            SELECT MAX(
+                CASE
+                    WHEN length({column}) <= 19 OR substr({column}, 21, 6) = '000000' THEN 19
+                    WHEN substr({column}, 24, 3) = '000' THEN 23
+                    ELSE 26
+                END
+            )
+            FROM {table}
+            WHERE run_id = ? AND {column} IS NOT NULL
+            """,
+            (run_id,),
+        )
+        return cur.fetchone()[0] or 19
+
+    def export_csv(self, table, run_id, path):
+        """
+        run_id の行を utf-8-sig のCSVに書き出す (一時ファイル経由で置き換え)。
+        行がなければ列名だけのCSVになる。
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+
+        columns = SUMMARY_COLUMNS if table == "summary" else PAIR_COLUMNS
+        widths = {
+            c: self.datetime_width(table, c, run_id) for c in DATETIME_COLUMNS if c in columns
+        }
+
+        header = True
+
+        with open(tmp_path, "w", encoding="utf-8-sig", newline="") as f:
+            for chunk in self.iter_table(table, run_id, parse_dates=False):
+                for c, width in widths.items():
+                    chunk[c] = chunk[c].str.slice(0, width)
+
+                chunk.to_csv(f, index=False, header=header)
+                header = False
+
+        os.replace(tmp_path, path)
+
+    def agg_summary(self, run_id):
+        """組み合わせ別集計 (method, model ごとのファイル数・変化点数・平均RMSE・省略数)"""
+        agg = pd.read_sql_query(
+            """
+            SELECT
+                method,
+                model,
+                COUNT(file_name) AS files,
+                SUM(status = 'ok') AS ok_files,
+                SUM(status = 'error') AS error_files,
+                SUM(status = 'skipped') AS skipped_files,
+                SUM(change_point_count) AS total_change_points,
+                AVG(rmse) AS mean_rmse
+            FROM summary
+            WHERE run_id = ?
+            GROUP BY method, model
+            ORDER BY method, model
+            """,
+            self.conn,
+            params=(run_id,),
+        )
+
+        agg["mean_rmse"] = agg["mean_rmse"].astype(float)
+
+        return agg.sort_values(
+            ["total_change_points", "mean_rmse"], ascending=[False, True]
+        )
+
+    def daily_counts(self, run_id):
+        """日別変化点数 (cp_datetime を SQLite の date() で日付にした件数。解釈できない日時は数えない)"""
+        daily = pd.read_sql_query(
+            """
+            SELECT
+                date(cp_datetime) AS date,
+                COUNT(*) AS change_point_count
+            FROM pairs
+            WHERE run_id = ? AND date(cp_datetime) IS NOT NULL
+            GROUP BY date
+            ORDER BY date
+            """,
+            self.conn,
+            params=(run_id,),
+        )
+
+        return daily
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+coingecko-retrieve-1.py の差分取得 (--incremental) の確認
+range が新しい価格を返さなかった銘柄 (すでに最新) は、失敗ではなく追加0行の成功として扱う。
+range の細かい足は、既存の間隔の各予定時刻に最も近い行に間引く。
+
+    python -m pytest -q test_coingecko_retrieve.py
+"""
+
+import sys
+import time
+import importlib.util
+from pathlib import Path
+
+import pandas as pd
+
+FINANCE_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(FINANCE_DIR))
+
+spec = importlib.util.spec_from_file_location("coingecko_retrieve", FINANCE_DIR / "coingecko-retrieve-1.py")
+retrieve = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(retrieve)
+
+import price_store  # noqa: E402
+
+
+ROW = {"id": "bitcoin", "symbol": "btc", "name": "Bitcoin"}
+
+
+def existing_frame():
+    return pd.DataFrame({
+        "timestamp": pd.date_range("2026-01-01", periods=3, freq="h"),
+        "price": [1.0, 2.0, 3.0],
+    })
+
+
+def record_empty_range(recorder):
+    last_ts = existing_frame()["timestamp"].iloc[-1]
+    df = retrieve.market_chart_to_df({"prices": []})
+    recorder.record(ROW, df, None, last_ts=last_ts)
+
+
+def test_empty_range_csv(tmp_path):
+    retrieve.save_coin_csv(existing_frame(), ROW["id"], ROW["symbol"], ROW["name"], tmp_path)
+    path = retrieve.coin_csv_path(ROW["id"], ROW["symbol"], tmp_path)
+    before = path.read_bytes()
+
+    recorder = retrieve.FetchRecorder(tmp_path, time.time(), incremental=True)
+    record_empty_range(recorder)
+
+    assert recorder.failed_records == []
+    assert recorder.empty_records == []
+    assert recorder.saved_records[0]["rows"] == 3
+    assert recorder.saved_records[0]["new_rows"] == 0
+    assert recorder.saved_records[0]["days"] == 0.08
+    assert path.read_bytes() == before
+
+
+def test_empty_range_store(tmp_path):
+    store = price_store.PriceStore(tmp_path / "store")
+    store.write_frame(existing_frame(), ROW["id"], symbol=ROW["symbol"], name=ROW["name"])
+
+    recorder = retrieve.FetchRecorder(tmp_path, time.time(), incremental=True, store=store)
+    record_empty_range(recorder)
+
+    assert recorder.failed_records == []
+    assert recorder.saved_records[0]["rows"] == 3
+    assert recorder.saved_records[0]["new_rows"] == 0
+    assert recorder.saved_records[0]["days"] == 0.08
+    assert store.meta(ROW["id"])["generation"] == 1
+
+
+def test_merge_appends_at_tail_spacing(tmp_path):
+    # 末尾だけ読む範囲 (TAIL_READ_BYTES) より長い1時間足のCSV
+    old = pd.DataFrame({"timestamp": pd.date_range("2026-01-01", periods=500, freq="h")})
+    old["price"] = 1.0
+    retrieve.save_coin_csv(old, ROW["id"], ROW["symbol"], ROW["name"], tmp_path)
+    last_ts = old["timestamp"].iloc[-1]
+
+    new = pd.DataFrame({"timestamp": pd.date_range(last_ts, periods=37, freq="5min")})
+    new["price"] = 2.0
+
+    recorder = retrieve.FetchRecorder(tmp_path, time.time(), incremental=True)
+    recorder.record(ROW, new, None, last_ts=last_ts)
+
+    saved = recorder.saved_records[0]
+    assert saved["rows"] == 503
+    assert saved["new_rows"] == 3
+    # 取得した差分 (3時間) ではなく、保存済みの全体の期間
+    assert saved["days"] == round(502 / 24, 2)
+
+
+def test_thin_to_spacing_keeps_closest_row():
+    last_ts = pd.Timestamp("2026-01-01 00:00")
+    # 5分足。1時間後のスロット (0:30〜1:30) では 0:35 より 1:00 が近い
+    df = pd.DataFrame({
+        "timestamp": pd.date_range("2026-01-01 00:05", "2026-01-01 02:00", freq="5min"),
+    })
+    df["price"] = range(len(df))
+
+    thinned = retrieve.thin_to_spacing(df, last_ts, pd.Timedelta(hours=1))
+
+    assert thinned["timestamp"].tolist() == [
+        pd.Timestamp("2026-01-01 01:00"),
+        pd.Timestamp("2026-01-01 02:00"),
+    ]
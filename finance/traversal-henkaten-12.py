@@ -8,21 +8,72 @@
 - 絵文字、₸、中国語などを含む銘柄名でも落ちにくい
 - 個別保存に失敗しても、統合用リストは保持
 - 最後に統合summary、統合pairs、日別変化点数CSV/PNGを保存
+- 各CSVは最初に1回だけ読み込み、npzキャッシュで全組み合わせ・次回実行に再利用
+- AR RMSEは銘柄ごとに1回だけ計算し、returnsのハッシュでキャッシュ
+  (キャッシュにない銘柄は正規方程式の一括 solve でまとめて当てはめる)
+- --workers N で (銘柄 × method × model) をプロセス並列実行 (出力は直列と同一)
+- --backend numpy で l1/l2/normal × pelt/binseg/bottomup/dynp を累積和エンジン (cp_engine.py) で実行
+  (dynpは枝刈りつき最適分割で、DYN_MAX_POINTS_FOR_CPの間引き・スキップなし)
+- --incremental で追加行だけを逐次PELT (cp_stream.py) にかけ、新たに確定した変化点だけ出力
+- 結果は (method, model, file) ごとにSQLiteの結果ストア (results_store.py) に追記し、
+  統合CSV・組み合わせ別集計・日別変化点数はストアから作る (組み合わせごとのCSVは廃止)
+- --resume RUN_ID で、落ちた実行の完了済み (method, model, file) をスキップして再開
+- ファイルごとのログ行をやめ、1行の進捗表示 (files/s, points/s, ETA) と
+  フェーズ別時間 (load / ar / downsample / cp / write) の JSON Lines メトリクスにした (progress.py)
+- CSV読込・対数収益率・AR・信号作成・変化点検知は共通ライブラリ henkaten を使う
+  (ARは statsmodels ではなく同じ最小二乗を NumPy で解く)
+- --crops でペナルティの範囲全体の PELT 分割を CROPS で求め、ペナルティ → 変化点数 → 変化点の表を保存
+- --budget SEC で、サンプル銘柄で測った組み合わせごとの速さから、時間内に終わるように
+  組み合わせを並べ替え・間引き・省略する (省略した単位は summary に status=skipped で残す)
+- --panel で全銘柄の収益率を共通の時刻グリッドにそろえた (時刻 × 銘柄) 行列を作り、
+  1回の探索で市場全体の変化点を求める (henkaten.panel, 銘柄ごとの検知の日別集計の代わり)
+- --multiscale で等間隔の間引きの代わりに、ブロック平均した粗い信号で検知し、
+  元の解像度で各変化点の位置を見直す (henkaten.detect_change_points_multiscale)
+- --ar-monitor で銘柄ごとの AR を忘却係数つきRLSで逐次更新し、残差の異常スコア
+  (ChangeFinder 風) が閾値を超えた時点を出力する (ar_monitor.py, 状態を保存して次回は追加分だけ)
+- --store DIR で CSV の代わりに列指向の価格ストア (price_store.py) から読む
+  (mmap した配列をそのまま使い、出力のファイル名は取得スクリプトの CSV 名と同じ)
 """
 
+import os
+import json
+import argparse
+import hashlib
 import time
 import random
 import warnings
 import re
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-import ruptures as rpt
-from statsmodels.tsa.ar_model import AutoReg
+import cp_engine
+import cp_stream
+import ar_monitor
+import results_store
+import price_store
+from henkaten import (
+    load_price_series,
+    make_log_returns,
+    fit_ar_rmse_batch,
+    make_signal,
+    downsample_signal,
+    detect_change_points_multiscale,
+    detect_change_points,
+    change_point_strengths,
+)
+from henkaten.io import MIN_PRICE_ROWS
+from henkaten.panel import (
+    build_return_panel,
+    standardize_panel,
+    coarsen_panel,
+    detect_panel_change_points,
+)
+from progress import Progress
 
 warnings.filterwarnings("ignore")
 
@@ -42,6 +93,19 @@ PLOT_DIR.mkdir(parents=True, exist_ok=True)
 
 OUTPUT_PREFIX = "change_point"
 
+# 読込キャッシュ
+# 各CSVは最初に1回だけ読み込み、全組み合わせで使い回す。
+# USE_DISK_CACHE=True のときは、mtime/sizeが変わっていなければ
+# 次回以降もCSVを解析せずにnpzから読み込む。
+CACHE_DIR = OUTPUT_DIR / "cache"
+USE_DISK_CACHE = True
+
+# AR(AR_LAGS)のRMSEは method/model に依存しないので銘柄ごとに1回だけ計算する。
+# USE_AR_DISK_CACHE=True のときは returns の内容ハッシュ + AR_LAGS をキーに
+# JSONへ保存し、CSVが変わらなければ次回はAR推定自体を省略する。
+AR_CACHE_PATH = CACHE_DIR / "ar_rmse_cache.json"
+USE_AR_DISK_CACHE = True
+
 CP_METHODS = ["pelt", "binseg", "bottomup", "window", "dynp"]
 CHANGE_MODELS = ["l1", "l2", "rbf", "normal", "linear"]
 
@@ -55,9 +119,91 @@ WINDOW_WIDTH = 10
 MIN_RETURNS_FOR_CP = 10
 MAX_POINTS_FOR_CP = 2000
 
-# dynpは重いので上限を別にする
+# dynpは重いので上限を別にする (rupturesで実行する場合のみ)
 DYN_MAX_POINTS_FOR_CP = 500
 
+# 変化点検知の実装
+# "ruptures": 全組み合わせ ruptures
+# "numpy"   : pelt/binseg/bottomup/dynp × l1/l2/normal は cp_engine (累積和) を使い、
+#             それ以外の組み合わせは ruptures を使う (l1 は近似コスト)。
+#             cp_engine の dynp は枝刈りつきの最適分割なので、
+#             DYN_MAX_POINTS_FOR_CP の制限なしで MAX_POINTS_FOR_CP まで扱える。
+CP_BACKEND = "ruptures"
+
+# 長い系列の扱い (--multiscale)
+# "downsample": MAX_POINTS_FOR_CP 点に等間隔で間引いて検知する (従来どおり)
+# "multiscale": ブロック平均で MAX_POINTS_FOR_CP 点以下にした信号で検知し、
+#               各変化点を元の信号の ±1ブロックの範囲で最適な位置に直す。
+#               出力の cp_index_downsampled は元のreturnsのインデックスになる。
+CP_RESOLUTION = "downsample"
+
+# 逐次検知モード (--incremental)
+# 銘柄 × model ごとにPELTの状態を保存し、次回は追加された行だけ処理する。
+# 新たに確定した変化点だけを pairs と同じ列構成で出力する。
+STREAM_STATE_DIR = OUTPUT_DIR / "stream_state"
+STREAM_METHOD = "pelt_online"
+
+# ペナルティパスモード (--crops)
+# pen = pen_base * log(n) の pen_base を [CROPS_PEN_BASE_MIN, CROPS_PEN_BASE_MAX] で動かし、
+# その範囲で最適分割が変わるペナルティだけ PELT を実行する (cp_engine.crops)。
+# 銘柄 × model ごとに、変化点数ごとの分割を1行ずつ保存する。
+CROPS_PEN_BASE_MIN = 0.05
+CROPS_PEN_BASE_MAX = 5.0
+CROPS_MAX_RUNS = 500
+
+# 時間予算モード (--budget SEC)
+# BUDGET_PROFILE_FILES 個のサンプル銘柄で全組み合わせを実行して 1点あたりの秒数を測り、
+# 残りの時間 × BUDGET_SAFETY に収まるように、推定時間の短い組み合わせから実行する。
+# 収まらない組み合わせは銘柄を間引くか省略し、summary に status="skipped" で記録する。
+BUDGET_PROFILE_FILES = 5
+BUDGET_SAFETY = 0.9
+
+# パネルモード (--panel)
+# 全銘柄の収益率を PANEL_FREQ のグリッドにそろえた (T × N) 行列で、市場全体の変化点を1回で求める。
+# PANEL_METHOD:
+#   "sparse": 銘柄ごとのコストの減少が PANEL_THRESHOLD_BASE * log(T) を超えた銘柄だけを
+#             足し合わせる二分割。PANEL_MIN_MEMBERS 銘柄以上が動いた点だけを変化点にする
+#   "pelt"  : 全銘柄の l2 コストの和で PELT (pen = PANEL_PEN_BASE * N * log(T))
+# グリッドの PANEL_MIN_COVERAGE 未満しかデータがない銘柄は除く。
+# T が PANEL_MAX_POINTS を超えるときはブロックごとの収益率の和にまとめてから検知する。
+PANEL_FREQ = "1h"
+PANEL_METHOD = "sparse"
+PANEL_THRESHOLD_BASE = 2.0
+PANEL_PEN_BASE = 0.2
+PANEL_MIN_MEMBERS = 2
+PANEL_MIN_COVERAGE = 0.5
+PANEL_MAX_POINTS = 2000
+# 変化点ごとに出力する銘柄 (コストの減少が大きい順) の数
+PANEL_TOP_MEMBERS = 20
+
+# ARの残差モニター (--ar-monitor)
+# 銘柄ごとの AR(AR_MONITOR_LAGS) を忘却係数 AR_MONITOR_FORGET のRLSで1点ずつ更新し、
+# 標準化した残差の負の対数尤度を AR_MONITOR_SMOOTH 点で平滑化 → 同じ処理をもう1段 → 変化スコア。
+# 変化スコアが AR_MONITOR_THRESHOLD を下から超えた時点をアラームとして出力する
+# (変化がなければスコアはおよそ 1.4。閾値を超えている間は1回だけ出す)。
+# 各銘柄の最初の AR_MONITOR_WARMUP 点は RLS の係数が落ち着いていないのでスコアを出さない。
+# 状態は AR_MONITOR_STATE_PATH に保存し、次回は前回の最終日時より後のreturnsだけ入れる。
+# lags / 忘却係数 / 平滑化の点数 / ウォームアップを変えたときは状態を作り直す。
+AR_MONITOR_LAGS = 5
+AR_MONITOR_FORGET = 0.99
+AR_MONITOR_SMOOTH = 5
+AR_MONITOR_WARMUP = 100
+AR_MONITOR_THRESHOLD = 8.0
+AR_MONITOR_METHOD = "ar_rls"
+AR_MONITOR_STATE_PATH = STREAM_STATE_DIR / "ar_monitor.npz"
+
+# 結果ストア (チェックポイント)
+# (method, model, file) が1つ終わるたびに summary / pairs をここへ追記する。
+# 同じDBに複数の run_id が入る。--resume RUN_ID は完了済みの単位を飛ばす。
+RESULTS_DB_PATH = OUTPUT_DIR / f"{OUTPUT_PREFIX}_results.sqlite"
+
+# 進捗表示・メトリクス
+# 進捗行は PROGRESS_REFRESH_SEC ごとに上書き (端末でなければ PROGRESS_PLAIN_SEC ごとに1行)、
+# メトリクスは METRICS_INTERVAL_SEC ごとに {OUTPUT_PREFIX}_metrics_{RUN_ID}.jsonl へ追記する。
+PROGRESS_REFRESH_SEC = 0.5
+PROGRESS_PLAIN_SEC = 30.0
+METRICS_INTERVAL_SEC = 10.0
+
 AR_LAGS = 5
 
 SEED = 42
@@ -113,662 +259,1464 @@ def safe_filename(name, max_len=120):
     return name[:max_len]
 
 
-def read_csv_auto(path):
-    encodings = ["utf-8-sig", "utf-8", "cp932", "shift_jis"]
-    last_error = None
+def ar_cache_key(returns, lags):
+    x = np.ascontiguousarray(returns, dtype=np.float64)
+    h = hashlib.sha1(x.tobytes())
+    h.update(f"|lags={lags}|ar=lstsq".encode("ascii"))
+    return h.hexdigest()
 
-    for enc in encodings:
-        try:
-            return pd.read_csv(path, encoding=enc)
-        except Exception as e:
-            last_error = e
 
-    raise last_error
+def load_ar_cache():
+    if not USE_AR_DISK_CACHE or not AR_CACHE_PATH.exists():
+        return {}
 
+    try:
+        with open(AR_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        log(f"ARキャッシュ読込失敗のため再計算します: {e}")
+        return {}
 
-def detect_datetime_column(df):
-    candidates = [
-        "timestamp",
-        "datetime",
-        "date",
-        "time",
-        "Date",
-        "Datetime",
-        "Timestamp",
-        "snapped_at",
-    ]
 
-    for c in candidates:
-        if c in df.columns:
-            return c
+def save_ar_cache(cache):
+    if not USE_AR_DISK_CACHE:
+        return
 
-    return None
+    AR_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = AR_CACHE_PATH.with_name(AR_CACHE_PATH.name + ".tmp")
 
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
 
-def detect_price_column(df):
-    candidates = [
-        "price",
-        "Price",
-        "close",
-        "Close",
-        "market_price",
-        "current_price",
-        "usd",
-        "value",
-    ]
+    os.replace(tmp_path, AR_CACHE_PATH)
 
-    for c in candidates:
-        if c in df.columns:
-            return c
 
-    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+def attach_ar_rmse(store, progress, lags=5):
+    """
+    ストアの各銘柄に "rmse" を付与する。
+    同じreturns・同じlagsならキャッシュ値を使い、ARは当てはめない。
+    キャッシュにない銘柄は最後にまとめて fit_ar_rmse_batch で一括で当てはめる。
+    """
+    cache = load_ar_cache()
+    hits = 0
+    pending = []
 
-    if numeric_cols:
-        return numeric_cols[0]
+    progress.start_stage("ar", total=len(store))
 
-    return None
+    for file_path, coin in store.items():
+        if "error" in coin or len(coin["returns"]) < MIN_RETURNS_FOR_CP:
+            progress.advance(label=file_path.stem, skipped=1)
+            continue
 
+        key = ar_cache_key(coin["returns"], lags)
 
-def load_price_series(file_path):
-    df = read_csv_auto(file_path)
+        if key in cache:
+            coin["rmse"] = cache[key]
+            hits += 1
+            progress.advance(label=file_path.stem, cache_hit=1)
+            continue
 
-    if df.empty:
-        raise ValueError("CSVが空です")
+        pending.append((key, coin))
 
-    dt_col = detect_datetime_column(df)
-    price_col = detect_price_column(df)
+    if pending:
+        with progress.timer("ar"):
+            rmses = fit_ar_rmse_batch([coin["returns"] for _, coin in pending], lags=lags)
 
-    if price_col is None:
-        raise ValueError("価格列が見つかりません")
+        for (key, coin), rmse in zip(pending, rmses.tolist()):
+            cache[key] = rmse
+            coin["rmse"] = rmse
 
-    if dt_col is not None:
-        dt = pd.to_datetime(df[dt_col], errors="coerce")
-    else:
-        dt = pd.Series(pd.RangeIndex(len(df)), index=df.index)
+        progress.advance(
+            len(pending),
+            points=sum(len(coin["returns"]) for _, coin in pending),
+            fit=len(pending),
+        )
+
+    progress.end_stage()
+
+    save_ar_cache(cache)
+
+    return hits, len(pending)
+
+
+def use_cp_engine(method, model):
+    return CP_BACKEND == "numpy" and cp_engine.supports(method, model)
 
-    price = pd.to_numeric(df[price_col], errors="coerce")
 
-    out = pd.DataFrame({
-        "datetime": dt,
-        "price": price
-    })
+def change_point_kwargs(stats=None):
+    """このスクリプトの設定での detect_change_points の引数"""
+    return dict(
+        pen_base=CHANGE_PEN_BASE,
+        n_bkps=CHANGE_N_BKPS,
+        min_size=CHANGE_MIN_SIZE,
+        jump=CHANGE_JUMP,
+        width=WINDOW_WIDTH,
+        backend=CP_BACKEND,
+        dynp_max_points=DYN_MAX_POINTS_FOR_CP,
+        min_returns=MIN_RETURNS_FOR_CP,
+        stats=stats
+    )
+
+
+def run_change_point_detection(method, model, signal, stats=None):
+    """このスクリプトの設定で henkaten.detect_change_points を呼ぶ"""
+    return detect_change_points(signal, method, model, **change_point_kwargs(stats))
+
+
+def run_change_point_detection_multiscale(method, model, signal, max_points, stats=None):
+    """このスクリプトの設定で henkaten.detect_change_points_multiscale を呼ぶ"""
+    return detect_change_points_multiscale(
+        signal, method, model, max_points=max_points, **change_point_kwargs(stats)
+    )
+
+
+def file_cache_key(file_path):
+    st = Path(file_path).stat()
+    return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+
+def price_cache_path(file_path):
+    return CACHE_DIR / f"{safe_filename(Path(file_path).name)}.npz"
+
+
+def load_price_arrays_cached(file_path):
+    """
+    価格系列を numpy 配列 (datetime, price) で返す。
+    npzキャッシュのキー(mtime, size)が一致すれば、CSVは読まない。
+    """
+    key = file_cache_key(file_path)
+    cache_path = price_cache_path(file_path)
+
+    if USE_DISK_CACHE and cache_path.exists():
+        try:
+            with np.load(cache_path, allow_pickle=False) as z:
+                if np.array_equal(z["key"], key):
+                    return z["datetime"], z["price"]
+        except Exception:
+            # 壊れたキャッシュは読み直して上書きする
+            pass
 
-    out = out.dropna(subset=["price"])
-    out = out.replace([np.inf, -np.inf], np.nan).dropna(subset=["price"])
+    price_df = load_price_series(file_path)
+    dt = price_df["datetime"].to_numpy()
+    price = price_df["price"].to_numpy(dtype=np.float64)
 
-    if dt_col is not None:
-        out = out.dropna(subset=["datetime"])
-        out = out.drop_duplicates(subset=["datetime"])
-        out = out.sort_values("datetime")
+    if USE_DISK_CACHE:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, key=key, datetime=dt, price=price)
+        os.replace(tmp_path, cache_path)
 
-    out = out.reset_index(drop=True)
+    return dt, price
 
-    if len(out) < 3:
+
+def price_store_files(series_store):
+    """
+    価格ストアの全銘柄を、CSV と同じ名前の (実在しない) Path に対応づける。
+    戻り値は ([Path], {Path: coin_id})。Path は file_name / symbol に使うだけ。
+    """
+    coin_ids = {Path(price_store.csv_file_name(meta)): meta["coin_id"] for meta in series_store.iter_meta()}
+    return sorted(coin_ids), coin_ids
+
+
+def load_price_arrays_from_store(series_store, coin_id):
+    """
+    価格ストアから価格系列を numpy 配列 (datetime, price) で返す。
+    ストアは timestamp 順・重複なしで保存されているので、CSV読込と同じく有限の価格だけ残す。
+    """
+    arrays = series_store.read(coin_id)
+
+    if arrays is None:
+        raise ValueError("価格ストアに銘柄がありません")
+
+    dt = arrays["timestamp_ms"].astype("datetime64[ms]").astype("datetime64[ns]")
+    price = arrays["price"]
+
+    finite = np.isfinite(price)
+    if not finite.all():
+        dt, price = dt[finite], price[finite]
+
+    if len(price) < MIN_PRICE_ROWS:
         raise ValueError("有効な価格データが少なすぎます")
 
-    return out
+    return dt, price
+
+
+def load_coin_store(files, progress, series_store=None, coin_ids=None):
+    """
+    全ファイルを1回だけ読み込み、組み合わせ間で共有するストアを作る。
+    値は {"datetime", "price", "ret_datetime", "returns"} の numpy 配列、
+    読込に失敗したファイルは {"error": メッセージ}。
+    series_store (price_store.PriceStore) があれば、CSV の代わりに coin_ids[file_path] を読む。
+    """
+    store = {}
+
+    progress.start_stage("load", total=len(files))
 
+    for file_i, file_path in enumerate(files, start=1):
+        try:
+            with progress.timer("load"):
+                if series_store is not None:
+                    dt, price = load_price_arrays_from_store(series_store, coin_ids[file_path])
+                else:
+                    dt, price = load_price_arrays_cached(file_path)
+                price_df = pd.DataFrame({"datetime": dt, "price": price})
+                ret_df = make_log_returns(price_df)
+
+            store[file_path] = {
+                "datetime": dt,
+                "price": price,
+                "ret_datetime": ret_df["datetime"].to_numpy(),
+                "returns": ret_df["return"].to_numpy(dtype=np.float64),
+            }
+
+            progress.advance(points=len(price), label=file_path.stem)
+
+        except Exception as e:
+            store[file_path] = {"error": str(e)}
+            progress.write(f"[LOAD {file_i}/{len(files)}] [{file_path.stem}] 読込失敗: {e}")
+            progress.advance(label=file_path.stem, errors=1)
+
+    progress.end_stage()
+
+    return store
 
-def compute_returns(price_df):
-    prices = price_df["price"].astype(float)
 
-    prices = prices.replace([np.inf, -np.inf], np.nan)
-    prices = prices.where(prices > 0)
-    log_price = np.log(prices)
+def save_csv_safe(df, path):
+    """
+    cp932ではなくutf-8-sigで保存。
+    Excelでも比較的開きやすく、Unicode文字で落ちにくい。
+    一時ファイルに書いてから置き換えるので、途中で落ちても壊れたCSVは残らない。
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    os.replace(tmp_path, path)
+
+
+def plot_daily_counts(daily_df, out_png, title):
+    if daily_df.empty:
+        return False
 
-    returns = log_price.diff()
+    # 日付を文字列にせず日時の軸で描く (変化点のない日も間隔が空く)
+    plt.figure(figsize=(12, 5))
+    plt.bar(pd.to_datetime(daily_df["date"]), daily_df["change_point_count"])
+    plt.xlabel("date")
+    plt.ylabel("change point count")
+    plt.title(title)
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(out_png, dpi=150)
+    plt.close()
 
-    out = price_df.copy()
-    out["return"] = returns
+    return True
 
-    out = out.replace([np.inf, -np.inf], np.nan)
-    out = out.dropna(subset=["return"])
-    out = out.reset_index(drop=True)
 
-    return out
+# =========================================================
+# 3. 1銘柄 × 1組み合わせの処理 (並列実行の単位)
+# =========================================================
 
+# ワーカープロセス側に1回だけ渡される事前読込済みストア
+_WORKER_STORE = None
 
-def fit_ar_rmse(returns, lags=5):
-    x = np.asarray(returns, dtype=float)
 
-    if len(x) <= lags + 5:
-        return np.nan
+def init_worker(store, run_id, backend, resolution):
+    """
+    ProcessPoolExecutorの各ワーカーの初期化。
+    ストアはタスクごとではなく、ワーカー起動時に1回だけ送る。
+    RUN_ID / CP_BACKEND / CP_RESOLUTION は親プロセスの値に揃える(spawnだと再計算されるため)。
+    """
+    global _WORKER_STORE, RUN_ID, CP_BACKEND, CP_RESOLUTION
+    _WORKER_STORE = store
+    RUN_ID = run_id
+    CP_BACKEND = backend
+    CP_RESOLUTION = resolution
+    warnings.filterwarnings("ignore")
+
+
+def error_summary_row(method, model, file_path, error):
+    return {
+        "run_id": RUN_ID,
+        "method": method,
+        "model": model,
+        "symbol": file_path.stem,
+        "file_name": file_path.name,
+        "rows": np.nan,
+        "returns": np.nan,
+        "start_datetime": "",
+        "end_datetime": "",
+        "min_price": np.nan,
+        "max_price": np.nan,
+        "last_price": np.nan,
+        "rmse": np.nan,
+        "change_point_count": 0,
+        "cp_datetimes": "",
+        "cp_indices_original": "",
+        "cp_strengths": "",
+        "status": "error",
+        "error": str(error),
+    }
+
+
+def skipped_summary_row(method, model, file_path, reason):
+    return dict(error_summary_row(method, model, file_path, reason), status="skipped")
+
+
+def process_cell(method, model, file_path, coin):
+    """
+    1銘柄に対して1つの(method, model)で変化点検知を行う。
+    戻り値は (summary_row, pair_columns, info)。
+    pair_columns は pairs の列ごとの配列の dict (results_store.write_unit にそのまま渡す)。
+    info は進捗・メトリクス用
+    (downsample_elapsed, cp_elapsed, total_elapsed, points, note, error,
+    dynp の枝刈りの dynp_pruned / dynp_evaluated / dynp_full)。
+    """
+    cell_start = datetime.now()
+    symbol = file_path.stem
+    info = {
+        "downsample_elapsed": 0.0,
+        "cp_elapsed": 0.0,
+        "total_elapsed": 0.0,
+        "points": 0,
+        "note": "",
+        "error": "",
+        "dynp_pruned": 0,
+        "dynp_evaluated": 0,
+        "dynp_full": 0,
+    }
 
     try:
-        model = AutoReg(x, lags=lags, old_names=False)
-        res = model.fit()
-        pred = res.predict(start=lags, end=len(x) - 1)
-        actual = x[lags:]
+        if "error" in coin:
+            raise ValueError(coin["error"])
 
-        rmse = np.sqrt(np.mean((actual - pred) ** 2))
-        return float(rmse)
+        prices = coin["price"]
+        returns = coin["returns"]
+        ret_datetimes = pd.Series(coin["ret_datetime"])
 
-    except Exception:
-        return np.nan
+        rows = len(prices)
+        returns_count = len(returns)
 
+        if returns_count < MIN_RETURNS_FOR_CP:
+            raise ValueError(
+                f"returnsが少なすぎます: {returns_count} < {MIN_RETURNS_FOR_CP}"
+            )
 
-def downsample_signal(signal, datetimes, max_points):
-    n = len(signal)
+        rmse = coin["rmse"]
 
-    if n <= max_points:
-        return signal, datetimes, np.arange(n)
+        ds_start = time.perf_counter()
+        signal_full = make_signal(returns)
 
-    idx = np.linspace(0, n - 1, max_points).astype(int)
-    idx = np.unique(idx)
+        if method == "dynp" and not use_cp_engine(method, model):
+            max_points = DYN_MAX_POINTS_FOR_CP
+        else:
+            max_points = MAX_POINTS_FOR_CP
 
-    return signal[idx], datetimes.iloc[idx].reset_index(drop=True), idx
+        multiscale = CP_RESOLUTION == "multiscale"
 
+        if multiscale:
+            # 検知は元の解像度のインデックスで返るので、間引かずにそのまま使う
+            signal, ds_datetimes, ds_idx = signal_full, ret_datetimes, np.arange(returns_count)
+        else:
+            signal, ds_datetimes, ds_idx = downsample_signal(
+                signal_full,
+                ret_datetimes,
+                max_points=max_points
+            )
 
-def make_signal(returns):
-    signal = np.asarray(returns, dtype=float)
-    signal = signal.reshape(-1, 1)
+        info["downsample_elapsed"] = time.perf_counter() - ds_start
+        info["points"] = len(signal)
 
-    std = float(np.std(signal))
+        cp_start = datetime.now()
+        cp_stats = {}
 
-    if std <= 0 or np.isnan(std):
-        raise ValueError("returnsの標準偏差が0です")
+        try:
+            if multiscale:
+                cps = run_change_point_detection_multiscale(
+                    method, model, signal, max_points, stats=cp_stats
+                )
+            else:
+                cps = run_change_point_detection(method, model, signal, stats=cp_stats)
+        except RuntimeError as e:
+            if "dynpスキップ" in str(e):
+                info["note"] = str(e)
+                cps = []
+            else:
+                raise
+
+        if cp_stats.get("full"):
+            info["dynp_pruned"] = int(cp_stats["pruned"])
+            info["dynp_evaluated"] = int(cp_stats["evaluated"])
+            info["dynp_full"] = int(cp_stats["full"])
+
+        if cp_stats.get("pruned"):
+            info["note"] = (
+                f"[{symbol}] dynp枝刈りあり: 除外候補={cp_stats['pruned']}, "
+                f"評価セル={cp_stats['evaluated']}/{cp_stats['full']} "
+                f"({cp_stats['evaluated'] / max(cp_stats['full'], 1) * 100:.1f}%)"
+            )
 
-    signal = signal / std
+        info["cp_elapsed"] = (datetime.now() - cp_start).total_seconds()
+
+        # 変化点ごとのループをやめ、全変化点の日時・元インデックス・強度を配列でまとめて求める
+        cps = np.asarray(cps, dtype=np.int64)
+        cps = cps[(cps >= 0) & (cps < len(ds_datetimes))]
+
+        cp_datetimes = ds_datetimes.iloc[cps]
+        cp_indices_original = np.asarray(ds_idx)[cps]
+        cp_strengths = change_point_strengths(signal, cps)
+
+        pair_columns = {
+            "run_id": RUN_ID,
+            "method": method,
+            "model": model,
+            "symbol": symbol,
+            "file_name": file_path.name,
+            "cp_index_downsampled": cps,
+            "cp_index_original": cp_indices_original,
+            "cp_datetime": cp_datetimes.to_numpy(),
+            "cp_strength": cp_strengths,
+            "rows": rows,
+            "returns": returns_count,
+            "rmse": rmse,
+        }
+
+        summary_row = {
+            "run_id": RUN_ID,
+            "method": method,
+            "model": model,
+            "symbol": symbol,
+            "file_name": file_path.name,
+            "rows": rows,
+            "returns": returns_count,
+            "start_datetime": ret_datetimes.iloc[0],
+            "end_datetime": ret_datetimes.iloc[-1],
+            "min_price": float(prices.min()),
+            "max_price": float(prices.max()),
+            "last_price": float(prices[-1]),
+            "rmse": rmse,
+            "change_point_count": len(cps),
+            "cp_datetimes": " | ".join([str(x) for x in cp_datetimes]),
+            "cp_indices_original": " | ".join([str(x) for x in cp_indices_original.tolist()]),
+            "cp_strengths": " | ".join([str(x) for x in cp_strengths.tolist()]),
+            "status": "ok",
+            "error": "",
+        }
+
+    except Exception as e:
+        summary_row = error_summary_row(method, model, file_path, e)
+        pair_columns = {}
+        info["error"] = str(e)
+
+    info["total_elapsed"] = (datetime.now() - cell_start).total_seconds()
+
+    return summary_row, pair_columns, info
+
+
+def process_cell_in_worker(task):
+    method, model, file_path = task
+    return process_cell(method, model, file_path, _WORKER_STORE[file_path])
+
+
+def iter_cell_results(tasks, coin_store, workers):
+    """
+    tasks の全(method, model, file)の結果を、直列実行と同じ順番で返す。
+    workers > 1 のときはプロセスプールに全セルを一括投入し、
+    結果は executor.map で順番通りに逐次受け取る。
+    """
+    if not tasks:
+        return
 
-    return signal
+    if workers <= 1:
+        for method, model, file_path in tasks:
+            yield process_cell(method, model, file_path, coin_store[file_path])
+        return
 
+    chunksize = max(1, len(tasks) // (workers * 8))
 
-def run_change_point_detection(method, model, signal):
-    n = len(signal)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(coin_store, RUN_ID, CP_BACKEND, CP_RESOLUTION),
+    ) as executor:
+        try:
+            yield from executor.map(process_cell_in_worker, tasks, chunksize=chunksize)
+        except GeneratorExit:
+            # 途中で打ち切られたら (時間予算)、まだ始まっていないタスクは実行しない
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
 
-    if n < MIN_RETURNS_FOR_CP:
-        return []
 
-    if method == "dynp" and n > DYN_MAX_POINTS_FOR_CP:
-        raise RuntimeError(
-            f"dynpスキップ: len={n} > DYN_MAX_POINTS_FOR_CP={DYN_MAX_POINTS_FOR_CP}"
-        )
+# =========================================================
+# 4. 全組み合わせ処理
+# =========================================================
 
-    n_bkps = min(CHANGE_N_BKPS, max(1, n // max(CHANGE_MIN_SIZE, 2) - 1))
+def run_cell_tasks(
+    tasks, coin_store, store, progress, workers, stage, announce=True, deadline=None
+):
+    """
+    tasks の (method, model, file) を実行し、1単位ずつ結果ストアへ書き込む。
+    ファイルごとのログは出さず、進捗行とメトリクスだけを更新する。
+    deadline (datetime) を過ぎたら打ち切り、残りの単位は status="skipped" で記録する。
+    戻り値は [(task, info)]。
+    """
+    all_combos = [(method, model) for method in CP_METHODS for model in CHANGE_MODELS]
+    total_combos = len(all_combos)
+    combo_index = {combo: i for i, combo in enumerate(all_combos, start=1)}
+
+    # 組み合わせごとの最後のタスク (そこで組み合わせの完了を出す)
+    last_task = {(method, model): file_path for method, model, file_path in tasks}
+
+    progress.start_stage(stage, total=len(tasks))
+
+    combo = None
+    combo_cps = 0
+    combo_dynp = {"pruned": 0, "evaluated": 0, "full": 0}
+    reported_errors = set()
+    combo_start = time.perf_counter()
+    done = []
+
+    results = iter_cell_results(tasks, coin_store, workers)
+
+    for (method, model, file_path), (summary_row, pair_columns, info) in zip(tasks, results):
+        if combo != (method, model):
+            combo = (method, model)
+            combo_cps = 0
+            combo_dynp = {"pruned": 0, "evaluated": 0, "full": 0}
+            combo_start = time.perf_counter()
+
+        # 1単位を1トランザクションで書き込む (チェックポイント)。
+        # 書き込みが終わった単位は --resume で再実行されない。
+        with progress.timer("write"):
+            store.write_unit(RUN_ID, method, model, file_path.name, summary_row, pair_columns)
+
+        progress.add_phase("downsample", info["downsample_elapsed"])
+        progress.add_phase("cp", info["cp_elapsed"])
+
+        # 同じファイルの同じエラー (returns不足など) は組み合わせをまたいで1回だけ出す。
+        # 読込失敗は LOAD で出しているので、ここでは出さない。
+        error_key = (file_path, info["error"])
+
+        if (
+            info["error"]
+            and "error" not in coin_store[file_path]
+            and error_key not in reported_errors
+        ):
+            reported_errors.add(error_key)
+            progress.write(
+                f"[COMBO {combo_index[combo]}/{total_combos}] "
+                f"[method={method} | model={model}] [{file_path.stem}] "
+                f"ファイル処理失敗: {info['error']}"
+            )
 
-    if method == "pelt":
-        algo = rpt.Pelt(
-            model=model,
-            min_size=CHANGE_MIN_SIZE,
-            jump=CHANGE_JUMP
-        ).fit(signal)
+        cell_cps = results_store.column_length(pair_columns)
+        combo_cps += cell_cps
+
+        # dynp の枝刈りの件数 (除外候補数・評価したセル数 / 全セル数) は
+        # 進捗のカウンタ (メトリクスの JSON Lines にも出る) と組み合わせの完了行に出す
+        dynp_counts = {}
+        if info["dynp_full"]:
+            for key in combo_dynp:
+                combo_dynp[key] += info[f"dynp_{key}"]
+                dynp_counts[f"dynp_{key}"] = info[f"dynp_{key}"]
+
+        progress.advance(
+            points=info["points"],
+            label=f"{method}/{model}",
+            change_points=cell_cps,
+            errors=int(bool(info["error"])),
+            dynp_skipped=int("dynpスキップ" in info["note"]),
+            **dynp_counts,
+        )
+
+        done.append(((method, model, file_path), info))
 
-        pen = CHANGE_PEN_BASE * np.log(max(n, 2))
-        cps = algo.predict(pen=pen)
+        if announce and file_path == last_task[combo]:
+            dynp_text = ""
+            if combo_dynp["full"]:
+                dynp_text = (
+                    f", dynp枝刈り: 除外候補={combo_dynp['pruned']}, "
+                    f"評価セル={combo_dynp['evaluated']}/{combo_dynp['full']} "
+                    f"({combo_dynp['evaluated'] / combo_dynp['full'] * 100:.1f}%)"
+                )
 
-    elif method == "binseg":
-        algo = rpt.Binseg(
-            model=model,
-            min_size=CHANGE_MIN_SIZE,
-            jump=CHANGE_JUMP
-        ).fit(signal)
+            progress.write(
+                f"[COMBO {combo_index[combo]}/{total_combos}] "
+                f"method={method} | model={model} 完了: "
+                f"combo_cps={combo_cps}, "
+                f"elapsed={format_elapsed(time.perf_counter() - combo_start)}"
+                f"{dynp_text}"
+            )
 
-        cps = algo.predict(n_bkps=n_bkps)
+        if deadline is not None and datetime.now() > deadline and len(done) < len(tasks):
+            results.close()
+            rest = tasks[len(done):]
+            progress.write(f"時間予算を超えたため打ち切り: 残り{len(rest)}単位を省略")
 
-    elif method == "bottomup":
-        algo = rpt.BottomUp(
-            model=model,
-            min_size=CHANGE_MIN_SIZE,
-            jump=CHANGE_JUMP
-        ).fit(signal)
+            with progress.timer("write"):
+                write_skipped_units(
+                    store, [(task, "時間予算を超えたため打ち切り") for task in rest]
+                )
+            break
 
-        cps = algo.predict(n_bkps=n_bkps)
+    progress.end_stage()
 
-    elif method == "window":
-        width = min(WINDOW_WIDTH, max(2, n // 2))
+    return done
 
-        algo = rpt.Window(
-            width=width,
-            model=model,
-            min_size=CHANGE_MIN_SIZE,
-            jump=CHANGE_JUMP
-        ).fit(signal)
 
-        cps = algo.predict(n_bkps=n_bkps)
+def write_skipped_units(store, skipped):
+    """[(task, 理由)] の単位を status="skipped" の summary 行として記録する"""
+    for (method, model, file_path), reason in skipped:
+        store.write_unit(
+            RUN_ID, method, model, file_path.name,
+            skipped_summary_row(method, model, file_path, reason), {}
+        )
 
-    elif method == "dynp":
-        algo = rpt.Dynp(
-            model=model,
-            min_size=CHANGE_MIN_SIZE,
-            jump=CHANGE_JUMP
-        ).fit(signal)
 
-        cps = algo.predict(n_bkps=n_bkps)
+def cell_points(method, model, coin):
+    """そのセルで変化点検知にかける点数 (間引き後) の見込み"""
+    if "error" in coin:
+        return 0
 
+    if method == "dynp" and not use_cp_engine(method, model):
+        max_points = DYN_MAX_POINTS_FOR_CP
     else:
-        raise ValueError(f"未知のmethodです: {method}")
+        max_points = MAX_POINTS_FOR_CP
+
+    return min(len(coin["returns"]), max_points)
+
 
-    # rupturesは最後にnを返すので除外
-    cps = [int(cp) for cp in cps if int(cp) < n]
+def profile_combinations(all_combos, files, coin_store, store, progress, workers):
+    """
+    サンプル銘柄 (BUDGET_PROFILE_FILES 個を等間隔に選ぶ) で全組み合わせを実行し、
+    ({(method, model): 1点あたりの秒数}, 実時間の倍率) を返す。
+    実時間の倍率は プロファイルの実時間 / (セルの時間の合計 / workers) で、
+    並列の効率やプロセスプールの起動などセルの時間に入らない分を見込むのに使う。
+    サンプルの結果もふつうの単位として結果ストアに書き込む。
+    """
+    ok_files = [
+        f for f in files
+        if "error" not in coin_store[f] and len(coin_store[f]["returns"]) >= MIN_RETURNS_FOR_CP
+    ]
 
-    return cps
+    if not ok_files:
+        return {}, 1.0
 
+    pick = np.unique(
+        np.linspace(0, len(ok_files) - 1, min(BUDGET_PROFILE_FILES, len(ok_files))).astype(int)
+    )
+    sample = [ok_files[i] for i in pick]
+    done = store.done_units(RUN_ID)
+
+    tasks = [
+        (method, model, file_path)
+        for method, model in all_combos
+        for file_path in sample
+        if (method, model, file_path.name) not in done
+    ]
 
-def estimate_strength(signal, cp, window=5):
-    n = len(signal)
+    seconds = {}
+    points = {}
+    start = time.perf_counter()
 
-    left_start = max(0, cp - window)
-    left_end = cp
-    right_start = cp
-    right_end = min(n, cp + window)
+    for (method, model, _), info in run_cell_tasks(
+        tasks, coin_store, store, progress, workers, stage="profile", announce=False
+    ):
+        seconds[(method, model)] = seconds.get((method, model), 0.0) + info["total_elapsed"]
+        points[(method, model)] = points.get((method, model), 0) + info["points"]
 
-    if left_end <= left_start or right_end <= right_start:
-        return np.nan
+    wall = time.perf_counter() - start
+    cell_seconds = sum(seconds.values())
+    wall_factor = max(wall * workers / cell_seconds, 1.0) if cell_seconds > 0 else 1.0
 
-    left_mean = float(np.mean(signal[left_start:left_end]))
-    right_mean = float(np.mean(signal[right_start:right_end]))
+    sec_per_point = {
+        combo: seconds[combo] / points[combo]
+        for combo in seconds
+        if points[combo] > 0
+    }
 
-    return abs(right_mean - left_mean)
+    return sec_per_point, wall_factor
 
 
-def save_csv_safe(df, path):
+def plan_with_budget(tasks, coin_store, sec_per_point, budget_sec, workers):
     """
-    cp932ではなくutf-8-sigで保存。
-    Excelでも比較的開きやすく、Unicode文字で落ちにくい。
+    推定時間が budget_sec に収まるように tasks を選ぶ。
+    推定時間は 1点あたりの秒数 × 点数 / workers (workers は実効の並列数)。
+    推定時間の短い (method, model) から順に全銘柄を入れ、
+    収まらなくなった組み合わせは銘柄を等間隔に間引いて残りの時間に合わせ、
+    それ以降の組み合わせは飛ばす。
+    プロファイルできなかった組み合わせは、他の組み合わせの1点あたり秒数の最大値で見積もる。
+    戻り値は (実行する tasks, [(飛ばす task, 理由)], 組み合わせごとの計画の行)。
     """
-    df.to_csv(path, index=False, encoding="utf-8-sig")
+    fallback = max(sec_per_point.values(), default=0.0)
+
+    by_combo = {}
+    for task in tasks:
+        by_combo.setdefault(task[:2], []).append(task)
+
+    estimates = {
+        combo: np.array([
+            sec_per_point.get(combo, fallback) * cell_points(*combo, coin_store[task[2]])
+            for task in combo_tasks
+        ]) / workers
+        for combo, combo_tasks in by_combo.items()
+    }
+
+    remaining = budget_sec
+    run_tasks = []
+    skipped = []
+    plan_rows = []
+
+    for combo in sorted(by_combo, key=lambda c: estimates[c].sum()):
+        combo_tasks = by_combo[combo]
+        est = estimates[combo]
+        total = float(est.sum())
+
+        # 検知しない単位 (読込失敗・returns不足) は時間がかからないので必ず残す
+        costly = np.flatnonzero(est > 0)
+
+        if total <= remaining:
+            count = len(costly)
+        else:
+            count = int(len(costly) * max(remaining, 0.0) / total)
+
+        picked = costly[np.linspace(0, len(costly) - 1, count).astype(int)]
+        keep = set(np.flatnonzero(est == 0).tolist()) | set(picked.tolist())
+        reason = (
+            f"時間予算で省略: 組み合わせの推定時間={total:.1f}秒, "
+            f"残り予算={max(remaining, 0.0):.1f}秒"
+        )
+        remaining -= float(sum(est[i] for i in keep))
 
+        for i, task in enumerate(combo_tasks):
+            if i in keep:
+                run_tasks.append(task)
+            else:
+                skipped.append((task, reason))
 
-def extract_daily_counts_from_pairs(df_pairs):
-    if df_pairs.empty:
-        return pd.DataFrame(columns=["date", "change_point_count"])
+        plan_rows.append({
+            "method": combo[0],
+            "model": combo[1],
+            "sec_per_point": sec_per_point.get(combo, np.nan),
+            "estimated_sec": total,
+            "files": len(combo_tasks),
+            "planned_files": len(keep),
+        })
 
-    if "cp_datetime" not in df_pairs.columns:
-        return pd.DataFrame(columns=["date", "change_point_count"])
+    return run_tasks, skipped, plan_rows
 
-    dt = pd.to_datetime(df_pairs["cp_datetime"], errors="coerce").dropna()
 
-    if dt.empty:
-        return pd.DataFrame(columns=["date", "change_point_count"])
+def run_all_combinations(files, coin_store, store, progress, workers=1, budget_sec=None):
+    """
+    全組み合わせを処理し、(method, model, file) ごとに結果ストアへ書き込む。
+    ストアで完了済みの単位 (--resume) はスキップする。
 
-    tmp = pd.DataFrame({"datetime": dt})
-    tmp["date"] = tmp["datetime"].dt.date
+    budget_sec (秒) を指定すると、サンプル銘柄で各組み合わせの1点あたりの時間を測り、
+    START_TIME からの経過時間が予算に収まるように組み合わせを並べ替え・間引き・省略する。
+    省略した単位は status="skipped" の summary 行として記録する。
+    """
+    all_combos = [(method, model) for method in CP_METHODS for model in CHANGE_MODELS]
 
-    daily = (
-        tmp.groupby("date")
-        .size()
-        .reset_index(name="change_point_count")
-        .sort_values("date")
-    )
+    if budget_sec is not None:
+        sec_per_point, wall_factor = profile_combinations(
+            all_combos, files, coin_store, store, progress, workers
+        )
 
-    return daily
+    done = store.done_units(RUN_ID)
 
+    tasks = [
+        (method, model, file_path)
+        for method, model in all_combos
+        for file_path in files
+        if (method, model, file_path.name) not in done
+    ]
 
-def plot_daily_counts(daily_df, out_png, title):
-    if daily_df.empty:
-        return False
+    if done:
+        total_units = len(all_combos) * len(files)
+        log(f"完了済みの単位をスキップ: {total_units - len(tasks)}/{total_units}")
 
-    plt.figure(figsize=(12, 5))
-    plt.bar(daily_df["date"].astype(str), daily_df["change_point_count"])
-    plt.xlabel("date")
-    plt.ylabel("change point count")
-    plt.title(title)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(out_png, dpi=150)
-    plt.close()
+    if budget_sec is not None:
+        elapsed = (datetime.now() - START_TIME).total_seconds()
+        remaining = (budget_sec - elapsed) * BUDGET_SAFETY
 
-    return True
+        tasks, skipped, plan_rows = plan_with_budget(
+            tasks, coin_store, sec_per_point, remaining, workers / wall_factor
+        )
+
+        log(
+            f"時間予算: {format_elapsed(budget_sec)}, 経過: {format_elapsed(elapsed)}, "
+            f"実時間の倍率: {wall_factor:.2f}, "
+            f"実行={len(tasks)}単位, 省略={len(skipped)}単位"
+        )
+        print(pd.DataFrame(plan_rows).to_string(index=False), flush=True)
+
+        with progress.timer("write"):
+            write_skipped_units(store, skipped)
+
+    deadline = None
+    if budget_sec is not None:
+        deadline = START_TIME + timedelta(seconds=budget_sec)
+
+    run_cell_tasks(tasks, coin_store, store, progress, workers, stage="cp", deadline=deadline)
 
 
 # =========================================================
-# 3. ファイル検索
+# 5. 統合保存・集計・日別プロット
 # =========================================================
 
-log("ファイル検索開始")
+def save_combined_outputs(store):
+    """統合CSV・組み合わせ別集計・日別変化点数を結果ストアから作る"""
+    log("全組み合わせの個別処理完了")
+
+    all_summary_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_summary_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
+    all_pairs_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_pairs_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
+
+    store.export_csv("summary", RUN_ID, all_summary_path)
+    log(f"統合summary保存: {all_summary_path.name}")
+
+    store.export_csv("pairs", RUN_ID, all_pairs_path)
+    log(f"統合pairs保存: {all_pairs_path.name}")
+
+    pairs_count = store.count("pairs", RUN_ID)
+    log(f"全体累計変化点数: {pairs_count}")
+
+    if pairs_count == 0:
+        log("変化点一覧は空です")
+    else:
+        log("変化点一覧あり")
+
+    # 集計保存
+    agg_summary = store.agg_summary(RUN_ID)
 
-files = sorted(DATA_DIR.glob(FILE_PATTERN))
+    if not agg_summary.empty:
 
-if not files:
-    raise FileNotFoundError(f"対象ファイルが見つかりません: {DATA_DIR / FILE_PATTERN}")
+        agg_summary_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_summary_AGG_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
+        save_csv_safe(agg_summary, agg_summary_path)
+        log(f"統合集計summary保存: {agg_summary_path.name}")
 
-log(f"対象ファイル数: {len(files)}")
-log(f"出力先: {OUTPUT_DIR.resolve()}")
+        log("===== 組み合わせ別ランキング =====")
+        print(agg_summary.to_string(index=False), flush=True)
+
+    # 日別変化点数CSV/PNG
+    daily_df = store.daily_counts(RUN_ID)
+
+    daily_csv_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_daily_counts_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
+    save_csv_safe(daily_df, daily_csv_path)
+    log(f"日別変化点数CSV保存: {daily_csv_path.name}")
+
+    daily_png_path = PLOT_DIR / f"{OUTPUT_PREFIX}_daily_counts_ALL_METHODS_ALL_MODELS_{RUN_ID}.png"
+
+    if plot_daily_counts(
+        daily_df,
+        daily_png_path,
+        title="Daily Change Points - ALL METHODS / ALL MODELS"
+    ):
+        log(f"日別変化点数プロット保存: {daily_png_path.name}")
+    else:
+        log("日別変化点数プロットは作成されませんでした")
 
 
 # =========================================================
-# 4. 全組み合わせ処理
+# 6. 逐次検知モード
 # =========================================================
 
-all_summary_rows = []
-all_pair_rows = []
+def stream_state_path(file_path, model):
+    return STREAM_STATE_DIR / f"{safe_filename(file_path.name)}_{model}.npz"
 
-total_combos = len(CP_METHODS) * len(CHANGE_MODELS)
-combo_index = 0
 
-for method in CP_METHODS:
-    for model in CHANGE_MODELS:
-        combo_index += 1
-
-        combo_start = datetime.now()
+def run_incremental(files, coin_store):
+    """
+    銘柄ごとに前回の状態を読み込み、前回の最終日時より後のreturnsだけを追加する。
+    戻り値は新たに確定した変化点の pairs 行。
+    """
+    models = [m for m in CHANGE_MODELS if m in cp_engine.SUPPORTED_MODELS]
+    pair_rows = []
 
-        log("============================================================")
-        log(f"[COMBO {combo_index}/{total_combos}] method={method} | model={model} 開始")
-        log("============================================================")
+    log(f"逐次検知開始: method={STREAM_METHOD}, models={models}")
 
-        combo_summary_rows = []
-        combo_pair_rows = []
+    for file_i, file_path in enumerate(files, start=1):
+        symbol = file_path.stem
+        coin = coin_store[file_path]
+        prefix = f"[STREAM {file_i}/{len(files)}] [{symbol}]"
 
-        current_combo_cps = 0
+        if "error" in coin:
+            log(f"{prefix} スキップ: {coin['error']}")
+            continue
 
-        for file_i, file_path in enumerate(files, start=1):
-            file_start = datetime.now()
+        returns = coin["returns"]
+        ret_datetimes = coin["ret_datetime"]
 
-            raw_symbol = file_path.stem
-            symbol = raw_symbol
+        if len(returns) < MIN_RETURNS_FOR_CP:
+            log(f"{prefix} スキップ: returnsが少なすぎます: {len(returns)}")
+            continue
 
-            log(
-                f"[COMBO {combo_index}/{total_combos}] "
-                f"[method={method} | model={model}] "
-                f"--- {symbol} 処理開始: file={file_i}/{len(files)} ---"
-            )
+        for model in models:
+            state_path = stream_state_path(file_path, model)
 
             try:
-                price_df = load_price_series(file_path)
-                ret_df = compute_returns(price_df)
+                detector, state_datetimes = cp_stream.load_state(state_path)
 
-                rows = len(price_df)
-                returns_count = len(ret_df)
+                if detector is None:
+                    scale = float(np.std(returns))
 
-                log(
-                    f"[COMBO {combo_index}/{total_combos}] "
-                    f"[method={method} | model={model}] "
-                    f"[{symbol}] 読込完了: rows={rows}, returns={returns_count}"
-                )
+                    if scale <= 0 or np.isnan(scale):
+                        raise ValueError("returnsの標準偏差が0です")
 
-                if returns_count < MIN_RETURNS_FOR_CP:
-                    raise ValueError(
-                        f"returnsが少なすぎます: {returns_count} < {MIN_RETURNS_FOR_CP}"
+                    detector = cp_stream.OnlinePelt(
+                        model,
+                        pen=CHANGE_PEN_BASE * np.log(max(len(returns), 2)),
+                        scale=scale,
+                        min_size=CHANGE_MIN_SIZE
                     )
+                    state_datetimes = ret_datetimes[:0]
+                    new_mask = np.ones(len(returns), dtype=bool)
+                else:
+                    new_mask = ret_datetimes > state_datetimes[-1]
 
-                ar_start = datetime.now()
-                rmse = fit_ar_rmse(ret_df["return"], lags=AR_LAGS)
-                ar_elapsed = (datetime.now() - ar_start).total_seconds()
+                new_cps = detector.update(returns[new_mask])
+                state_datetimes = np.concatenate([state_datetimes, ret_datetimes[new_mask]])
 
-                log(
-                    f"[COMBO {combo_index}/{total_combos}] "
-                    f"[method={method} | model={model}] "
-                    f"[{symbol}] AR終了: RMSE={rmse}, time={format_elapsed(ar_elapsed)}"
-                )
+                cp_stream.save_state(state_path, detector, state_datetimes)
 
-                signal_full = make_signal(ret_df["return"])
+            except Exception as e:
+                log(f"{prefix} [model={model}] 逐次検知失敗: {e}")
+                continue
 
-                if method == "dynp":
-                    max_points = DYN_MAX_POINTS_FOR_CP
-                else:
-                    max_points = MAX_POINTS_FOR_CP
+            state_dt_series = pd.Series(state_datetimes)
 
-                signal, ds_datetimes, ds_idx = downsample_signal(
-                    signal_full,
-                    ret_df["datetime"],
-                    max_points=max_points
-                )
+            for cp in new_cps:
+                cp_dt = state_dt_series.iloc[cp]
 
-                cp_start = datetime.now()
-
-                try:
-                    cps = run_change_point_detection(method, model, signal)
-                except RuntimeError as e:
-                    if "dynpスキップ" in str(e):
-                        log(
-                            f"[COMBO {combo_index}/{total_combos}] "
-                            f"[method={method} | model={model}] {e}"
-                        )
-                        cps = []
-                    else:
-                        raise
-
-                cp_elapsed = (datetime.now() - cp_start).total_seconds()
-
-                if not cps:
-                    log(
-                        f"[COMBO {combo_index}/{total_combos}] "
-                        f"[method={method} | model={model}] "
-                        f"[{symbol}] 変化点なし"
-                    )
+                # 現在のCSV上の位置 (古い行が消えていれば -1)
+                pos = int(np.searchsorted(ret_datetimes, state_datetimes[cp]))
+                if pos >= len(ret_datetimes) or ret_datetimes[pos] != state_datetimes[cp]:
+                    pos = -1
 
-                cp_datetimes = []
-                cp_indices_original = []
-                cp_strengths = []
-
-                for cp in cps:
-                    cp = int(cp)
-
-                    if cp < 0 or cp >= len(ds_datetimes):
-                        continue
-
-                    cp_dt = ds_datetimes.iloc[cp]
-                    orig_idx = int(ds_idx[cp])
-                    strength = estimate_strength(signal, cp)
-
-                    cp_datetimes.append(cp_dt)
-                    cp_indices_original.append(orig_idx)
-                    cp_strengths.append(strength)
-
-                    combo_pair_rows.append({
-                        "run_id": RUN_ID,
-                        "method": method,
-                        "model": model,
-                        "symbol": symbol,
-                        "file_name": file_path.name,
-                        "cp_index_downsampled": cp,
-                        "cp_index_original": orig_idx,
-                        "cp_datetime": cp_dt,
-                        "cp_strength": strength,
-                        "rows": rows,
-                        "returns": returns_count,
-                        "rmse": rmse,
-                    })
-
-                current_file_cps = len(cp_datetimes)
-                current_combo_cps += current_file_cps
-
-                summary_row = {
+                pair_rows.append({
                     "run_id": RUN_ID,
-                    "method": method,
+                    "method": STREAM_METHOD,
                     "model": model,
                     "symbol": symbol,
                     "file_name": file_path.name,
-                    "rows": rows,
-                    "returns": returns_count,
-                    "start_datetime": ret_df["datetime"].iloc[0],
-                    "end_datetime": ret_df["datetime"].iloc[-1],
-                    "min_price": float(price_df["price"].min()),
-                    "max_price": float(price_df["price"].max()),
-                    "last_price": float(price_df["price"].iloc[-1]),
-                    "rmse": rmse,
-                    "change_point_count": current_file_cps,
-                    "cp_datetimes": " | ".join([str(x) for x in cp_datetimes]),
-                    "cp_indices_original": " | ".join([str(x) for x in cp_indices_original]),
-                    "cp_strengths": " | ".join([str(x) for x in cp_strengths]),
-                    "status": "ok",
-                    "error": "",
-                }
-
-                combo_summary_rows.append(summary_row)
-
-                file_elapsed = (datetime.now() - file_start).total_seconds()
-                progress = file_i / len(files) * 100
-
-                log(
-                    f"[COMBO {combo_index}/{total_combos}] "
-                    f"[method={method} | model={model}] "
-                    f"[{symbol}] CP処理終了: current_file_cps={current_file_cps}, "
-                    f"time={format_elapsed(cp_elapsed)}"
-                )
+                    "cp_index_downsampled": cp,
+                    "cp_index_original": pos,
+                    "cp_datetime": cp_dt,
+                    "cp_strength": detector.strength(cp),
+                    "rows": len(coin["price"]),
+                    "returns": len(returns),
+                    "rmse": coin["rmse"],
+                })
 
-                log(
-                    f"[COMBO {combo_index}/{total_combos}] "
-                    f"[method={method} | model={model}] "
-                    f"--- {symbol} 処理終了: current_file_cps={current_file_cps}, "
-                    f"progress={progress:.1f}%, total_time={format_elapsed(file_elapsed)} ---"
-                )
+            log(
+                f"{prefix} [model={model}] 追加returns={int(new_mask.sum())}, "
+                f"状態の長さ={detector.n_samples}, 新規確定変化点={len(new_cps)}"
+            )
 
-                log(
-                    f"[COMBO {combo_index}/{total_combos}] "
-                    f"[method={method} | model={model}] "
-                    f"累計変化点数: current_file={current_file_cps}, "
-                    f"current_combo={current_combo_cps}, "
-                    f"all_combos={len(all_pair_rows) + len(combo_pair_rows)}"
-                )
+    return pair_rows
 
-            except Exception as e:
-                file_elapsed = (datetime.now() - file_start).total_seconds()
 
-                log(
-                    f"[COMBO {combo_index}/{total_combos}] "
-                    f"[method={method} | model={model}] "
-                    f"[{symbol}] ファイル処理失敗: {e}"
+# =========================================================
+# 7. ペナルティパス (CROPS) モード
+# =========================================================
+
+def run_crops(files, coin_store):
+    """
+    銘柄 × model ごとに CROPS でペナルティパスを求める。
+    戻り値は (変化点数ごとの) 分割の行。
+    """
+    models = [m for m in CHANGE_MODELS if m in cp_engine.SUPPORTED_MODELS]
+    rows = []
+
+    log(
+        f"ペナルティパス開始: models={models}, "
+        f"pen_base={CROPS_PEN_BASE_MIN}〜{CROPS_PEN_BASE_MAX}"
+    )
+
+    for file_i, file_path in enumerate(files, start=1):
+        symbol = file_path.stem
+        coin = coin_store[file_path]
+        prefix = f"[CROPS {file_i}/{len(files)}] [{symbol}]"
+
+        if "error" in coin:
+            log(f"{prefix} スキップ: {coin['error']}")
+            continue
+
+        returns = coin["returns"]
+
+        if len(returns) < MIN_RETURNS_FOR_CP:
+            log(f"{prefix} スキップ: returnsが少なすぎます: {len(returns)}")
+            continue
+
+        try:
+            signal = make_signal(returns)
+        except Exception as e:
+            log(f"{prefix} スキップ: {e}")
+            continue
+
+        signal, cp_datetimes, original_idx = downsample_signal(
+            signal, pd.Series(coin["ret_datetime"]), MAX_POINTS_FOR_CP
+        )
+
+        n = len(signal)
+        log_n = np.log(max(n, 2))
+
+        for model in models:
+            t0 = time.perf_counter()
+
+            try:
+                cost = cp_engine.PrefixSumCost(model, signal)
+                path = cp_engine.crops(
+                    cost,
+                    pen_min=CROPS_PEN_BASE_MIN * log_n,
+                    pen_max=CROPS_PEN_BASE_MAX * log_n,
+                    min_size=CHANGE_MIN_SIZE,
+                    jump=CHANGE_JUMP,
+                    max_runs=CROPS_MAX_RUNS
                 )
+            except Exception as e:
+                log(f"{prefix} [model={model}] ペナルティパス失敗: {e}")
+                continue
 
-                combo_summary_rows.append({
+            # 同じ変化点数は1行にまとめ、その分割が得られたペナルティの範囲を残す
+            by_n_bkps = {}
+
+            for r in path:
+                if r["n_bkps"] not in by_n_bkps:
+                    by_n_bkps[r["n_bkps"]] = dict(r, penalty_max=r["penalty"])
+                else:
+                    by_n_bkps[r["n_bkps"]]["penalty_max"] = r["penalty"]
+
+            for r in sorted(by_n_bkps.values(), key=lambda r: r["penalty"]):
+                cps = [cp for cp in r["bkps"] if cp < n]
+
+                rows.append({
                     "run_id": RUN_ID,
-                    "method": method,
                     "model": model,
                     "symbol": symbol,
                     "file_name": file_path.name,
-                    "rows": np.nan,
-                    "returns": np.nan,
-                    "start_datetime": "",
-                    "end_datetime": "",
-                    "min_price": np.nan,
-                    "max_price": np.nan,
-                    "last_price": np.nan,
-                    "rmse": np.nan,
-                    "change_point_count": 0,
-                    "cp_datetimes": "",
-                    "cp_indices_original": "",
-                    "cp_strengths": "",
-                    "status": "error",
-                    "error": str(e),
+                    "n_signal": n,
+                    "penalty_min": r["penalty"],
+                    "penalty_max": r["penalty_max"],
+                    "pen_base_min": r["penalty"] / log_n,
+                    "pen_base_max": r["penalty_max"] / log_n,
+                    "n_bkps": r["n_bkps"],
+                    "cost": r["cost"],
+                    "cp_indices_downsampled": " | ".join(str(cp) for cp in cps),
+                    "cp_indices_original": " | ".join(str(int(original_idx[cp])) for cp in cps),
+                    "cp_datetimes": " | ".join(str(cp_datetimes.iloc[cp]) for cp in cps),
                 })
 
-                log(
-                    f"[COMBO {combo_index}/{total_combos}] "
-                    f"[method={method} | model={model}] "
-                    f"--- {symbol} 処理終了: error, total_time={format_elapsed(file_elapsed)} ---"
-                )
+            log(
+                f"{prefix} [model={model}] PELT実行回数={len(path)}, "
+                f"分割の種類={len(by_n_bkps)}, "
+                f"処理時間={format_elapsed(time.perf_counter() - t0)}"
+            )
 
-        # 重要:
-        # 保存の前に統合リストへ追加する。
-        # これにより、個別CSV保存が失敗しても全体結果は失われない。
-        all_summary_rows.extend(combo_summary_rows)
-        all_pair_rows.extend(combo_pair_rows)
+    return rows
 
-        combo_summary_df = pd.DataFrame(combo_summary_rows)
-        combo_pairs_df = pd.DataFrame(combo_pair_rows)
 
-        combo_summary_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_summary_{method}_{model}_{RUN_ID}.csv"
-        combo_pairs_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_pairs_{method}_{model}_{RUN_ID}.csv"
+# =========================================================
+# 8. パネル (銘柄をまたぐ変化点) モード
+# =========================================================
 
-        try:
-            save_csv_safe(combo_summary_df, combo_summary_path)
-            log(f"[COMBO {combo_index}/{total_combos}] summary保存: {combo_summary_path.name}")
-        except Exception as e:
-            log(f"[COMBO {combo_index}/{total_combos}] summary保存失敗: {e}")
+def run_panel(files, coin_store):
+    """
+    全銘柄を1つの (時刻 × 銘柄) 行列にして市場全体の変化点を求める。
+    戻り値は (変化点ごとの行, 日別の行)。
+    """
+    series = {
+        file_path.stem: (coin["datetime"], coin["price"])
+        for file_path in files
+        for coin in [coin_store[file_path]]
+        if "error" not in coin
+    }
+
+    t0 = time.perf_counter()
+
+    panel = build_return_panel(series, freq=PANEL_FREQ, min_coverage=PANEL_MIN_COVERAGE)
+    X, symbols = standardize_panel(panel)
+    X, grid, block = coarsen_panel(X, panel.index, PANEL_MAX_POINTS)
+
+    log(
+        f"パネル作成: 銘柄={len(symbols)}/{len(series)}, グリッド={len(panel)} ({PANEL_FREQ}), "
+        f"検知点数={len(X)} (block={block}), "
+        f"処理時間={format_elapsed(time.perf_counter() - t0)}"
+    )
 
-        try:
-            save_csv_safe(combo_pairs_df, combo_pairs_path)
-            log(f"[COMBO {combo_index}/{total_combos}] pairs保存: {combo_pairs_path.name}")
-        except Exception as e:
-            log(f"[COMBO {combo_index}/{total_combos}] pairs保存失敗: {e}")
+    t0 = time.perf_counter()
 
-        combo_elapsed = (datetime.now() - combo_start).total_seconds()
+    results = detect_panel_change_points(
+        X,
+        method=PANEL_METHOD,
+        pen_base=PANEL_PEN_BASE,
+        threshold_base=PANEL_THRESHOLD_BASE,
+        min_members=PANEL_MIN_MEMBERS,
+        min_size=CHANGE_MIN_SIZE,
+        jump=CHANGE_JUMP,
+    )
 
-        log(
-            f"[COMBO {combo_index}/{total_combos}] "
-            f"method={method} | model={model} 完了: "
-            f"combo_cps={len(combo_pair_rows)}, "
-            f"elapsed={format_elapsed(combo_elapsed)}"
-        )
+    log(
+        f"パネル変化点検知: method={PANEL_METHOD}, 変化点数={len(results)}, "
+        f"処理時間={format_elapsed(time.perf_counter() - t0)}"
+    )
+
+    rows = []
+
+    for r in results:
+        members = [symbols[j] for j in r["members"][:PANEL_TOP_MEMBERS]]
+        member_gains = r["member_gains"][:PANEL_TOP_MEMBERS].tolist()
+
+        rows.append({
+            "run_id": RUN_ID,
+            "method": PANEL_METHOD,
+            "freq": PANEL_FREQ,
+            "block": block,
+            "n_coins": len(symbols),
+            "cp_index": r["cp"],
+            "cp_index_grid": r["cp"] * block,
+            "cp_datetime": grid[r["cp"]],
+            "member_count": len(r["members"]),
+            "member_share": len(r["members"]) / len(symbols),
+            "gain": r["gain"],
+            "top_members": " | ".join(members),
+            "top_member_gains": " | ".join(str(g) for g in member_gains),
+        })
+
+    if not rows:
+        return rows, []
+
+    cp_df = pd.DataFrame(rows)
+    daily = (
+        cp_df.assign(date=pd.to_datetime(cp_df["cp_datetime"]).dt.date)
+        .groupby("date", as_index=False)
+        .agg(change_point_count=("cp_index", "size"), member_count=("member_count", "sum"))
+    )
+
+    return rows, daily.to_dict("records")
 
 
 # =========================================================
-# 5. 統合保存
+# 9. ARの残差モニター モード
 # =========================================================
 
-log("全組み合わせの個別処理完了")
+def load_ar_monitor(symbols):
+    """
+    保存したモニターを読み込み、symbols の並びに直す。
+    戻り値は (monitor, 各銘柄の前回の最終日時 (新しい銘柄は NaT))。
+    """
+    monitor, old_symbols, old_last = ar_monitor.load_state(AR_MONITOR_STATE_PATH)
+    last_datetimes = np.full(len(symbols), np.datetime64("NaT"), dtype="datetime64[ns]")
+
+    params = (AR_MONITOR_LAGS, AR_MONITOR_FORGET, AR_MONITOR_SMOOTH, AR_MONITOR_WARMUP)
+
+    if monitor is not None and (
+        (monitor.lags, monitor.forgetting, monitor.smooth, monitor.warmup) != params
+    ):
+        log("ARモニター: 設定が変わったので状態を作り直します")
+        monitor = None
+
+    if monitor is None:
+        monitor = ar_monitor.ArResidualMonitor(
+            len(symbols),
+            lags=AR_MONITOR_LAGS,
+            forgetting=AR_MONITOR_FORGET,
+            smooth=AR_MONITOR_SMOOTH,
+            warmup=AR_MONITOR_WARMUP,
+        )
+        return monitor, last_datetimes
+
+    old_pos = {symbol: i for i, symbol in enumerate(old_symbols)}
+    rows = np.array([old_pos.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+    last_datetimes[rows >= 0] = old_last[rows[rows >= 0]]
+
+    return monitor.reindex(rows), last_datetimes
+
 
-all_summary_df = pd.DataFrame(all_summary_rows)
-all_pairs_df = pd.DataFrame(all_pair_rows)
+def run_ar_monitor(files, coin_store):
+    """
+    全銘柄の前回以降のreturnsをモニターに入れる。
+    戻り値は (アラームの行, 銘柄ごとの行)。
+    """
+    coins = [(fp, coin_store[fp]) for fp in files if "error" not in coin_store[fp]]
+    symbols = [fp.stem for fp, _ in coins]
 
-all_summary_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_summary_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
-all_pairs_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_pairs_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
+    monitor, last_datetimes = load_ar_monitor(symbols)
 
-save_csv_safe(all_summary_df, all_summary_path)
-log(f"統合summary保存: {all_summary_path.name}")
+    # 前回の最終日時より後のreturnsだけ入れる (新しい銘柄は全部)
+    starts = [
+        0 if np.isnat(last) else int(np.searchsorted(coin["ret_datetime"], last, side="right"))
+        for (_, coin), last in zip(coins, last_datetimes)
+    ]
+    new_returns = [coin["returns"][start:] for (_, coin), start in zip(coins, starts)]
+    n_new = sum(len(r) for r in new_returns)
 
-save_csv_safe(all_pairs_df, all_pairs_path)
-log(f"統合pairs保存: {all_pairs_path.name}")
+    t0 = time.perf_counter()
+    outlier_list, change_list = ar_monitor.replay(monitor, new_returns)
+    elapsed = time.perf_counter() - t0
 
-log(f"全体累計変化点数: {len(all_pairs_df)}")
+    log(
+        f"ARモニター更新: 銘柄={len(coins)}, 追加returns={n_new}, "
+        f"{n_new / max(elapsed, 1e-9):,.0f} points/s, 処理時間={format_elapsed(elapsed)}"
+    )
 
-if all_pairs_df.empty:
-    log("変化点一覧は空です")
-else:
-    log("変化点一覧あり")
+    alarm_rows = []
+    coin_rows = []
+
+    for i, ((file_path, coin), start, outlier, change) in enumerate(
+        zip(coins, starts, outlier_list, change_list)
+    ):
+        ret_datetimes = coin["ret_datetime"]
+
+        above = np.nan_to_num(change, nan=-np.inf) >= AR_MONITOR_THRESHOLD
+        alarms = np.flatnonzero(above & ~np.concatenate([[False], above[:-1]]))
+
+        for j in alarms:
+            alarm_rows.append({
+                "run_id": RUN_ID,
+                "method": AR_MONITOR_METHOD,
+                "symbol": file_path.stem,
+                "file_name": file_path.name,
+                "cp_index_original": start + j,
+                "cp_datetime": ret_datetimes[start + j],
+                "return": coin["returns"][start + j],
+                "outlier_score": outlier[j],
+                "change_score": change[j],
+            })
+
+        has_score = np.isfinite(change).any()
+        peak = int(np.nanargmax(change)) if has_score else -1
+
+        coin_rows.append({
+            "run_id": RUN_ID,
+            "symbol": file_path.stem,
+            "file_name": file_path.name,
+            "returns": len(coin["returns"]),
+            "new_returns": len(change),
+            "alarm_count": len(alarms),
+            "max_change_score": change[peak] if has_score else np.nan,
+            "max_change_datetime": pd.Timestamp(ret_datetimes[start + peak]) if has_score else "",
+            "last_change_score": change[-1] if len(change) else np.nan,
+            "rmse": coin.get("rmse", np.nan),
+        })
+
+        if len(ret_datetimes):
+            last_datetimes[i] = ret_datetimes[-1]
+
+    ar_monitor.save_state(AR_MONITOR_STATE_PATH, monitor, symbols, last_datetimes)
+
+    return alarm_rows, coin_rows
 
 
 # =========================================================
-# 6. 集計保存
+# 10. メイン
 # =========================================================
 
-if not all_summary_df.empty:
-    agg_summary = (
-        all_summary_df
-        .groupby(["method", "model"], dropna=False)
-        .agg(
-            files=("file_name", "count"),
-            ok_files=("status", lambda x: int((x == "ok").sum())),
-            error_files=("status", lambda x: int((x == "error").sum())),
-            total_change_points=("change_point_count", "sum"),
-            mean_rmse=("rmse", "mean"),
-        )
-        .reset_index()
-        .sort_values(["total_change_points", "mean_rmse"], ascending=[False, True])
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="coingecko_by_coin の全銘柄に対して25組み合わせの変化点検知を行う"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="並列プロセス数 (1なら直列実行)"
+    )
+    parser.add_argument(
+        "--backend", choices=["ruptures", "numpy"], default=CP_BACKEND,
+        help="変化点検知の実装 (numpy: l1/l2/normal × pelt/binseg/bottomup を高速化)"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="逐次検知モード: 前回以降に追加された行だけ処理し、新たに確定した変化点を出力"
+    )
+    parser.add_argument(
+        "--resume", metavar="RUN_ID", default=None,
+        help="指定した RUN_ID の実行を再開 (結果ストアで完了済みの method × model × ファイルはスキップ)"
+    )
+    parser.add_argument(
+        "--multiscale", action="store_true",
+        help="長い系列を間引かず、粗い信号で検知してから元の解像度で変化点の位置を見直す"
+    )
+    parser.add_argument(
+        "--budget", type=float, metavar="SEC", default=None,
+        help="時間予算 (秒): サンプル銘柄で各組み合わせの速さを測り、"
+             "予算に収まるように組み合わせを並べ替え・間引き・省略する"
+    )
+    parser.add_argument(
+        "--panel", action="store_true",
+        help="パネルモード: 全銘柄を (時刻 × 銘柄) 行列にそろえ、市場全体の変化点を1回で求める"
     )
+    parser.add_argument(
+        "--ar-monitor", action="store_true",
+        help="ARの残差モニター: RLSで銘柄ごとのARを逐次更新し、異常スコアが閾値を超えた時点を出力"
+    )
+    parser.add_argument(
+        "--crops", action="store_true",
+        help="ペナルティパスモード: ペナルティの範囲全体の分割を CROPS で求めて表に保存"
+    )
+    parser.add_argument(
+        "--store", type=Path, metavar="DIR", default=None,
+        help="CSV の代わりにこの価格ストア (price_store.py) の全銘柄を読む"
+    )
+    return parser.parse_args()
 
-    agg_summary_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_summary_AGG_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
-    save_csv_safe(agg_summary, agg_summary_path)
-    log(f"統合集計summary保存: {agg_summary_path.name}")
 
-    log("===== 組み合わせ別ランキング =====")
-    print(agg_summary.to_string(index=False), flush=True)
+def main():
+    global CP_BACKEND, CP_RESOLUTION, RUN_ID
 
+    args = parse_args()
+    CP_BACKEND = args.backend
 
-# =========================================================
-# 7. 日別変化点数CSV/PNG
-# =========================================================
+    if args.multiscale:
+        CP_RESOLUTION = "multiscale"
 
-daily_df = extract_daily_counts_from_pairs(all_pairs_df)
+    if args.resume:
+        RUN_ID = args.resume
 
-daily_csv_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_daily_counts_ALL_METHODS_ALL_MODELS_{RUN_ID}.csv"
-save_csv_safe(daily_df, daily_csv_path)
-log(f"日別変化点数CSV保存: {daily_csv_path.name}")
+    if args.workers <= 0:
+        raise ValueError("--workers は 1 以上にしてください")
 
-daily_png_path = PLOT_DIR / f"{OUTPUT_PREFIX}_daily_counts_ALL_METHODS_ALL_MODELS_{RUN_ID}.png"
+    series_store, coin_ids = None, None
 
-if plot_daily_counts(
-    daily_df,
-    daily_png_path,
-    title="Daily Change Points - ALL METHODS / ALL MODELS"
-):
-    log(f"日別変化点数プロット保存: {daily_png_path.name}")
-else:
-    log("日別変化点数プロットは作成されませんでした")
+    if args.store is not None:
+        log(f"価格ストアから読込: {args.store}")
 
+        series_store = price_store.PriceStore(args.store)
+        files, coin_ids = price_store_files(series_store)
 
-# =========================================================
-# 8. 最終表示
-# =========================================================
+        if not files:
+            raise FileNotFoundError(f"価格ストアに銘柄がありません: {args.store}")
+    else:
+        log("ファイル検索開始")
+
+        files = sorted(DATA_DIR.glob(FILE_PATTERN))
+
+        if not files:
+            raise FileNotFoundError(f"対象ファイルが見つかりません: {DATA_DIR / FILE_PATTERN}")
+
+    log(f"対象ファイル数: {len(files)}")
+    log(f"出力先: {OUTPUT_DIR.resolve()}")
+    log(f"並列プロセス数: {args.workers}")
+    log(f"変化点検知バックエンド: {CP_BACKEND}")
+    log(f"長い系列の扱い: {CP_RESOLUTION}")
+
+    log(f"RUN_ID: {RUN_ID}")
+
+    progress = Progress(
+        metrics_path=OUTPUT_DIR / f"{OUTPUT_PREFIX}_metrics_{RUN_ID}.jsonl",
+        run_id=RUN_ID,
+        echo=log,
+        refresh_sec=PROGRESS_REFRESH_SEC,
+        metrics_sec=METRICS_INTERVAL_SEC,
+        plain_sec=PROGRESS_PLAIN_SEC,
+    )
+
+    log("全ファイル事前読込開始")
+    coin_store = load_coin_store(files, progress, series_store, coin_ids)
+    log(
+        f"全ファイル事前読込完了: ok={sum('error' not in v for v in coin_store.values())}, "
+        f"error={sum('error' in v for v in coin_store.values())}"
+    )
+
+    ar_hits, ar_fits = attach_ar_rmse(coin_store, progress, lags=AR_LAGS)
+    log(f"AR RMSE計算完了: cache_hit={ar_hits}, fit={ar_fits}")
+
+    if args.incremental:
+        pair_rows = run_incremental(files, coin_store)
+        progress.close()
+
+        pairs_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_pairs_INCREMENTAL_{RUN_ID}.csv"
+        save_csv_safe(pd.DataFrame(pair_rows), pairs_path)
+
+        total_elapsed = (datetime.now() - START_TIME).total_seconds()
+        log(f"逐次検知pairs保存: {pairs_path.name}")
+        log(f"新規確定変化点数: {len(pair_rows)}")
+        log(f"総処理時間: {format_elapsed(total_elapsed)}")
+        log("完了")
+        return
+
+    if args.crops:
+        crops_rows = run_crops(files, coin_store)
+        progress.close()
+
+        crops_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_crops_{RUN_ID}.csv"
+        save_csv_safe(pd.DataFrame(crops_rows), crops_path)
+
+        total_elapsed = (datetime.now() - START_TIME).total_seconds()
+        log(f"ペナルティパス保存: {crops_path.name}")
+        log(f"行数: {len(crops_rows)}")
+        log(f"総処理時間: {format_elapsed(total_elapsed)}")
+        log("完了")
+        return
+
+    if args.ar_monitor:
+        alarm_rows, monitor_rows = run_ar_monitor(files, coin_store)
+        progress.close()
+
+        alarm_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_ar_monitor_{RUN_ID}.csv"
+        monitor_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_ar_monitor_summary_{RUN_ID}.csv"
+        save_csv_safe(pd.DataFrame(alarm_rows), alarm_path)
+
+        monitor_df = pd.DataFrame(monitor_rows)
+        if not monitor_df.empty:
+            monitor_df = monitor_df.sort_values("max_change_score", ascending=False)
+        save_csv_safe(monitor_df, monitor_path)
+
+        total_elapsed = (datetime.now() - START_TIME).total_seconds()
+        log(f"ARモニターのアラーム保存: {alarm_path.name}")
+        log(f"ARモニターの銘柄別保存: {monitor_path.name}")
+        log(f"アラーム数: {len(alarm_rows)}")
+        log(f"総処理時間: {format_elapsed(total_elapsed)}")
+        log("完了")
+        return
+
+    if args.panel:
+        panel_rows, panel_daily_rows = run_panel(files, coin_store)
+        progress.close()
+
+        panel_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_panel_{RUN_ID}.csv"
+        panel_daily_path = OUTPUT_DIR / f"{OUTPUT_PREFIX}_panel_daily_{RUN_ID}.csv"
+        save_csv_safe(pd.DataFrame(panel_rows), panel_path)
+
+        panel_daily_df = pd.DataFrame(panel_daily_rows)
+        save_csv_safe(panel_daily_df, panel_daily_path)
+
+        if plot_daily_counts(
+            panel_daily_df,
+            OUTPUT_DIR / f"{OUTPUT_PREFIX}_panel_daily_{RUN_ID}.png",
+            "Market-wide change points per day (panel)"
+        ):
+            log(f"パネル日別PNG保存: {OUTPUT_PREFIX}_panel_daily_{RUN_ID}.png")
+
+        total_elapsed = (datetime.now() - START_TIME).total_seconds()
+        log(f"パネル変化点保存: {panel_path.name}")
+        log(f"市場全体の変化点数: {len(panel_rows)}")
+        log(f"総処理時間: {format_elapsed(total_elapsed)}")
+        log("完了")
+        return
+
+    store = results_store.ResultsStore(RESULTS_DB_PATH)
+
+    try:
+        run_all_combinations(
+            files, coin_store, store, progress, workers=args.workers, budget_sec=args.budget
+        )
+        save_combined_outputs(store)
+
+        summary_count = store.count("summary", RUN_ID)
+        pairs_count = store.count("pairs", RUN_ID)
+    finally:
+        store.close()
+        progress.close()
+
+    total_elapsed = (datetime.now() - START_TIME).total_seconds()
+
+    log("====================================")
+    log("処理結果")
+    log(f"summary行数: {summary_count}")
+    log(f"pairs行数: {pairs_count}")
+    log(f"全体累計変化点数: {pairs_count}")
+    log(f"出力先: {OUTPUT_DIR.resolve()}")
+    log(f"総処理時間: {format_elapsed(total_elapsed)}")
+    log("完了")
 
-total_elapsed = (datetime.now() - START_TIME).total_seconds()
 
-log("====================================")
-log("処理結果")
-log(f"summary行数: {len(all_summary_df)}")
-log(f"pairs行数: {len(all_pairs_df)}")
-log(f"全体累計変化点数: {len(all_pairs_df)}")
-log(f"出力先: {OUTPUT_DIR.resolve()}")
-log(f"総処理時間: {format_elapsed(total_elapsed)}")
-log("完了")
\ No newline at end of file
+if __name__ == "__main__":
+    main()